@@ -6,3 +6,4 @@ from crm import models
 admin.site.register(models.Customer)
 admin.site.register(models.Contract)
 admin.site.register(models.Event)
+admin.site.register(models.OutboxMessage)
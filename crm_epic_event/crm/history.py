@@ -0,0 +1,117 @@
+"""
+Change history of the customers, contracts and events (crm.models.HistoryEntry).
+
+When they are saved, the models compare their fields with the values in the
+database (HistoryMixin), and give the changes to record(). Those values are
+read by the first save of an instance (one SELECT) : the loading keeps
+nothing, and the reads (lists, exports) cost nothing. An entry is
+only kept once its transaction is committed : nothing is written for a change
+rolled back. During a request, the entries are buffered and written by the
+HistoryMiddleware with a single INSERT, whatever the number of instances
+saved, once the response is sent : the client doesn't wait for it.
+Outside of a request (commands, shell), each entry is written when committed.
+The instances written without save() (update(), bulk_create) are not recorded.
+"""
+import threading
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import transaction
+from django.dispatch import receiver
+
+
+# The entries of the write request being served.
+current_entries = ContextVar('current_entries', default=None)
+# The entries of the responses not closed yet, by thread : the servers close
+# a response in the thread which served it (sync_to_async for ASGI).
+pending = threading.local()
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RequestEntries:
+    def __init__(self, request):
+        self.request = request
+        self.entries = []
+        self.flushed = False
+
+    def get_user(self):
+        # The user set by the authentication of DRF, who also sets it on the
+        # request of Django.
+        user = getattr(self.request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return None
+        return user
+
+    def flush(self):
+        self.flushed = True
+        flush(self.entries)
+
+
+def is_enabled():
+    return getattr(settings, 'HISTORY_ENABLED', True)
+
+
+def record(entry):
+    """
+    Attributes the entry to the user of the request, and keeps it when the
+    transaction is committed (at once if there is none).
+    """
+    request_entries = current_entries.get()
+    user = request_entries.get_user() if request_entries is not None else None
+    if user is not None:
+        entry.user_id = user.id
+        entry.username = user.username
+
+    def keep():
+        # A transaction can be committed after the end of the request (ex: the
+        # one of a TestCase).
+        if request_entries is not None and not request_entries.flushed:
+            request_entries.entries.append(entry)
+        else:
+            flush([entry])
+
+    transaction.on_commit(keep)
+
+
+def flush(entries):
+    from crm.models import HistoryEntry
+
+    if entries:
+        HistoryEntry.objects.bulk_create(entries)
+
+
+class HistoryMiddleware:
+    """
+    Buffers the history entries of the write requests, and writes them when
+    the server closes the response, after sending it (request_finished).
+    They are written even if the request failed after some changes were
+    committed. The reads cost nothing.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in SAFE_METHODS or not is_enabled():
+            return self.get_response(request)
+
+        request_entries = RequestEntries(request)
+        token = current_entries.set(request_entries)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            request_entries.flush()
+            raise
+        finally:
+            current_entries.reset(token)
+        pending.entries = getattr(pending, 'entries', []) + [request_entries]
+        return response
+
+
+@receiver(request_finished)
+def flush_pending(sender, **kwargs):
+    entries = getattr(pending, 'entries', [])
+    pending.entries = []
+    for request_entries in entries:
+        request_entries.flush()
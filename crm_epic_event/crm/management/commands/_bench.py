@@ -0,0 +1,51 @@
+"""
+Helpers shared by the bench_* commands.
+"""
+import statistics
+import time
+
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+
+def make_view(viewset_class, user, path, params=None, kwargs=None, action='list'):
+    """
+    Returns a viewset ready to build its queryset, as it would be during a
+    request on the path, done by the user.
+    """
+    request = Request(APIRequestFactory().get(path, params or {}))
+    request.user = user
+    view = viewset_class()
+    view.request = request
+    view.kwargs = kwargs or {}
+    view.action = action
+    view.format_kwarg = None
+    return view
+
+
+def measure(function, runs):
+    """
+    Runs the function and returns the p50, p95, p99 and max durations in ms.
+    """
+    durations = []
+    for i in range(runs):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return summarize(durations)
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    runs = len(durations)
+    return {
+        'p50': statistics.median(durations),
+        'p95': durations[min(int(runs * 0.95), runs - 1)],
+        'p99': durations[min(int(runs * 0.99), runs - 1)],
+        'max': durations[-1]
+    }
+
+
+def format_timings(timings):
+    return 'p50 %.2f ms | p95 %.2f ms | p99 %.2f ms | max %.2f ms' % (
+        timings['p50'], timings['p95'], timings['p99'], timings['max'])
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from crm.management.commands._bench import format_timings, summarize
+from users.models import User
+from users.serializers import RoleTokenObtainPairSerializer
+
+
+SERVERS = {
+    'wsgi': ['crm_epic_event.wsgi'],
+    'asgi, sync views': ['crm_epic_event.asgi:sync_application', '-k', 'uvicorn.workers.UvicornWorker'],
+    'asgi, async reads': ['crm_epic_event.asgi', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+class Command(BaseCommand):
+    help = ('Starts the WSGI and the ASGI applications with gunicorn, one after the '
+            'other, and compares their requests per second and latencies with '
+            'many concurrent clients which send their requests slowly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+            help='Number of events to create first with seed_crm (ex: 100000).')
+        parser.add_argument('--path', default='/api/contracts/')
+        parser.add_argument('--role', default='SELLER', choices=['MANAGER', 'SELLER', 'SUPPORT'])
+        parser.add_argument('--clients', type=int, default=200,
+            help='Number of concurrent clients.')
+        parser.add_argument('--slow', type=float, default=0.5,
+            help='Seconds each client takes to send its request.')
+        parser.add_argument('--duration', type=float, default=20)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            call_command('seed_crm', events=options['seed'])
+        user = User.objects.filter(role=options['role']).first()
+        if user is None:
+            raise CommandError('No %s in the database, run seed_crm first' % options['role'])
+        token = str(RoleTokenObtainPairSerializer.get_token(user).access_token)
+
+        for name, arguments in SERVERS.items():
+            server = self.start_server(arguments, options)
+            try:
+                sessions = self.sessions()
+                results = asyncio.run(self.load(token, options))
+                results['sessions'] = self.sessions() - sessions
+            finally:
+                server.terminate()
+                server.wait()
+            self.report(name, results, options)
+
+    def sessions(self):
+        """
+        Number of connections opened to the database since its statistics
+        were reset (PostgreSQL 14+).
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_stat_clear_snapshot()')
+            cursor.execute('SELECT sessions FROM pg_stat_database WHERE datname = current_database()')
+            return cursor.fetchone()[0]
+
+    def start_server(self, arguments, options):
+        command = [sys.executable, '-m', 'gunicorn', '--pythonpath', str(settings.BASE_DIR),
+                   '-w', str(options['workers']), '-b', '127.0.0.1:%s' % options['port'],
+                   '--log-level', 'warning', *arguments]
+        server = subprocess.Popen(command, env=os.environ.copy())
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', options['port']), timeout=1).close()
+                return server
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('The server did not start: ' + ' '.join(command))
+
+    async def load(self, token, options):
+        request = ('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer %s\r\n'
+                   'Connection: close\r\n\r\n' % (options['path'], token)).encode()
+        deadline = time.monotonic() + options['duration']
+        results = {'durations': [], 'errors': 0, 'start': time.monotonic()}
+        await asyncio.gather(*[self.client(request, deadline, results, options)
+                               for i in range(options['clients'])])
+        results['elapsed'] = time.monotonic() - results['start']
+        return results
+
+    async def client(self, request, deadline, results, options):
+        """
+        Sends the request in two halves, options['slow'] seconds apart, and
+        times the response from the end of the request.
+        """
+        middle = len(request) // 2
+        while time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', options['port'])
+                writer.write(request[:middle])
+                await writer.drain()
+                await asyncio.sleep(options['slow'])
+                writer.write(request[middle:])
+                await writer.drain()
+                sent = time.monotonic()
+                response = await asyncio.wait_for(reader.read(), 60)
+                writer.close()
+                if response.startswith(b'HTTP/1.1 200'):
+                    results['durations'].append((time.monotonic() - sent) * 1000)
+                else:
+                    results['errors'] += 1
+            except (OSError, asyncio.TimeoutError):
+                results['errors'] += 1
+
+    def report(self, name, results, options):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            '%s | %s clients | %s' % (name, options['clients'], options['path'])))
+        if not results['durations']:
+            self.stdout.write('No successful request, %s errors\n' % results['errors'])
+            return
+        self.stdout.write('%.1f requests/s | %s errors | %s' % (
+            len(results['durations']) / results['elapsed'], results['errors'],
+            format_timings(summarize(results['durations']))))
+        self.stdout.write('%s connections opened to the database, %.2f per request\n' % (
+            results['sessions'], results['sessions'] / len(results['durations'])))
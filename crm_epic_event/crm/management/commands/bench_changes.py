@@ -0,0 +1,76 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from crm.models import ContractVisibility, Event
+from crm.management.commands._bench import format_timings, summarize
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = ('Measures the sync of the events by the apps : a full download '
+            '(GET /api/events/changes/ without updated_since, every page), then '
+            'an incremental sync after --changed events were updated, for the '
+            'MANAGER and for the busiest SUPPORT member. The date_updated of the '
+            'events are restored at the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--changed', type=int, default=10)
+        parser.add_argument('--limit', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        manager = User.objects.filter(role='MANAGER').first()
+        busiest = ContractVisibility.objects.filter(user__role='SUPPORT', event__isnull=False
+            ).values('user').annotate(events=Count('id')).order_by('-events').first()
+        support = User.objects.get(id=busiest['user']) if busiest != None else None
+        if manager is None or support is None:
+            raise CommandError('No MANAGER or SUPPORT in the database, run seed_crm first')
+
+        for user in [manager, support]:
+            client = APIClient(HTTP_HOST='127.0.0.1')
+            client.force_authenticate(user=user)
+            events = list(Event.objects.visible_to(user).order_by('id').values_list(
+                'id', 'date_updated')[:options['changed']])
+            since = timezone.now()
+            try:
+                Event.objects.filter(id__in=[id for id, date_updated in events]).update(
+                    date_updated=since + timedelta(microseconds=1))
+                with override_settings(SYNC_LAG=0):
+                    full = self.sync(client, None, options)
+                    delta = self.sync(client, since, options)
+            finally:
+                for id, date_updated in events:
+                    Event.objects.filter(id=id).update(date_updated=date_updated)
+            if delta[0] != len(events):
+                raise CommandError('The sync returned %s events instead of %s' % (delta[0], len(events)))
+            self.stdout.write('%-8s %s' % (user.role, user.username))
+            for label, (rows, pages, queries, timings) in [('full', full), ('changes', delta)]:
+                self.stdout.write('  %-8s | %6s events | %3s pages | %3s queries | %s' % (
+                    label, rows, pages, queries, format_timings(timings)))
+
+    def sync(self, client, since, options):
+        """
+        Downloads all the pages. Returns the number of events, of pages and of
+        queries, and the timings.
+        """
+        params = {'limit': options['limit']}
+        if since != None:
+            params['updated_since'] = since.isoformat()
+        durations = []
+        for i in range(options['runs']):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = client.get('/api/events/changes/', params)
+                pages = [response.data]
+                while pages[-1]['next'] != None:
+                    pages.append(client.get(pages[-1]['next']).data)
+                durations.append((time.perf_counter() - start) * 1000)
+        rows = sum(len(page['results']) for page in pages)
+        return rows, len(pages), len(context.captured_queries), summarize(durations)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from django.db import connections, DatabaseError
+from django.db.backends.postgresql.base import DatabaseWrapper
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.models import Contract
+from crm_epic_event.postgresql_pool.base import DatabaseWrapper as PoolDatabaseWrapper
+from crm.management.commands._bench import format_timings, summarize
+from users.models import User
+
+
+APPLICATION_NAME = 'bench_db_pool'
+
+# (name, wrapper class, CONN_MAX_AGE)
+MODES = [
+    ('persistent', DatabaseWrapper, 600),
+    ('per request', DatabaseWrapper, 0),
+    ('pool', PoolDatabaseWrapper, 0),
+]
+
+
+class Command(BaseCommand):
+    help = ('Runs the queries of a /contracts/ page from more and more threads, '
+            'like the threads of a worker, with a persistent connection per '
+            'thread (CONN_MAX_AGE=600), a new connection per request '
+            '(CONN_MAX_AGE=0), and the pool of crm_epic_event/postgresql_pool. '
+            'Prints the latencies, the errors and the number of connections '
+            'opened on the server.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,5,20,50,100',
+            help='Numbers of threads, separated by commas.')
+        parser.add_argument('--pool-size', type=int, default=10)
+        parser.add_argument('--pool-timeout', type=float, default=10)
+        parser.add_argument('--duration', type=float, default=10,
+            help='Seconds of each run.')
+
+    def handle(self, *args, **options):
+        seller = User.objects.filter(role='SELLER').first()
+        if seller is None:
+            raise CommandError('No SELLER in the database, run seed_crm first')
+        queryset = Contract.objects.visible_to(seller).select_related(
+            'customer', 'support', 'event').order_by('-date_created', '-id')
+        # The queries of the first page of the list.
+        queries = [queryset.order_by().values('id').query.sql_with_params(),
+                   queryset[:100].query.sql_with_params()]
+        # Replaces "SELECT ..." of the count, which is built by the paginator.
+        queries[0] = ('SELECT COUNT(*) FROM (%s) subquery' % queries[0][0], queries[0][1])
+
+        for concurrency in [int(value) for value in options['concurrency'].split(',')]:
+            for name, wrapper_class, conn_max_age in MODES:
+                results = self.run(wrapper_class, conn_max_age, concurrency, queries, options)
+                self.report(name, concurrency, results, options)
+
+    def make_wrapper(self, wrapper_class, conn_max_age, alias, options):
+        settings_dict = dict(connections['default'].settings_dict)
+        settings_dict['OPTIONS'] = {**settings_dict['OPTIONS'],
+                                    'application_name': APPLICATION_NAME}
+        settings_dict['CONN_MAX_AGE'] = conn_max_age
+        settings_dict['POOL'] = {'SIZE': options['pool_size'],
+                                 'TIMEOUT': options['pool_timeout']}
+        return wrapper_class(settings_dict, alias=alias)
+
+    def run(self, wrapper_class, conn_max_age, concurrency, queries, options):
+        results = {'durations': [], 'errors': 0, 'connections': 0}
+        lock = threading.Lock()
+        # django.contrib.postgres reads the settings of the wrappers by alias.
+        alias = 'default'
+        deadline = time.monotonic() + options['duration']
+        done = threading.Event()
+        monitor = threading.Thread(target=self.count_connections, args=(results, done))
+        threads = [threading.Thread(target=self.client,
+                       args=(wrapper_class, conn_max_age, alias, queries, deadline,
+                             results, lock, options))
+                   for i in range(concurrency)]
+        monitor.start()
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results['elapsed'] = time.monotonic() - start
+        done.set()
+        monitor.join()
+        if wrapper_class is PoolDatabaseWrapper:
+            # The pool isn't reused by the next run.
+            self.make_wrapper(wrapper_class, conn_max_age, alias, options).close_pool()
+        return results
+
+    def client(self, wrapper_class, conn_max_age, alias, queries, deadline, results, lock, options):
+        """
+        One thread of a worker : its own wrapper, like django.db.connection,
+        and a request_finished at the end of each request.
+        """
+        wrapper = self.make_wrapper(wrapper_class, conn_max_age, alias, options)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                with wrapper.cursor() as cursor:
+                    for sql, params in queries:
+                        cursor.execute(sql, params)
+                        cursor.fetchall()
+                duration = (time.perf_counter() - start) * 1000
+                with lock:
+                    results['durations'].append(duration)
+            except DatabaseError:
+                with lock:
+                    results['errors'] += 1
+                time.sleep(0.1)
+            finally:
+                wrapper.close_if_unusable_or_obsolete()
+        wrapper.close()
+
+    def count_connections(self, results, done):
+        """
+        Highest number of connections of the benchmark opened on the server.
+        """
+        wrapper = DatabaseWrapper(dict(connections['default'].settings_dict), alias='default')
+        with wrapper.cursor() as cursor:
+            while not done.wait(0.05):
+                cursor.execute('SELECT COUNT(*) FROM pg_stat_activity WHERE application_name = %s',
+                               [APPLICATION_NAME])
+                results['connections'] = max(results['connections'], cursor.fetchone()[0])
+        wrapper.close()
+
+    def report(self, name, concurrency, results, options):
+        label = name if name != 'pool' else 'pool of %s' % options['pool_size']
+        line = '%4s threads | %-12s | %4s connections | %7.1f req/s | %5s errors' % (
+            concurrency, label, results['connections'],
+            len(results['durations']) / results['elapsed'], results['errors'])
+        if results['durations']:
+            line += ' | ' + format_timings(summarize(results['durations']))
+        self.stdout.write(line)
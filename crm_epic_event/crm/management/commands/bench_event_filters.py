@@ -0,0 +1,75 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from crm import models
+from crm.views import EventViewset
+from users.models import User
+from crm.management.commands._bench import make_view, measure, format_timings
+
+
+CASES = [
+    {},
+    {'last_name': 'customer12'},
+    {'compagny_name': 'compagny 42', 'email': 'example'},
+    {'last_name': 'customer1', 'date': '2026'},
+]
+
+
+def legacy_queryset(view):
+    """
+    The EventViewset.get_queryset before the customer filters were merged in
+    a single join : one level of IN-subquery per filter, used or not.
+    """
+    queryset = view.fetch_queryset()
+    params = view.request.query_params
+    last_name = params.get('last_name')
+    compagny_name = params.get('compagny_name')
+    email = params.get('email')
+    date = params.get('date')
+
+    queryset = models.Event.objects.filter(id__in=models.Contract.objects.filter(
+        event__in=queryset, customer__last_name__icontains=last_name).values('event')
+        if last_name else queryset)
+    queryset = models.Event.objects.filter(id__in=models.Contract.objects.filter(
+        event__in=queryset, customer__compagny_name__icontains=compagny_name).values('event')
+        if compagny_name else queryset)
+    queryset = models.Event.objects.filter(id__in=models.Contract.objects.filter(
+        event__in=queryset, customer__email__icontains=email).values('event')
+        if email else queryset)
+    return queryset.filter(date_event__icontains=date) if date else queryset
+
+
+class Command(BaseCommand):
+    help = ('Compares the plan and the latency of the /events/ list queryset '
+            'before and after the merge of the customer filters.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+            help='Number of events to create first with seed_crm (ex: 1000000).')
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--analyze', action='store_true',
+            help='Print EXPLAIN ANALYZE instead of EXPLAIN.')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            call_command('seed_crm', events=options['seed'])
+        self.stdout.write('%s events in the database\n' % models.Event.objects.count())
+
+        users = [User.objects.filter(role='MANAGER').first(),
+                 User.objects.filter(role='SELLER').first()]
+        for user in [user for user in users if user is not None]:
+            for params in CASES:
+                view = make_view(EventViewset, user, '/api/events/', params)
+                for name, queryset in [('before', legacy_queryset(view)),
+                                       ('after', view.get_queryset())]:
+                    self.report(name, user, params, queryset, options)
+
+    def report(self, name, user, params, queryset, options):
+        def list_page():
+            queryset.count()
+            list(queryset[:100])
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            '%s | %s | %s' % (name, user.role, params or 'no filter')))
+        self.stdout.write(queryset.explain(analyze=options['analyze']))
+        self.stdout.write(format_timings(measure(list_page, options['runs'])) + '\n')
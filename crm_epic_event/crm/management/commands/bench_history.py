@@ -0,0 +1,75 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from crm.models import Contract, HistoryEntry
+from crm.management.commands._bench import format_timings, summarize
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = ('Measures a PATCH of a contract through the whole middleware stack, '
+            'with and without the change history (HISTORY_ENABLED) : the time '
+            'until the response is sent, and until it is closed (the history is '
+            'written in between). The contract and the history are restored at '
+            'the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=500)
+
+    def handle(self, *args, **options):
+        manager = User.objects.filter(role='MANAGER').first()
+        contract = Contract.objects.filter(seller__isnull=False, support__isnull=False,
+                                           customer__isnull=False).order_by('id').first()
+        if manager is None or contract is None:
+            raise CommandError('No MANAGER or contract in the database, run seed_crm first')
+        client = APIClient(HTTP_HOST='127.0.0.1')
+        client.force_authenticate(user=manager)
+        url = '/api/contracts/%s/' % contract.id
+        data = {'support': contract.support_id, 'seller': contract.seller_id,
+                'customer': contract.customer_id}
+        last_entry = HistoryEntry.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+        durations = {True: [], False: []}
+        # Until the response is closed, with the INSERT of the history.
+        busy_durations = {True: [], False: []}
+        queries = {}
+        try:
+            # Warm up, then the two modes one request after the other, so they
+            # see the same state of the database and of the caches.
+            # Each request changes the due.
+            for i in range(options['runs'] + 10):
+                for enabled in [False, True]:
+                    with override_settings(HISTORY_ENABLED=enabled):
+                        with CaptureQueriesContext(connection) as context:
+                            start = time.perf_counter()
+                            response = client.patch(url, {**data, 'due': 1000 + enabled},
+                                                    format='multipart')
+                            busy = (time.perf_counter() - start) * 1000
+                    if response.status_code != 200:
+                        raise CommandError('PATCH %s returned %s' % (url, response.status_code))
+                    if i >= 10:
+                        # Until the response is given to the server, from the
+                        # Server-Timing header of the MetricsMiddleware.
+                        durations[enabled].append(float(
+                            response['Server-Timing'].split('total;dur=')[1]))
+                        busy_durations[enabled].append(busy)
+                    queries[enabled] = len(context.captured_queries)
+        finally:
+            Contract.objects.filter(id=contract.id).update(due=contract.due)
+            HistoryEntry.objects.filter(id__gt=last_entry).delete()
+
+        timings = {enabled: summarize(durations[enabled]) for enabled in durations}
+        busy_timings = {enabled: summarize(busy_durations[enabled]) for enabled in durations}
+        for enabled, label in [(False, 'without history'), (True, 'with history')]:
+            self.stdout.write('%-16s | %2s queries | response %s' % (
+                label, queries[enabled], format_timings(timings[enabled])))
+            self.stdout.write('%-16s |            | closed   %s' % (
+                '', format_timings(busy_timings[enabled])))
+        self.stdout.write('The history adds %.3f ms to the median response, '
+                          '%.3f ms until it is closed' % (
+            timings[True]['p50'] - timings[False]['p50'],
+            busy_timings[True]['p50'] - busy_timings[False]['p50']))
@@ -0,0 +1,69 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from crm.renderers import FastJSONRenderer, orjson
+from crm.views import ContractViewset, CustomerViewset, EventViewset
+from users.models import User
+from crm.management.commands._bench import make_view, measure, format_timings
+
+
+VIEWSETS = [
+    ('customers', CustomerViewset),
+    ('contracts', ContractViewset),
+    ('events', EventViewset),
+]
+
+
+class Command(BaseCommand):
+    help = ('Compares the rendering of a page of the /customers/, /contracts/ and '
+            '/events/ lists with the list serializers and JSONRenderer, and with the '
+            'fast path (.values(), rows_from_values and FastJSONRenderer). Checks '
+            'that both give the same bytes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+            help='Number of events to create first with seed_crm (ex: 100000).')
+        parser.add_argument('--role', default='MANAGER', choices=['MANAGER', 'SELLER', 'SUPPORT'])
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--runs', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            call_command('seed_crm', events=options['seed'])
+        user = User.objects.filter(role=options['role']).first()
+        if user is None:
+            raise CommandError('No %s in the database, run seed_crm first' % options['role'])
+        if orjson is None:
+            self.stdout.write(self.style.WARNING('orjson is not installed, FastJSONRenderer '
+                                                 'falls back to JSONRenderer'))
+
+        for name, viewset_class in VIEWSETS:
+            view = make_view(viewset_class, user, '/api/%s/' % name)
+            self.compare(name, view, options)
+
+    def compare(self, name, view, options):
+        serializer_class = view.get_serializer_class()
+        size = options['page_size']
+        queryset = view.get_queryset().order_by('-date_created', '-id')
+        values = queryset.values(*serializer_class.get_values_columns())
+
+        def serializer_render(instances):
+            return JSONRenderer().render(serializer_class(instances, many=True).data)
+
+        def values_render(rows):
+            return FastJSONRenderer().render(serializer_class.rows_from_values(rows))
+
+        instances = list(queryset[:size])
+        rows = list(values[:size])
+        if serializer_render(instances) != values_render(rows):
+            raise CommandError('The fast path of /%s/ gives a different output' % name)
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            '/%s/ | %s | %s rows' % (name, view.request.user.role, len(rows))))
+        for label, function in [
+                ('serializer, query and render', lambda: serializer_render(list(queryset[:size]))),
+                ('values, query and render', lambda: values_render(list(values[:size]))),
+                ('serializer, render only', lambda: serializer_render(instances)),
+                ('values, render only', lambda: values_render(rows))]:
+            self.stdout.write('%-30s %s' % (label, format_timings(measure(function, options['runs']))))
@@ -0,0 +1,152 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import User
+from users.serializers import RoleTokenObtainPairSerializer
+
+
+# Run in a new interpreter : time to import the WSGI application and its urls,
+# like a worker does before its first request.
+IMPORT_SCRIPT = '''
+import json, os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crm_epic_event.settings')
+start = time.perf_counter()
+from crm_epic_event.wsgi import application
+setup = time.perf_counter()
+from django.urls import get_resolver, reverse
+get_resolver().url_patterns
+reverse('customers-list')
+if %(admin)r:
+    reverse('admin:index')
+end = time.perf_counter()
+rss = int(open('/proc/self/status').read().split('VmRSS:')[1].split()[0])
+print(json.dumps({'setup': setup - start, 'total': end - start, 'rss': rss,
+                  'modules': len(sys.modules), 'admin': 'crm.admin' in sys.modules}))
+'''
+
+
+def memory(pid):
+    """
+    RSS, PSS (the shared pages divided between the processes which share
+    them) and USS (the private pages) of a process, in kB.
+    """
+    values = {}
+    with open('/proc/%s/smaps_rollup' % pid) as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return {'rss': values['Rss'], 'pss': values['Pss'],
+            'uss': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def children(pid):
+    pids = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/%s/stat' % name) as file:
+                    # The name of the process, in parentheses, can have spaces.
+                    ppid = int(file.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if ppid == pid:
+                pids.append(int(name))
+    return pids
+
+
+class Command(BaseCommand):
+    help = ('Measures the startup of the application : the import time of the WSGI '
+            'application and its urls, with and without the admin, then the time to '
+            'the first response and the memory of each worker of gunicorn (see '
+            'gunicorn.conf.py), with and without preload_app.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5,
+            help='Number of imports measured.')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--threads', type=int, default=2)
+        parser.add_argument('--requests', type=int, default=200,
+            help='Requests sent before measuring the memory, so that every worker serves some.')
+        parser.add_argument('--port', type=int, default=8766)
+
+    def handle(self, *args, **options):
+        if sys.platform != 'linux':
+            raise CommandError('The memory is read from /proc, on Linux only')
+        self.stdout.write(self.style.MIGRATE_HEADING('Import of the application'))
+        for label, admin in [('without the admin', False), ('with the admin', True)]:
+            self.report_import(label, admin, options)
+
+        user = User.objects.filter(role='MANAGER').first()
+        if user is None:
+            raise CommandError('No MANAGER in the database, run seed_crm first')
+        token = str(RoleTokenObtainPairSerializer.get_token(user).access_token)
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            'gunicorn, %s workers of %s threads' % (options['workers'], options['threads'])))
+        for label, preload in [('without preload_app', '0'), ('with preload_app', '1')]:
+            self.report_server(label, preload, token, options)
+
+    def report_import(self, label, admin, options):
+        runs = []
+        for i in range(options['runs']):
+            output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT % {'admin': admin}],
+                                    cwd=settings.BASE_DIR, env=os.environ.copy(),
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        self.stdout.write('%-20s django.setup %6.0f ms | with the urls %6.0f ms | '
+                          '%s modules | RSS %6.1f MB' % (
+            label, statistics.median(run['setup'] for run in runs) * 1000,
+            statistics.median(run['total'] for run in runs) * 1000,
+            runs[-1]['modules'], statistics.median(run['rss'] for run in runs) / 1024))
+
+    def report_server(self, label, preload, token, options):
+        env = dict(os.environ, GUNICORN_PRELOAD=preload, WEB_CONCURRENCY=str(options['workers']),
+                   GUNICORN_THREADS=str(options['threads']), GUNICORN_MAX_REQUESTS='0')
+        command = [sys.executable, '-m', 'gunicorn', '-c',
+                   str(settings.BASE_DIR.parent / 'gunicorn.conf.py'),
+                   '--pythonpath', str(settings.BASE_DIR), '-b', '127.0.0.1:%s' % options['port'],
+                   '--log-level', 'warning', 'crm_epic_event.wsgi']
+        start = time.monotonic()
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+        try:
+            first_response = self.wait_first_response(start, options)
+            url = 'http://127.0.0.1:%s/api/customers/?limit=10' % options['port']
+            for i in range(options['requests']):
+                request = urllib.request.Request(url, headers={'Authorization': 'Bearer ' + token})
+                urllib.request.urlopen(request, timeout=30).read()
+            master = memory(server.pid)
+            workers = [memory(pid) for pid in children(server.pid)]
+        finally:
+            server.terminate()
+            server.wait()
+
+        self.stdout.write('%-20s first response %6.0f ms | master RSS %6.1f MB | '
+                          'per worker : RSS %6.1f MB, PSS %6.1f MB, USS %6.1f MB | '
+                          'total PSS %6.1f MB' % (
+            label, first_response * 1000, master['rss'] / 1024,
+            statistics.mean(worker['rss'] for worker in workers) / 1024,
+            statistics.mean(worker['pss'] for worker in workers) / 1024,
+            statistics.mean(worker['uss'] for worker in workers) / 1024,
+            (master['pss'] + sum(worker['pss'] for worker in workers)) / 1024))
+
+    def wait_first_response(self, start, options):
+        url = 'http://127.0.0.1:%s/api/metrics' % options['port']
+        while time.monotonic() - start < 60:
+            try:
+                urllib.request.urlopen(url, timeout=5).read()
+                return time.monotonic() - start
+            except urllib.error.HTTPError:
+                # Answered, a 403 if METRICS_TOKEN is set.
+                return time.monotonic() - start
+            except OSError:
+                time.sleep(0.02)
+        raise CommandError('gunicorn did not answer after 60 seconds')
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm.models import Event
+
+
+class Command(BaseCommand):
+    help = ('Marks the events whose date is passed as finished. To run '
+            'periodically (ex: every hour with cron or the Heroku Scheduler).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+            help='Events updated by each UPDATE.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        finished = Event.finish_past_events(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('%s events finished in %.0f ms' % (
+            finished, (time.perf_counter() - start) * 1000)))
@@ -0,0 +1,235 @@
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.management.commands._bench import format_timings, summarize
+from users.models import User
+
+
+ROLES = ['MANAGER', 'SELLER', 'SUPPORT']
+
+# (route name, weight, roles). The names are the ones of crm_epic_event/urls.py.
+# The weights give the mix of each role : mostly lists, often filtered.
+ROUTES = [
+    ('customers-list', 4, ROLES),
+    ('customers-detail', 2, ROLES),
+    ('contracts-list', 4, ROLES),
+    ('contracts-detail', 2, ROLES),
+    ('events-list', 4, ROLES),
+    ('events-detail', 2, ROLES),
+    ('customer_contracts-list', 2, ROLES),
+    ('customer_events-list', 2, ROLES),
+    ('_user_customers-list', 1, ['MANAGER']),
+    ('user_contracts-list', 1, ['MANAGER']),
+    ('user_events-list', 1, ['MANAGER']),
+    ('reports-revenue', 1, ['MANAGER']),
+    ('reports-unpaid', 1, ['MANAGER']),
+    ('reports-pipeline', 1, ['MANAGER']),
+]
+
+
+class Client:
+    """
+    One keep-alive connection to the server, and the token of a user.
+    """
+    def __init__(self, url, token=None):
+        url = urlsplit(url)
+        self.connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        self.host = url.netloc
+        self.token = token
+
+    def request(self, method, path, data=None):
+        """
+        Returns the status, the decoded body (None if not JSON) and the
+        duration in ms.
+        """
+        headers = {'Host': self.host}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return None, None, (time.perf_counter() - start) * 1000
+        duration = (time.perf_counter() - start) * 1000
+        try:
+            return response.status, json.loads(content), duration
+        except ValueError:
+            return response.status, None, duration
+
+
+class Command(BaseCommand):
+    help = ('Load test of a running server : logs in as a MANAGER, a SELLER and a '
+            'SUPPORT member, walks the list, detail and nested routes with a mix of '
+            'filters, and prints the throughput, the latencies and the error rate '
+            'of each route and role.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--password', default='jambon12',
+            help='Password of the users (see seed_crm --password).')
+        for role in ROLES:
+            parser.add_argument('--' + role.lower(),
+                help='Username of the %s. Default : the first one of the database.' % role)
+        parser.add_argument('--concurrency', type=int, default=5,
+            help='Concurrent clients per role.')
+        parser.add_argument('--duration', type=float, default=30)
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--output', help='Saves the results in this JSON file.')
+        parser.add_argument('--compare', help='JSON file of a previous run to compare with.')
+
+    def handle(self, *args, **options):
+        random.seed(options['random_seed'])
+        sessions = {role: self.login(role, options) for role in ROLES}
+        for role, session in sessions.items():
+            session['ids'] = self.discover(Client(options['url'], session['token']), role)
+
+        results = {}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['duration']
+        threads = [threading.Thread(target=self.run_client,
+                       args=(options, role, sessions[role], deadline, results, lock))
+                   for role in ROLES for i in range(options['concurrency'])]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        report = self.report(results, elapsed)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+        if options['compare']:
+            with open(options['compare']) as file:
+                self.compare(json.load(file), report)
+
+    def login(self, role, options):
+        username = options[role.lower()]
+        if username is None:
+            user = User.objects.filter(role=role, is_active=True).order_by('id').first()
+            if user is None:
+                raise CommandError('No %s in the database, run seed_crm first' % role)
+            username = user.username
+        status, body, duration = Client(options['url']).request(
+            'POST', '/api/login/', {'username': username, 'password': options['password']})
+        if status != 200:
+            raise CommandError('Login of %s failed (%s): %s' % (username, status, body))
+        return {'username': username, 'token': body['access']}
+
+    def discover(self, client, role):
+        """
+        Reads the first pages of the role, to know which instances it can
+        request on the detail and nested routes, and what to search.
+        """
+        ids = {}
+        for route in ['customers', 'contracts', 'events']:
+            status, body, duration = client.request('GET', '/api/%s/?limit=100' % route)
+            ids[route] = body['results'] if status == 200 else []
+        if role == 'MANAGER':
+            users = {'SELLER': [], 'SUPPORT': []}
+            status, body, duration = client.request('GET', '/api/users/?limit=100')
+            for user in (body['results'] if status == 200 else []):
+                status, detail, duration = client.request('GET', '/api/users/%s/' % user['id'])
+                if status == 200 and detail['role'] in users:
+                    users[detail['role']].append(user['id'])
+            ids['users'] = users
+        return ids
+
+    def build_path(self, route, ids):
+        """
+        Returns the path of a request on the route, with a realistic mix of
+        filters, or None if the role has nothing to request there.
+        """
+        customers, contracts, events = ids['customers'], ids['contracts'], ids['events']
+        if route == 'customers-list':
+            params = random.choice([
+                {}, {'pagination': 'cursor'}, {'limit': 20, 'offset': 20},
+                {'last_name': random.choice(customers)['last_name'][:6]} if customers else {},
+                {'search': random.choice(customers)['last_name']} if customers else {}])
+            return '/api/customers/?' + urlencode(params)
+        if route == 'contracts-list':
+            due_low = random.randint(0, 90000)
+            params = random.choice([
+                {}, {'pagination': 'cursor'}, {'signed': 'false'}, {'signed': 'true'},
+                {'due_low': due_low, 'due_high': due_low + 5000}])
+            return '/api/contracts/?' + urlencode(params)
+        if route == 'events-list':
+            params = random.choice([
+                {}, {'pagination': 'cursor'}, {'finished': 'false'},
+                {'date': time.strftime('%Y-%m')}])
+            return '/api/events/?' + urlencode(params)
+        if route.startswith('reports-'):
+            return '/api/reports/%s/' % route[len('reports-'):]
+
+        for name, instances in [('customers', customers), ('contracts', contracts),
+                                ('events', events)]:
+            if route == name + '-detail':
+                return '/api/%s/%s/' % (name, random.choice(instances)['id']) if instances else None
+        if route in ('customer_contracts-list', 'customer_events-list'):
+            nested = 'contracts' if route == 'customer_contracts-list' else 'events'
+            return '/api/customers/%s/%s/' % (
+                random.choice(customers)['id'], nested) if customers else None
+
+        users = ids.get('users', {})
+        nested = {'_user_customers-list': 'customers', 'user_contracts-list': 'contracts',
+                  'user_events-list': 'events'}[route]
+        user_ids = users.get('SELLER', []) + users.get('SUPPORT', [])
+        return '/api/users/%s/%s/' % (random.choice(user_ids), nested) if user_ids else None
+
+    def run_client(self, options, role, session, deadline, results, lock):
+        routes = [(route, weight) for route, weight, roles in ROUTES if role in roles]
+        client = Client(options['url'], session['token'])
+        while time.monotonic() < deadline:
+            route = random.choices([route for route, weight in routes],
+                                   [weight for route, weight in routes])[0]
+            path = self.build_path(route, session['ids'])
+            if path is None:
+                continue
+            status, body, duration = client.request('GET', path)
+            with lock:
+                result = results.setdefault((role, route), {'durations': [], 'errors': 0})
+                if status == 200:
+                    result['durations'].append(duration)
+                else:
+                    result['errors'] += 1
+
+    def report(self, results, elapsed):
+        report = {}
+        for (role, route), result in sorted(results.items()):
+            requests = len(result['durations']) + result['errors']
+            line = {'requests': requests, 'rps': requests / elapsed,
+                    'error_rate': result['errors'] / requests}
+            if result['durations']:
+                line.update(summarize(result['durations']))
+            report['%s %s' % (role, route)] = line
+            self.stdout.write('%-8s %-24s %6.1f req/s | %5.1f%% errors | %s' % (
+                role, route, line['rps'], line['error_rate'] * 100,
+                format_timings(line) if result['durations'] else 'no successful request'))
+        total = sum(line['requests'] for line in report.values())
+        errors = sum(line['requests'] * line['error_rate'] for line in report.values())
+        self.stdout.write(self.style.SUCCESS('%s requests in %.1f s : %.1f req/s, %.1f%% errors' % (
+            total, elapsed, total / elapsed, errors * 100 / total if total else 0)))
+        return report
+
+    def compare(self, previous, report):
+        self.stdout.write(self.style.MIGRATE_HEADING('Compared with the previous run'))
+        for key, line in report.items():
+            old = previous.get(key)
+            if old is None or 'p95' not in old or 'p95' not in line:
+                continue
+            self.stdout.write('%-33s req/s %+6.1f%% | p95 %+6.1f%%' % (
+                key, (line['rps'] / old['rps'] - 1) * 100, (line['p95'] / old['p95'] - 1) * 100))
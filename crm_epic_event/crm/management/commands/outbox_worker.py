@@ -0,0 +1,64 @@
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from crm import outbox
+
+
+class Command(BaseCommand):
+    help = ('Delivers the webhooks of the outbox (ex: a contract signed) in batches, '
+            'and retries the failed ones with an exponential backoff. Runs until '
+            'stopped (SIGTERM or Ctrl-C), or until the outbox is empty with --once. '
+            'Several workers can run at the same time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--concurrency', type=int, default=10,
+            help='Webhooks posted at the same time.')
+        parser.add_argument('--timeout', type=float, default=10,
+            help='Seconds to wait for a receiver.')
+        parser.add_argument('--max-attempts', type=int, default=10)
+        parser.add_argument('--poll-interval', type=float, default=1,
+            help='Seconds between two reads of an empty outbox.')
+        parser.add_argument('--keep-days', type=int, default=7,
+            help='The messages sent are deleted after this number of days.')
+        parser.add_argument('--once', action='store_true',
+            help='Stops when no message is ready to be sent.')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                signal.signal(signum, lambda signum, frame: stop.set())
+        # A message whose worker died is sent again after the lease : it must be
+        # longer than a batch, whose webhooks are posted concurrency at a time.
+        rounds = -(-options['batch_size'] // options['concurrency'])
+        lease = options['timeout'] * rounds + 30
+        totals = {'sent': 0, 'retried': 0, 'failed': 0}
+
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            last_prune = 0
+            while not stop.is_set():
+                messages = outbox.claim(options['batch_size'], lease)
+                if messages:
+                    counts = outbox.send(messages, executor, options['timeout'],
+                                         options['max_attempts'])
+                    for key in totals:
+                        totals[key] += counts[key]
+                    self.stdout.write('%(sent)s sent, %(retried)s to retry, %(failed)s failed' % counts)
+                    continue
+                if options['once']:
+                    break
+                # Like at the end of a request : the connection is closed if it
+                # is broken or older than CONN_MAX_AGE, and opened again.
+                close_old_connections()
+                if time.monotonic() - last_prune > 3600:
+                    outbox.prune(options['keep_days'])
+                    last_prune = time.monotonic()
+                stop.wait(options['poll_interval'])
+        self.stdout.write(self.style.SUCCESS(
+            'Total : %(sent)s sent, %(retried)s to retry, %(failed)s failed' % totals))
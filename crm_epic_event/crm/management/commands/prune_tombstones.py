@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from crm.models import Tombstone
+
+
+class Command(BaseCommand):
+    help = ('Deletes the tombstones of the changes feeds older than '
+            'SYNC_TOMBSTONE_DAYS. To run periodically (ex: every day).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.SYNC_TOMBSTONE_DAYS)
+
+    def handle(self, *args, **options):
+        deleted = Tombstone.prune(options['days'])
+        self.stdout.write(self.style.SUCCESS('%s tombstones deleted' % deleted))
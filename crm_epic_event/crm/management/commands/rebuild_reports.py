@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from crm.models import REPORT_SUMMARIES
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the summary tables of the /reports/ endpoints. '
+            'Needed after contracts or events were written without their save() method.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for summary in REPORT_SUMMARIES:
+                summary.rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(', '.join(
+            '%s %s' % (summary.objects.count(), summary._meta.verbose_name_plural)
+            for summary in REPORT_SUMMARIES)))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from crm.models import ContractVisibility, CustomerVisibility
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the visibility tables of the SELLER and SUPPORT users. '
+            'Needed after instances were written without their save() method.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            ContractVisibility.rebuild(options['batch_size'])
+            CustomerVisibility.rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            '%s contract and %s customer visibilities' % (
+                ContractVisibility.objects.count(), CustomerVisibility.objects.count())))
@@ -0,0 +1,100 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from crm.models import Customer, Contract, Event
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = ('Fill the database with fake users, customers, contracts and events. '
+            'Only meant for the benchmarks, never run it on the production database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=1000000)
+        parser.add_argument('--customers', type=int, default=None,
+            help='Default : one customer for five events.')
+        parser.add_argument('--unsigned', type=int, default=None,
+            help='Contracts without event. Default : one for ten events.')
+        parser.add_argument('--managers', type=int, default=1)
+        parser.add_argument('--sellers', type=int, default=50)
+        parser.add_argument('--supports', type=int, default=50)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--password', default=None,
+            help='Password of the users created (for load_test). Default : none usable.')
+
+    def handle(self, *args, **options):
+        """
+        The instances are inserted with bulk_create, which skips the save()
+        methods of the models. That is what allows past events here.
+        """
+        self.batch_size = options['batch_size']
+        # Hashed once : hashing it for each user would take most of the seeding.
+        self.password = make_password(options['password']) if options['password'] else '!'
+        nb_events = options['events']
+        nb_customers = options['customers'] or max(nb_events // 5, 1)
+        nb_unsigned = options['unsigned'] if options['unsigned'] is not None else nb_events // 10
+
+        self.create_users('MANAGER', options['managers'])
+        sellers = self.create_users('SELLER', options['sellers'])
+        supports = self.create_users('SUPPORT', options['supports'])
+        customers = self.create_customers(nb_customers, sellers)
+        self.create_contracts(nb_events, nb_unsigned, customers, sellers, supports)
+        # bulk_create skipped the save() methods which maintain the visibilities
+        # and the reports.
+        call_command('rebuild_visibility', batch_size=self.batch_size)
+        call_command('rebuild_reports', batch_size=self.batch_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Created %s customers, %s events and %s contracts'
+            % (nb_customers, nb_events, nb_events + nb_unsigned)))
+
+    def create_users(self, role, number):
+        start = User.objects.count()
+        users = [User(username='seed_%s_%s' % (role.lower(), start + i),
+                      first_name='Seed', last_name=role.capitalize() + str(start + i),
+                      email='seed%s@example.com' % (start + i),
+                      password=self.password, role=role)
+                 for i in range(number)]
+        return User.objects.bulk_create(users)
+
+    def create_customers(self, number, sellers):
+        ids = []
+        for start in range(0, number, self.batch_size):
+            customers = [Customer(first_name='Seed', last_name='Customer%s' % i,
+                                  compagny_name='Compagny %s' % (i % 1000),
+                                  email='customer%s@example.com' % i,
+                                  existing=True, seller=random.choice(sellers))
+                         for i in range(start, min(start + self.batch_size, number))]
+            ids += [customer.id for customer in Customer.objects.bulk_create(customers)]
+        return ids
+
+    def create_contracts(self, nb_events, nb_unsigned, customers, sellers, supports):
+        now = timezone.now()
+        for start in range(0, nb_events, self.batch_size):
+            with transaction.atomic():
+                events = []
+                for i in range(start, min(start + self.batch_size, nb_events)):
+                    date_event = now + timedelta(days=random.randint(-365, 365))
+                    events.append(Event(name='Event %s' % i, location='Paris',
+                                        date_event=date_event, finished=date_event < now))
+                events = Event.objects.bulk_create(events)
+                Contract.objects.bulk_create([
+                    self.contract(customers, sellers, supports, event=event,
+                                  signed=True, date_signed=now)
+                    for event in events])
+        for start in range(0, nb_unsigned, self.batch_size):
+            Contract.objects.bulk_create([
+                self.contract(customers, sellers, supports)
+                for i in range(start, min(start + self.batch_size, nb_unsigned))])
+
+    def contract(self, customers, sellers, supports, **kwargs):
+        return Contract(customer_id=random.choice(customers),
+                        seller=random.choice(sellers), support=random.choice(supports),
+                        due=random.randint(100, 100000), payed=random.random() < 0.5,
+                        **kwargs)
@@ -0,0 +1,184 @@
+"""
+Per-request instrumentation : number of SQL queries, time spent in the
+database, time spent in the view and the serialization (without the SQL),
+size of the response. Each sampled request gets a Server-Timing header, and
+the values are aggregated in histograms, labelled by route name and user role,
+served as Prometheus text on /api/metrics.
+
+The histograms are kept in the memory of each process : with several workers,
+each scrape reads the worker which answers it.
+"""
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERIES_BUCKETS = [1, 2, 3, 5, 10, 20, 50, 100]
+SIZE_BUCKETS = [1000, 10000, 100000, 1000000, 10000000]
+
+# The measures of the request being served. Context variables follow the
+# request in the threads of sync_to_async, like the async reads under ASGI.
+current_measures = ContextVar('current_measures', default=None)
+
+
+class Measures:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.view_start = None
+        self.queries = 0
+        self.db_time = 0
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper of every connection. Outside a sampled request, it only
+    reads the context variable.
+    """
+    measures = current_measures.get()
+    if measures is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        measures.queries += 1
+        measures.db_time += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        counts = self.series.setdefault(labels, [[0] * len(self.buckets), 0, 0])
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                counts[0][index] += 1
+        counts[1] += 1
+        counts[2] += value
+
+    def to_text(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for (route, role), (buckets, count, total) in sorted(self.series.items()):
+            labels = 'route="%s",role="%s"' % (route, role)
+            for bucket, bucket_count in zip(self.buckets, buckets):
+                lines.append('%s_bucket{%s,le="%s"} %s' % (self.name, labels, bucket, bucket_count))
+            lines.append('%s_bucket{%s,le="+Inf"} %s' % (self.name, labels, count))
+            lines.append('%s_count{%s} %s' % (self.name, labels, count))
+            lines.append('%s_sum{%s} %s' % (self.name, labels, total))
+        return '\n'.join(lines)
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.duration = Histogram('crm_request_duration_seconds',
+            'Duration of the requests.', DURATION_BUCKETS)
+        self.db_time = Histogram('crm_request_db_seconds',
+            'Time spent in the SQL queries of a request.', DURATION_BUCKETS)
+        self.serialization = Histogram('crm_request_serialization_seconds',
+            'Time spent in the view and the rendering of a request, without the SQL.',
+            DURATION_BUCKETS)
+        self.queries = Histogram('crm_request_queries',
+            'Number of SQL queries of a request.', QUERIES_BUCKETS)
+        self.size = Histogram('crm_response_size_bytes',
+            'Size of the responses.', SIZE_BUCKETS)
+
+    def observe(self, labels, duration, db_time, serialization, queries, size):
+        with self.lock:
+            self.duration.observe(labels, duration)
+            self.db_time.observe(labels, db_time)
+            self.serialization.observe(labels, serialization)
+            self.queries.observe(labels, queries)
+            if size is not None:
+                self.size.observe(labels, size)
+
+    def to_text(self):
+        with self.lock:
+            histograms = [self.duration, self.db_time, self.serialization,
+                          self.queries, self.size]
+            return '\n'.join(histogram.to_text() for histogram in histograms) + '\n'
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    """
+    Measures a part of the requests, set by METRICS_SAMPLE_RATE (from 0 to 1).
+    The other requests only cost a random number.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 1)
+        # The connections opened before this module was loaded.
+        for connection in connections.all():
+            instrument_connection(None, connection)
+
+    def __call__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        measures = Measures()
+        token = current_measures.set(measures)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_measures.reset(token)
+        end = time.perf_counter()
+
+        view_time = end - measures.view_start if measures.view_start != None else 0
+        serialization = max(view_time - measures.db_time, 0)
+        response['Server-Timing'] = ', '.join([
+            'db;dur=%.2f;desc="%s queries"' % (measures.db_time * 1000, measures.queries),
+            'serialization;dur=%.2f' % (serialization * 1000),
+            'total;dur=%.2f' % ((end - measures.start) * 1000)])
+
+        match = request.resolver_match
+        user = getattr(request, 'user', None)
+        labels = (match.url_name if match != None else 'unresolved',
+                  getattr(user, 'role', None) or 'anonymous')
+        size = len(response.content) if not response.streaming else None
+        registry.observe(labels, end - measures.start, measures.db_time, serialization,
+                         measures.queries, size)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        measures = current_measures.get()
+        if measures is not None:
+            measures.view_start = time.perf_counter()
+
+
+def metrics_view(request):
+    """
+    The histograms in the Prometheus text format, and the state of the database
+    connection pool if there is one. If METRICS_TOKEN is set, the scraper must
+    send it as a bearer token.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        return HttpResponseForbidden()
+    text = registry.to_text()
+    # The connection pools of crm_epic_event/postgresql_pool, if enabled.
+    for alias in connections:
+        pool_metrics = getattr(connections[alias], 'pool_metrics', None)
+        if pool_metrics is not None:
+            text += pool_metrics() + '\n'
+    return HttpResponse(text, content_type='text/plain; version=0.0.4')
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0004_contract_payed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['date_created', 'id'], name='contract_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['date_created', 'id'], name='customer_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['date_created', 'id'], name='event_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_visibilities(apps, schema_editor):
+    Contract = apps.get_model('crm', 'Contract')
+    Customer = apps.get_model('crm', 'Customer')
+    ContractVisibility = apps.get_model('crm', 'ContractVisibility')
+    CustomerVisibility = apps.get_model('crm', 'CustomerVisibility')
+
+    contracts = Contract.objects.values_list('id', 'seller', 'support', 'customer', 'event')
+    ContractVisibility.objects.bulk_create([
+        ContractVisibility(user_id=user_id, contract_id=contract_id,
+                           customer_id=customer_id, event_id=event_id)
+        for contract_id, seller_id, support_id, customer_id, event_id in contracts.iterator()
+        for user_id in {seller_id, support_id} - {None}], batch_size=10000)
+
+    pairs = set(Customer.objects.filter(seller__isnull=False).values_list('seller', 'id'))
+    pairs |= set(Contract.objects.filter(support__isnull=False, customer__isnull=False
+                    ).values_list('support', 'customer'))
+    CustomerVisibility.objects.bulk_create([
+        CustomerVisibility(user_id=user_id, customer_id=customer_id)
+        for user_id, customer_id in pairs], batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0006_customer_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerVisibility',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visibilities', to='crm.customer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='customer_visibilities', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ContractVisibility',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contract', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visibilities', to='crm.contract')),
+                ('customer', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='crm.customer')),
+                ('event', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='visibilities', to='crm.event')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contract_visibilities', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='customervisibility',
+            constraint=models.UniqueConstraint(fields=('user', 'customer'), name='customer_visibility_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='contractvisibility',
+            index=models.Index(fields=['user', 'event'], name='contract_visibility_event_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contractvisibility',
+            index=models.Index(fields=['user', 'customer'], name='contract_visibility_cust_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='contractvisibility',
+            constraint=models.UniqueConstraint(fields=('user', 'contract'), name='contract_visibility_unique'),
+        ),
+        migrations.RunPython(fill_visibilities, migrations.RunPython.noop),
+    ]
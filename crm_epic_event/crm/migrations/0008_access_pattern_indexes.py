@@ -0,0 +1,42 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0007_visibility'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='contractvisibility',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='contract_visibilities', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='customervisibility',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='customer_visibilities', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['due'], name='contract_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(condition=models.Q(('signed', False)), fields=['date_created', 'id'], name='contract_unsigned_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['date_event'], name='event_date_event_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('finished', False)), fields=['date_event'], name='event_unfinished_idx'),
+        ),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, TruncMonth
+
+
+def fill_summaries(apps, schema_editor):
+    Contract = apps.get_model('crm', 'Contract')
+    Event = apps.get_model('crm', 'Event')
+    SellerSummary = apps.get_model('crm', 'SellerSummary')
+    CustomerSummary = apps.get_model('crm', 'CustomerSummary')
+    PipelineSummary = apps.get_model('crm', 'PipelineSummary')
+    EventMonthSummary = apps.get_model('crm', 'EventMonthSummary')
+
+    SellerSummary.objects.bulk_create([SellerSummary(**values) for values in
+        Contract.objects.filter(seller__isnull=False).values('seller').annotate(
+            contracts=Count('id'),
+            signed_contracts=Count('id', filter=Q(signed=True)),
+            signed_due=Coalesce(Sum('due', filter=Q(signed=True)), 0.0),
+            payed_due=Coalesce(Sum('due', filter=Q(payed=True)), 0.0)
+        ).values('seller_id', 'contracts', 'signed_contracts', 'signed_due', 'payed_due')],
+        batch_size=10000)
+    CustomerSummary.objects.bulk_create([CustomerSummary(**values) for values in
+        Contract.objects.filter(customer__isnull=False).values('customer').annotate(
+            contracts=Count('id'),
+            total_due=Coalesce(Sum('due'), 0.0),
+            unpaid_due=Coalesce(Sum('due', filter=Q(signed=True, payed=False)), 0.0)
+        ).values('customer_id', 'contracts', 'total_due', 'unpaid_due')],
+        batch_size=10000)
+    PipelineSummary.objects.bulk_create([PipelineSummary(**values) for values in
+        Contract.objects.values('signed').annotate(
+            contracts=Count('id'), total_due=Coalesce(Sum('due'), 0.0))])
+    EventMonthSummary.objects.bulk_create([EventMonthSummary(**values) for values in
+        Event.objects.annotate(
+            month=TruncMonth('date_event', output_field=models.DateField())
+        ).values('month').annotate(events=Count('id'))])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0008_access_pattern_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventMonthSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('events', models.IntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PipelineSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signed', models.BooleanField(unique=True)),
+                ('contracts', models.IntegerField(default=0)),
+                ('total_due', models.FloatField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='SellerSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contracts', models.IntegerField(default=0)),
+                ('signed_contracts', models.IntegerField(default=0)),
+                ('signed_due', models.FloatField(default=0)),
+                ('payed_due', models.FloatField(default=0)),
+                ('seller', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='CustomerSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contracts', models.IntegerField(default=0)),
+                ('total_due', models.FloatField(default=0)),
+                ('unpaid_due', models.FloatField(default=0)),
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='crm.customer')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='customersummary',
+            index=models.Index(condition=models.Q(('unpaid_due__gt', 0)), fields=['-unpaid_due'], name='customer_summary_unpaid_idx'),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
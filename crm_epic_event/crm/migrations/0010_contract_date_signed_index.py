@@ -0,0 +1,17 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0009_report_summaries'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['date_signed'], name='contract_date_signed_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:20
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0010_contract_date_signed_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=50)),
+                ('url', models.URLField(max_length=500)),
+                ('payload', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('status', models.CharField(choices=[('PENDING', 'PENDING'), ('SENT', 'SENT'), ('FAILED', 'FAILED')], default='PENDING', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_sent', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['available_at', 'id'], name='outbox_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0011_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('finished', False)), fields=['date_created', 'id'], name='event_unfinished_created_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:23
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0012_event_unfinished_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('CREATE', 'CREATE'), ('UPDATE', 'UPDATE'), ('DELETE', 'DELETE')], max_length=10)),
+                ('changes', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('username', models.CharField(blank=True, default='', max_length=150)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='historyentry',
+            index=models.Index(fields=['resource', 'object_id', 'id'], name='history_entry_object_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.0.1 on 2026-10-18 11:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0013_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='contractvisibility',
+            name='date_created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='customervisibility',
+            name='date_created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['date_updated'], name='contract_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contractvisibility',
+            index=models.Index(fields=['user', 'date_created'], name='contract_visibility_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['date_updated'], name='customer_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customervisibility',
+            index=models.Index(fields=['user', 'date_created'], name='customer_visibility_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['date_updated'], name='event_updated_idx'),
+        ),
+        migrations.AddField(
+            model_name='tombstone',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['resource', 'date_created'], name='tombstone_resource_date_idx'),
+        ),
+    ]
@@ -1,12 +1,132 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.db.models.functions import Coalesce, TruncMonth, Upper
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 from phone_field import PhoneField
-from datetime import datetime
+from datetime import datetime, timedelta
 from rest_framework.exceptions import PermissionDenied
 import pytz
 
+from crm import history
+
+
+class VisibleQuerySet(models.QuerySet):
+    """
+    The role rules, in one place. A MANAGER sees everything, a SELLER or a
+    SUPPORT member only the rows of the visibility tables, with one join.
+    """
+    # Lookup of the customer, for the MANAGER (who has no visibility rows).
+    customer_lookup = None
+
+    def visible_to(self, user, customer=None):
+        """
+        The instances the user can see, of the customer (or his id) if given.
+        The filter on the customer of the visibility rows uses their (user,
+        customer) index.
+        """
+        if user.role == 'MANAGER':
+            if customer is None:
+                return self.all()
+            # The pk of the customers can't be compared with an instance.
+            return self.filter(**{self.customer_lookup: getattr(customer, 'pk', customer)})
+        elif user.role == 'SELLER' or user.role == 'SUPPORT':
+            lookups = {'visibilities__user': user}
+            if customer is not None:
+                lookups['visibilities__customer'] = customer
+            return self.filter(**lookups)
+        return self.none()
+
+    def granted_to(self, user, since, until):
+        """
+        The instances the user can see since a date of the window, by the
+        date_created of his visibility rows. Their date_updated can be older.
+        """
+        if user.role == 'SELLER' or user.role == 'SUPPORT':
+            return self.filter(visibilities__user=user, visibilities__date_created__gt=since,
+                               visibilities__date_created__lte=until)
+        return self.none()
+
+
+class CustomerQuerySet(VisibleQuerySet):
+    customer_lookup = 'pk'
+
+
+class ContractQuerySet(VisibleQuerySet):
+    customer_lookup = 'customer'
+
+
+class EventQuerySet(VisibleQuerySet):
+    customer_lookup = 'event__customer'
+
+
+class HistoryMixin:
+    """
+    Field level history of a model (see crm/history.py). The values in the
+    database are read before the first save of an instance, and compared with
+    the ones saved. The loading keeps nothing, so the reads cost nothing.
+    """
+    history_resource = None
+    # Changed by every save.
+    history_excluded_fields = ['date_created', 'date_updated']
+
+    def load_history_state(self):
+        """
+        The values in the database, read once : after a save, the values saved
+        are kept instead.
+        """
+        if getattr(self, 'history_state', None) is None:
+            fields = [field for field in self._meta.concrete_fields
+                      if field.name not in self.history_excluded_fields]
+            values = type(self)._base_manager.filter(pk=self.pk).values(
+                *[field.attname for field in fields]).first()
+            self.history_state = {field.name: values[field.attname] for field in fields
+                                  } if values != None else None
+        return self.history_state
+
+    def get_history_state(self):
+        """
+        The loaded values of the fields, the foreign keys by id.
+        """
+        return {field.name: self.__dict__[field.attname] for field in self._meta.concrete_fields
+                if field.attname in self.__dict__ and field.name not in self.history_excluded_fields}
+
+    def record_history(self, action, update_fields=None):
+        old = getattr(self, 'history_state', None)
+        new = self.get_history_state()
+        if update_fields is not None:
+            new = {name: value for name, value in new.items() if name in update_fields}
+        if action == HistoryEntry.DELETE:
+            changes = {name: [value, None] for name, value in (old or new).items()}
+        elif action == HistoryEntry.CREATE or old is None:
+            changes = {name: [None, value] for name, value in new.items()}
+        else:
+            changes = {name: [old[name], value] for name, value in new.items()
+                       if name in old and old[name] != value}
+        self.history_state = {**(old or {}), **new}
+        if changes or action == HistoryEntry.DELETE:
+            history.record(HistoryEntry(resource=self.history_resource, object_id=self.pk,
+                action=action, changes={name: [history_value(value) for value in values]
+                                        for name, values in changes.items()}))
+
+
+def history_value(value):
+    """
+    The values which can't be written in JSON (ex: a phone number) are kept
+    as text.
+    """
+    if value is None or isinstance(value, (bool, int, float, str, datetime)):
+        return value
+    return str(value)
+
+
+class Customer(HistoryMixin, models.Model):
+    IDENTITY_ERROR = 'compagny_name and last_name can\'t be both empty.'
 
-class Customer(models.Model):
     first_name = models.CharField(max_length=25, null=True, blank=True)
     last_name = models.CharField(max_length=25, null=True, blank=True)
     email = models.EmailField(max_length=100)
@@ -19,6 +139,24 @@ class Customer(models.Model):
     seller = models.ForeignKey(settings.AUTH_USER_MODEL, 
         null=True, on_delete=models.SET_NULL, related_name='customer')
 
+    history_resource = 'customer'
+
+    objects = CustomerQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_created', 'id'], name='customer_created_id_idx'),
+            models.Index(fields=['date_updated'], name='customer_updated_idx'),
+            # The filters and the search are case insensitive, so the trigrams
+            # are indexed on the upper case value.
+            GinIndex(OpClass(Upper('last_name'), name='gin_trgm_ops'),
+                name='customer_last_name_trgm_idx'),
+            GinIndex(OpClass(Upper('compagny_name'), name='gin_trgm_ops'),
+                name='customer_compagny_trgm_idx'),
+            GinIndex(OpClass(Upper('email'), name='gin_trgm_ops'),
+                name='customer_email_trgm_idx')
+        ]
+
     def save(self, *args, **kwargs):
         try:
             self.check_fields()
@@ -26,25 +164,38 @@ class Customer(models.Model):
             raise e
         self.date_updated = datetime.now()
         super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'seller' in update_fields:
+            CustomerVisibility.refresh_customer(self)
     
     def check_fields(self):
         """
         A customer is identifiable with a name, a compagny, or both.
         Thats why at least of of those fiels is required.
         """
-        if not self.compagny_name and not self.last_name:
-            raise PermissionDenied(
-                'compagny_name and last_name can\'t be both empty.')
+        if not self.is_identifiable(self.last_name, self.compagny_name):
+            raise PermissionDenied(self.IDENTITY_ERROR)
+
+    @staticmethod
+    def is_identifiable(last_name, compagny_name):
+        return bool(compagny_name or last_name)
+
+    @staticmethod
+    def display_name(first_name, last_name, compagny_name):
+        """
+        Also used by the fast path of the contracts list, from .values().
+        """
+        if last_name and compagny_name:
+            return str(first_name) + " " + str(last_name) + "; " + str(compagny_name)
+        elif last_name:
+            return str(first_name) + " " + str(last_name)
+        return compagny_name
 
     def __str__(self):
-        if self.last_name and self.compagny_name:
-            return str(self.first_name) + " " + str(self.last_name) + "; " + str(self.compagny_name)
-        elif self.last_name:
-            return str(self.first_name) + " " + str(self.last_name)
-        return self.compagny_name
+        return self.display_name(self.first_name, self.last_name, self.compagny_name)
             
 
-class Event(models.Model):
+class Event(HistoryMixin, models.Model):
     name = models.CharField(max_length=25)
     location = models.CharField(max_length=255)
     finished = models.BooleanField(default=False)
@@ -52,10 +203,49 @@ class Event(models.Model):
     date_updated = models.DateTimeField(auto_now_add=True)
     date_event = models.DateTimeField()
 
+    history_resource = 'event'
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_created', 'id'], name='event_created_id_idx'),
+            models.Index(fields=['date_updated'], name='event_updated_idx'),
+            models.Index(fields=['date_event'], name='event_date_event_idx'),
+            models.Index(fields=['date_event'], condition=models.Q(finished=False),
+                name='event_unfinished_idx'),
+            # The order of the lists, for ?finished=false.
+            models.Index(fields=['date_created', 'id'], condition=models.Q(finished=False),
+                name='event_unfinished_created_idx')
+        ]
+
     def save(self, *args, **kwargs):
         self.date_updated = datetime.now()
         self.date_event_not_passed()
+        old_state = None if self._state.adding else self.get_saved_report_state()
         super().save(*args, **kwargs)
+        self.report_state = self.get_report_state()
+        if self.report_state is None or kwargs.get('update_fields') is not None:
+            self.report_state = self.get_saved_report_state(refresh=True)
+        EventMonthSummary.add_states([(old_state, -1), (self.report_state, 1)])
+
+    def get_report_state(self):
+        """
+        The fields counted in the report tables, None if they were not loaded.
+        """
+        if 'date_event' not in self.__dict__:
+            return None
+        return {'date_event': self.date_event}
+
+    def get_saved_report_state(self, refresh=False):
+        """
+        The state counted in the report tables : the one of the last save of
+        the instance, or read from the database.
+        """
+        state = None if refresh else getattr(self, 'report_state', None)
+        if state is None:
+            state = Event.objects.filter(id=self.id).values('date_event').first()
+        return state
     
     def date_event_not_passed(self):
         """
@@ -65,12 +255,31 @@ class Event(models.Model):
         if self.date_event < utc.localize(datetime.now()):
             raise PermissionDenied(
                 'Event date can\'t be before event creation')
-    
+
+    @classmethod
+    def finish_past_events(cls, batch_size=10000):
+        """
+        Marks the events whose date is passed as finished, with one UPDATE per
+        batch instead of a save() per event (whose date_event_not_passed would
+        refuse them anyway). The events are found with event_unfinished_idx,
+        and the reports don't count the finished field. Returns the number of
+        events finished.
+        """
+        now = timezone.now()
+        finished = 0
+        while True:
+            batch = cls.objects.filter(finished=False, date_event__lt=now
+                        ).order_by().values('id')[:batch_size]
+            updated = cls.objects.filter(id__in=batch).update(finished=True, date_updated=now)
+            finished += updated
+            if updated < batch_size:
+                return finished
+
     def __str__(self):
         return self.name
     
 
-class Contract(models.Model):
+class Contract(HistoryMixin, models.Model):
     """
     ATTENTION : si je modifie une signature, les 2 events restent
     Lors de la création d'un event, l'event n'est pas lié au contrat
@@ -90,18 +299,68 @@ class Contract(models.Model):
     due = models.FloatField(max_length=10)
     payed = models.BooleanField(default=False)
 
+    REPORT_FIELDS = ['seller_id', 'customer_id', 'signed', 'due', 'payed']
+
+    history_resource = 'contract'
+
+    objects = ContractQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_created', 'id'], name='contract_created_id_idx'),
+            models.Index(fields=['date_updated'], name='contract_updated_idx'),
+            models.Index(fields=['due'], name='contract_due_idx'),
+            models.Index(fields=['date_created', 'id'], condition=models.Q(signed=False),
+                name='contract_unsigned_idx'),
+            models.Index(fields=['date_signed'], name='contract_date_signed_idx')
+        ]
+
     def save(self, *args, **kwargs):
         """
         A contract with a non existing customer update his status existing to True.
         """
         self.date_updated = datetime.now()
         self.update_customer_status()
+        adding = self._state.adding
+        old_state = None if adding else self.get_saved_report_state()
         super().save(*args, **kwargs)
+        if adding:
+            ContractVisibility.add_contracts([self])
+        else:
+            ContractVisibility.refresh_contract(self)
+        self.report_state = self.get_report_state()
+        if self.report_state is None or kwargs.get('update_fields') is not None:
+            # Partial save : only the database knows what is counted now.
+            self.report_state = self.get_saved_report_state(refresh=True)
+        for summary in CONTRACT_SUMMARIES:
+            summary.add_states([(old_state, -1), (self.report_state, 1)])
+
+    def get_report_state(self):
+        """
+        The fields counted in the report tables, None if they were not loaded.
+        """
+        if any(field not in self.__dict__ for field in self.REPORT_FIELDS):
+            return None
+        return {field: self.__dict__[field] for field in self.REPORT_FIELDS}
+
+    def get_saved_report_state(self, refresh=False):
+        """
+        The state counted in the report tables : the one of the last save of
+        the instance, or read from the database. The loading doesn't keep it,
+        so the reads cost nothing.
+        """
+        state = None if refresh else getattr(self, 'report_state', None)
+        if state is None:
+            state = Contract.objects.filter(id=self.id).values(*self.REPORT_FIELDS).first()
+        return state
     
     def update_customer_status(self):
-        self.date_updated = datetime.now()
-        self.customer.existing = True
-        self.customer.save()
+        """
+        The customer is only written when his status actually changes.
+        """
+        if self.customer is not None and not self.customer.existing:
+            self.customer.existing = True
+            self.customer.save(update_fields=['existing', 'date_updated'])
 
     def sign(self, name_event, location_event, date_event):
         """
@@ -117,7 +376,545 @@ class Contract(models.Model):
         event.name=name_event
         event.location=location_event
         event.date_event=datetime.strptime(date_event, '%d/%m/%y %H:%M')
-        event.save()
+        with transaction.atomic():
+            event.save()
+
+            self.event = event
+            self.save()
+            OutboxMessage.add_contract_signed(self)
+
+
+class CustomerVisibility(models.Model):
+    """
+    The customers a SELLER or a SUPPORT member can see : the customers he is in
+    charge of, and the customers of the contracts he supports.
+    Maintained by Customer.save, Contract.save and the deletion of a contract,
+    so the lists only have to join this table.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE, related_name='customer_visibilities',
+        db_index=False)
+    customer = models.ForeignKey(Customer,
+        on_delete=models.CASCADE, related_name='visibilities')
+    # Since when the user can see the customer, read by the changes feed
+    # and the validator of the lists.
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'customer'],
+                name='customer_visibility_unique')
+        ]
+        indexes = [
+            models.Index(fields=['user', 'date_created'], name='customer_visibility_date_idx')
+        ]
+
+    @classmethod
+    def refresh_customer(cls, customer):
+        """
+        Makes the rows of the customer match his seller and the supports of
+        his contracts.
+        """
+        expected = set(Contract.objects.filter(customer=customer, support__isnull=False
+                        ).values_list('support', flat=True).distinct())
+        if customer.seller_id:
+            expected.add(customer.seller_id)
+        existing = set(cls.objects.filter(customer=customer).values_list('user', flat=True))
+
+        if existing - expected:
+            cls.objects.filter(customer=customer, user__in=existing - expected).delete()
+            Tombstone.add([('customer', customer.id, user_id) for user_id in existing - expected])
+        if expected - existing:
+            cls.objects.bulk_create([cls(user_id=user_id, customer=customer)
+                for user_id in expected - existing], ignore_conflicts=True)
+
+    @classmethod
+    def rebuild(cls, batch_size=10000):
+        """
+        Rebuilds the whole table, after instances were written without their
+        save() method (bulk_create, update, raw SQL...).
+        """
+        cls.objects.all().delete()
+        pairs = [Customer.objects.filter(seller__isnull=False).values_list('seller', 'id'),
+                 Contract.objects.filter(support__isnull=False, customer__isnull=False
+                    ).values_list('support', 'customer').distinct()]
+        for queryset in pairs:
+            rows = []
+            for user_id, customer_id in queryset.iterator(chunk_size=batch_size):
+                rows.append(cls(user_id=user_id, customer_id=customer_id))
+                if len(rows) == batch_size:
+                    cls.objects.bulk_create(rows, ignore_conflicts=True)
+                    rows = []
+            cls.objects.bulk_create(rows, ignore_conflicts=True)
+
+    @classmethod
+    def add_customers(cls, customers):
+        """
+        Adds the rows of customers created without their save() method.
+        """
+        cls.objects.bulk_create([cls(user_id=customer.seller_id, customer=customer)
+            for customer in customers if customer.seller_id], ignore_conflicts=True)
+
+    @classmethod
+    def refresh_pair(cls, user_id, customer_id):
+        """
+        Checks if the user can still see the customer, after one of the
+        contracts linking them changed.
+        """
+        visible = (Customer.objects.filter(id=customer_id, seller_id=user_id).exists()
+            or Contract.objects.filter(customer_id=customer_id, support_id=user_id).exists())
+        if visible:
+            cls.objects.get_or_create(user_id=user_id, customer_id=customer_id)
+        elif cls.objects.filter(user_id=user_id, customer_id=customer_id).delete()[0]:
+            Tombstone.add([('customer', customer_id, user_id)])
+
+
+class ContractVisibility(models.Model):
+    """
+    The contracts, and their events, a SELLER or a SUPPORT member can see : the
+    ones he is the seller or the support of.
+    Maintained by Contract.save (so also by Contract.sign and the creation of
+    an event through /contracts/<pk>/sign/).
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE, related_name='contract_visibilities',
+        db_index=False)
+    contract = models.ForeignKey(Contract,
+        on_delete=models.CASCADE, related_name='visibilities')
+    customer = models.ForeignKey(Customer, null=True,
+        on_delete=models.SET_NULL, related_name='+')
+    event = models.ForeignKey(Event, null=True,
+        on_delete=models.SET_NULL, related_name='visibilities')
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'contract'],
+                name='contract_visibility_unique')
+        ]
+        indexes = [
+            models.Index(fields=['user', 'event'], name='contract_visibility_event_idx'),
+            models.Index(fields=['user', 'customer'], name='contract_visibility_cust_idx'),
+            models.Index(fields=['user', 'date_created'], name='contract_visibility_date_idx')
+        ]
+
+    @classmethod
+    def rebuild(cls, batch_size=10000):
+        """
+        Rebuilds the whole table, after instances were written without their
+        save() method (bulk_create, update, raw SQL...).
+        """
+        cls.objects.all().delete()
+        contracts = Contract.objects.values_list(
+            'id', 'seller', 'support', 'customer', 'event').iterator(chunk_size=batch_size)
+        rows = []
+        for contract_id, seller_id, support_id, customer_id, event_id in contracts:
+            for user_id in {seller_id, support_id} - {None}:
+                rows.append(cls(user_id=user_id, contract_id=contract_id,
+                                customer_id=customer_id, event_id=event_id))
+            if len(rows) >= batch_size:
+                cls.objects.bulk_create(rows)
+                rows = []
+        cls.objects.bulk_create(rows)
+
+    @classmethod
+    def add_contracts(cls, contracts):
+        """
+        Adds the rows of contracts created without their save() method.
+        """
+        cls.objects.bulk_create([
+            cls(user_id=user_id, contract=contract,
+                customer_id=contract.customer_id, event_id=contract.event_id)
+            for contract in contracts
+            for user_id in {contract.seller_id, contract.support_id} - {None}])
+        CustomerVisibility.objects.bulk_create([
+            CustomerVisibility(user_id=contract.support_id, customer_id=contract.customer_id)
+            for contract in contracts if contract.support_id and contract.customer_id],
+            ignore_conflicts=True)
+
+    @classmethod
+    def refresh_contract(cls, contract):
+        """
+        Makes the rows of the contract match its seller, support, customer
+        and event. Nothing is written when none of them changed.
+        """
+        expected = {user_id for user_id in (contract.seller_id, contract.support_id) if user_id}
+        rows = list(cls.objects.filter(contract=contract).values_list(
+                        'user', 'customer', 'event'))
+        existing = {user_id for user_id, customer_id, event_id in rows}
+        up_to_date = all(customer_id == contract.customer_id and event_id == contract.event_id
+                         for user_id, customer_id, event_id in rows)
+        if existing == expected and up_to_date:
+            return
+
+        if existing - expected:
+            cls.objects.filter(contract=contract, user__in=existing - expected).delete()
+            Tombstone.add([(resource, object_id, user_id)
+                for user_id, customer_id, event_id in rows if user_id in existing - expected
+                for resource, object_id in [('contract', contract.id), ('event', event_id)]
+                if object_id])
+        if not up_to_date:
+            # A new customer or event for the users : dated like a new row.
+            cls.objects.filter(contract=contract).update(customer_id=contract.customer_id,
+                event_id=contract.event_id, date_created=timezone.now())
+        cls.objects.bulk_create([
+            cls(user_id=user_id, contract=contract,
+                customer_id=contract.customer_id, event_id=contract.event_id)
+            for user_id in expected - existing], ignore_conflicts=True)
+
+        old_pairs = {(user_id, customer_id) for user_id, customer_id, event_id in rows
+                     if customer_id}
+        if contract.support_id and contract.customer_id:
+            CustomerVisibility.objects.get_or_create(
+                user_id=contract.support_id, customer_id=contract.customer_id)
+        new_pairs = {(user_id, contract.customer_id) for user_id in expected}
+        for user_id, customer_id in old_pairs - new_pairs:
+            CustomerVisibility.refresh_pair(user_id, customer_id)
+
+
+class Summary(models.Model):
+    """
+    Commun methods of the report tables. Their rows are never recomputed during
+    a request : the changes of the instances are added to their counters, so a
+    report never reads the contracts or the events.
+    After instances were written without their save() method, rebuild them with
+    the rebuild_reports command.
+    """
+    class Meta:
+        abstract = True
+
+    @staticmethod
+    def row(state):
+        """
+        Returns the key of the row counting an instance in that state, and
+        what the instance adds to that row. None if it isn't counted.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def add_states(cls, states):
+        """
+        Adds (sign 1) or removes (sign -1) instances from the table.
+        states is a list of (state, sign). The changes are grouped by row, and
+        nothing is written for a row whose counters don't change.
+        """
+        changes = {}
+        for state, sign in states:
+            row = cls.row(state) if state is not None else None
+            if row is None:
+                continue
+            key, values = row
+            row_changes = changes.setdefault(tuple(key.items()), {})
+            for field, value in values.items():
+                row_changes[field] = row_changes.get(field, 0) + sign * value
+
+        for key, row_changes in changes.items():
+            updates = {field: F(field) + value for field, value in row_changes.items() if value}
+            if not updates:
+                continue
+            if not cls.objects.filter(**dict(key)).update(**updates):
+                cls.objects.bulk_create([cls(**dict(key))], ignore_conflicts=True)
+                cls.objects.filter(**dict(key)).update(**updates)
+
+    @classmethod
+    def rebuild(cls, batch_size=10000):
+        cls.objects.all().delete()
+        cls.objects.bulk_create([cls(**values) for values in cls.aggregate()],
+                                batch_size=batch_size)
+
+
+class SellerSummary(Summary):
+    """
+    Contracts and revenue (due of the signed contracts) of each SELLER.
+    """
+    seller = models.OneToOneField(settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE, related_name='summary')
+    contracts = models.IntegerField(default=0)
+    signed_contracts = models.IntegerField(default=0)
+    signed_due = models.FloatField(default=0)
+    payed_due = models.FloatField(default=0)
+
+    @staticmethod
+    def row(state):
+        if state['seller_id'] is None:
+            return None
+        return {'seller_id': state['seller_id']}, {
+            'contracts': 1,
+            'signed_contracts': 1 if state['signed'] else 0,
+            'signed_due': state['due'] if state['signed'] else 0,
+            'payed_due': state['due'] if state['payed'] else 0
+        }
+
+    @staticmethod
+    def aggregate():
+        return Contract.objects.filter(seller__isnull=False).values('seller').annotate(
+            contracts=Count('id'),
+            signed_contracts=Count('id', filter=Q(signed=True)),
+            signed_due=Coalesce(Sum('due', filter=Q(signed=True)), 0.0),
+            payed_due=Coalesce(Sum('due', filter=Q(payed=True)), 0.0)
+        ).values('seller_id', 'contracts', 'signed_contracts', 'signed_due', 'payed_due')
+
+
+class CustomerSummary(Summary):
+    """
+    Contracts of each customer, and what he still owes (due of the signed and
+    not payed contracts).
+    """
+    customer = models.OneToOneField(Customer,
+        on_delete=models.CASCADE, related_name='summary')
+    contracts = models.IntegerField(default=0)
+    total_due = models.FloatField(default=0)
+    unpaid_due = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-unpaid_due'], condition=models.Q(unpaid_due__gt=0),
+                name='customer_summary_unpaid_idx')
+        ]
+
+    @staticmethod
+    def row(state):
+        if state['customer_id'] is None:
+            return None
+        return {'customer_id': state['customer_id']}, {
+            'contracts': 1,
+            'total_due': state['due'],
+            'unpaid_due': state['due'] if state['signed'] and not state['payed'] else 0
+        }
+
+    @staticmethod
+    def aggregate():
+        return Contract.objects.filter(customer__isnull=False).values('customer').annotate(
+            contracts=Count('id'),
+            total_due=Coalesce(Sum('due'), 0.0),
+            unpaid_due=Coalesce(Sum('due', filter=Q(signed=True, payed=False)), 0.0)
+        ).values('customer_id', 'contracts', 'total_due', 'unpaid_due')
+
+
+class PipelineSummary(Summary):
+    """
+    Number and due of the signed and of the unsigned contracts : two rows.
+    """
+    signed = models.BooleanField(unique=True)
+    contracts = models.IntegerField(default=0)
+    total_due = models.FloatField(default=0)
+
+    @staticmethod
+    def row(state):
+        return {'signed': state['signed']}, {'contracts': 1, 'total_due': state['due']}
+
+    @staticmethod
+    def aggregate():
+        return Contract.objects.values('signed').annotate(
+            contracts=Count('id'), total_due=Coalesce(Sum('due'), 0.0))
+
+
+class EventMonthSummary(Summary):
+    """
+    Number of events per month of the event.
+    """
+    month = models.DateField(unique=True)
+    events = models.IntegerField(default=0)
+
+    @staticmethod
+    def row(state):
+        date_event = state['date_event']
+        if timezone.is_aware(date_event):
+            date_event = timezone.localtime(date_event)
+        return {'month': date_event.date().replace(day=1)}, {'events': 1}
+
+    @staticmethod
+    def aggregate():
+        return Event.objects.annotate(
+            month=TruncMonth('date_event', output_field=models.DateField())
+        ).values('month').annotate(events=Count('id'))
+
+
+class OutboxMessage(models.Model):
+    """
+    A webhook to call, one row per url of OUTBOX_WEBHOOKS. It is written in
+    the same transaction than the change it announces (ex: a contract signed),
+    so it is sent only if the change is committed, and the request doesn't
+    wait for the receivers. The outbox_worker command delivers the messages
+    and retries them (see crm/outbox.py).
+    """
+    PENDING = 'PENDING'
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+
+    STATUS_CHOICES = (
+        (PENDING, 'PENDING'),
+        (SENT, 'SENT'),
+        (FAILED, 'FAILED')
+    )
+
+    topic = models.CharField(max_length=50)
+    url = models.URLField(max_length=500)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # The message isn't sent before : retry delay, or lease of the worker sending it.
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at', 'id'], condition=models.Q(status='PENDING'),
+                name='outbox_pending_idx')
+        ]
+
+    @classmethod
+    def add(cls, topic, payload):
+        cls.objects.bulk_create([cls(topic=topic, url=url, payload=payload)
+            for url in settings.OUTBOX_WEBHOOKS])
+
+    @classmethod
+    def add_contract_signed(cls, contract):
+        """
+        For the support member in charge of the event, and the billing. Only
+        the ids of the users and of the customer are sent, so nothing more is
+        read during the signature.
+        """
+        event = contract.event
+        cls.add('contract.signed', {
+            'contract': contract.id,
+            'customer': contract.customer_id,
+            'seller': contract.seller_id,
+            'support': contract.support_id,
+            'due': contract.due,
+            'payed': contract.payed,
+            'date_signed': contract.date_signed,
+            'event': {
+                'id': event.id,
+                'name': event.name,
+                'location': event.location,
+                'date_event': event.date_event
+            }
+        })
+
+
+class HistoryEntry(models.Model):
+    """
+    A change of a customer, a contract or an event : the fields changed, with
+    their old and new values, and the user who made it. Only ever inserted,
+    by crm/history.py. The user isn't a constraint, so the history of a
+    deleted user is kept, with his username.
+    """
+    CREATE = 'CREATE'
+    UPDATE = 'UPDATE'
+    DELETE = 'DELETE'
+
+    ACTION_CHOICES = (
+        (CREATE, 'CREATE'),
+        (UPDATE, 'UPDATE'),
+        (DELETE, 'DELETE')
+    )
+
+    resource = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    # {field: [old value, new value]}
+    changes = models.JSONField(encoder=DjangoJSONEncoder)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name='+')
+    username = models.CharField(max_length=150, blank=True, default='')
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'object_id', 'id'], name='history_entry_object_idx')
+        ]
+
+
+class Tombstone(models.Model):
+    """
+    A customer, a contract or an event deleted (no user), or that a user can't
+    see anymore. Read by the changes feeds, so the apps remove it too.
+    Deleted after SYNC_TOMBSTONE_DAYS by the prune_tombstones command.
+    """
+    resource = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name='+')
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'date_created'], name='tombstone_resource_date_idx')
+        ]
+
+    @classmethod
+    def add(cls, tombstones):
+        """
+        tombstones : (resource, object id, user id or None) tuples.
+        """
+        cls.objects.bulk_create([cls(resource=resource, object_id=object_id, user_id=user_id)
+            for resource, object_id, user_id in tombstones])
+
+    @classmethod
+    def prune(cls, days):
+        """
+        Deletes the tombstones older than days. The changes feeds refuse the
+        syncs older than that.
+        """
+        return cls.objects.filter(date_created__lt=timezone.now() - timedelta(days=days)).delete()[0]
+
+
+CONTRACT_SUMMARIES = [SellerSummary, CustomerSummary, PipelineSummary]
+REPORT_SUMMARIES = CONTRACT_SUMMARIES + [EventMonthSummary]
+
+
+@receiver(pre_delete, sender=Contract)
+@receiver(pre_delete, sender=Event)
+def instance_deleting(sender, instance, **kwargs):
+    # What the report tables count, while the row exists.
+    instance.report_state = instance.get_saved_report_state()
+
+
+@receiver(post_delete, sender=Contract)
+def contract_deleted(sender, instance, **kwargs):
+    """
+    The contract rows are deleted in cascade, but its support may not be
+    related to its customer anymore.
+    """
+    if instance.support_id and instance.customer_id:
+        CustomerVisibility.refresh_pair(instance.support_id, instance.customer_id)
+    for summary in CONTRACT_SUMMARIES:
+        summary.add_states([(instance.report_state, -1)])
+
+
+@receiver(post_delete, sender=Event)
+def event_deleted(sender, instance, **kwargs):
+    EventMonthSummary.add_states([(instance.report_state, -1)])
+
+
+@receiver(pre_save, sender=Customer)
+@receiver(pre_save, sender=Contract)
+@receiver(pre_save, sender=Event)
+def instance_saving(sender, instance, **kwargs):
+    if history.is_enabled() and not instance._state.adding:
+        instance.load_history_state()
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Contract)
+@receiver(post_save, sender=Event)
+def instance_saved(sender, instance, created, update_fields=None, **kwargs):
+    if history.is_enabled():
+        instance.record_history(HistoryEntry.CREATE if created else HistoryEntry.UPDATE,
+                                update_fields)
+
 
-        self.event = event
-        self.save()   
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Contract)
+@receiver(post_delete, sender=Event)
+def instance_deleted(sender, instance, **kwargs):
+    tombstones = [(instance.history_resource, instance.pk, None)]
+    if sender is Contract and instance.event_id:
+        # Its event is seen through it : the users of the contract lose it.
+        tombstones.append(('event', instance.event_id, None))
+    Tombstone.add(tombstones)
+    if history.is_enabled():
+        instance.record_history(HistoryEntry.DELETE)
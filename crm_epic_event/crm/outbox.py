@@ -0,0 +1,137 @@
+"""
+Delivery of the webhooks of the outbox (crm.models.OutboxMessage), by the
+outbox_worker command. The requests only write the messages, in their
+transaction : how slow the receivers are doesn't change their latency.
+
+A batch of messages is claimed in a short transaction : their available_at is
+pushed back by a lease, so another worker doesn't send them at the same time,
+and a worker which dies doesn't lose them. They are then posted in parallel,
+outside of any transaction. A message which fails is retried later with an
+exponential backoff, and is FAILED after max_attempts, or at once if the
+receiver refuses it (4xx other than 408 and 429).
+The delivery is at least once : the receivers can recognize a message sent
+twice by its X-Outbox-Id header.
+"""
+import hashlib
+import hmac
+import json
+import random
+import urllib.error
+import urllib.request
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from crm.models import OutboxMessage
+
+
+# The status codes of the errors which are worth retrying.
+RETRY_STATUSES = {408, 429}
+
+
+class DeliveryError(Exception):
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+def backoff(attempts, base=2, cap=3600):
+    """
+    Delay before the next attempt, in seconds : base, 2 * base, 4 * base...
+    up to cap, with a jitter so the messages of a receiver which was down
+    don't all come back at the same time.
+    """
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def claim(batch_size, lease):
+    """
+    The next messages to send, their attempts counted. The rows locked by
+    another worker are skipped.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(OutboxMessage.objects.filter(
+            status=OutboxMessage.PENDING, available_at__lte=now
+        ).order_by('available_at', 'id').select_for_update(skip_locked=True
+        ).values_list('id', flat=True)[:batch_size])
+        OutboxMessage.objects.filter(id__in=ids).update(
+            available_at=now + timedelta(seconds=lease), attempts=F('attempts') + 1)
+    return list(OutboxMessage.objects.filter(id__in=ids).order_by('id'))
+
+
+def deliver(message, timeout):
+    """
+    Posts the payload of the message to its url. Raises a DeliveryError if the
+    receiver doesn't answer with a 2xx.
+    """
+    body = json.dumps(message.payload, cls=DjangoJSONEncoder).encode()
+    headers = {
+        'Content-Type': 'application/json',
+        'User-Agent': 'crm-epic-events-outbox',
+        'X-Outbox-Id': str(message.id),
+        'X-Outbox-Topic': message.topic,
+        'X-Outbox-Attempt': str(message.attempts)
+    }
+    secret = getattr(settings, 'OUTBOX_WEBHOOK_SECRET', None)
+    if secret:
+        headers['X-Outbox-Signature'] = 'sha256=' + hmac.new(
+            secret.encode(), body, hashlib.sha256).hexdigest()
+    request = urllib.request.Request(message.url, data=body, headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+    except urllib.error.HTTPError as error:
+        retry = error.code >= 500 or error.code in RETRY_STATUSES
+        raise DeliveryError('HTTP %s' % error.code, retry=retry)
+    except (OSError, ValueError) as error:
+        # Connection refused, timeout, invalid url...
+        raise DeliveryError('%s: %s' % (type(error).__name__, error))
+
+
+def send(messages, executor, timeout, max_attempts):
+    """
+    Delivers the messages in parallel and records the results. Returns the
+    number of messages sent, retried and failed.
+    """
+    errors = {}
+
+    def attempt(message):
+        try:
+            deliver(message, timeout)
+        except DeliveryError as error:
+            errors[message.id] = error
+
+    list(executor.map(attempt, messages))
+
+    now = timezone.now()
+    sent = [message.id for message in messages if message.id not in errors]
+    OutboxMessage.objects.filter(id__in=sent).update(
+        status=OutboxMessage.SENT, date_sent=now, last_error='')
+    counts = {'sent': len(sent), 'retried': 0, 'failed': 0}
+    for message in messages:
+        error = errors.get(message.id)
+        if error is None:
+            continue
+        if error.retry and message.attempts < max_attempts:
+            counts['retried'] += 1
+            OutboxMessage.objects.filter(id=message.id).update(last_error=str(error),
+                available_at=now + timedelta(seconds=backoff(message.attempts)))
+        else:
+            counts['failed'] += 1
+            OutboxMessage.objects.filter(id=message.id).update(last_error=str(error),
+                status=OutboxMessage.FAILED)
+    return counts
+
+
+def prune(days):
+    """
+    Deletes the messages sent more than days ago.
+    """
+    return OutboxMessage.objects.filter(status=OutboxMessage.SENT,
+        date_sent__lt=timezone.now() - timedelta(days=days)).delete()[0]
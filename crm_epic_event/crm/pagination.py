@@ -0,0 +1,52 @@
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class DateCreatedCursorPagination(CursorPagination):
+    """
+    Keyset pagination on (date_created, id), the most recent instances first.
+    Every page is read from the index from where the previous one stopped, and
+    no count is made.
+    """
+    ordering = ('-date_created', '-id')
+
+
+class CursorOrOffsetPagination(LimitOffsetPagination):
+    """
+    By default the lists are paginated with limit and offset, like the rest of
+    the API.
+    Adding ?pagination=cursor to the url switches to the keyset pagination,
+    which is as fast for the last page than for the first one. The next and
+    previous links returned keep that mode.
+    """
+    cursor_pagination_class = DateCreatedCursorPagination
+    mode_query_param = 'pagination'
+    # Set by the view when it already counted the instances of the list.
+    known_count = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if self.use_cursor(request):
+            self.cursor_paginator = self.cursor_pagination_class()
+            page = self.cursor_paginator.paginate_queryset(queryset, request, view)
+            self.display_page_controls = self.cursor_paginator.display_page_controls
+            return page
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count(self, queryset):
+        if self.known_count != None:
+            return self.known_count
+        return super().get_count(queryset)
+
+    def use_cursor(self, request):
+        return (request.query_params.get(self.mode_query_param) == 'cursor'
+                or self.cursor_pagination_class.cursor_query_param in request.query_params)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
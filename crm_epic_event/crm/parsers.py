@@ -0,0 +1,25 @@
+import codecs
+import csv
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class CSVParser(BaseParser):
+    """
+    Parses a CSV file with a header line into a list of dictionaries, like a
+    JSON array. The empty cells are left out of the rows.
+    """
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        try:
+            decoded_stream = codecs.getreader(encoding)(stream)
+            return [{key: value for key, value in row.items() if value != ''}
+                    for row in csv.DictReader(decoded_stream)]
+        except (csv.Error, UnicodeDecodeError) as exc:
+            raise ParseError('CSV parse error - %s' % str(exc))
@@ -6,7 +6,7 @@ class CustomerPermissions(BasePermission):
         """
         Every connected user can read CustomerViewset.
         A MANAGER can do everything.
-        A SELLER can create or update an instance.
+        A SELLER can create (one by one or with an import) or update an instance.
         """
         connected_user = request.user
         if request.method == 'GET':
@@ -14,7 +14,8 @@ class CustomerPermissions(BasePermission):
         if connected_user.role == 'MANAGER':
             return True
         if connected_user.role == 'SELLER':
-            if view.action == 'create' or view.action == 'update' or view.action == 'partial_update':
+            if (view.action == 'create' or view.action == 'update'
+                    or view.action == 'partial_update' or view.action == 'bulk_import'):
                 return True
         return False
 
@@ -24,7 +25,7 @@ class ContractPermissions(BasePermission):
         """
         Every connected user can read ContractViewset.
         A MANAGER can do everything.
-        A SELLER can create or update an instance
+        A SELLER can create (one by one or with an import) or update an instance
         """
         connected_user = request.user
         if request.method == 'GET':
@@ -32,7 +33,8 @@ class ContractPermissions(BasePermission):
         if connected_user.role == 'MANAGER':
             return True
         if connected_user.role == 'SELLER':
-            if view.action == 'create' or view.action == 'update' or view.action == 'partial_update':
+            if (view.action == 'create' or view.action == 'update'
+                    or view.action == 'partial_update' or view.action == 'bulk_import'):
                 return True
         return False
 
@@ -57,4 +59,12 @@ class EventPermission(BasePermission):
         if connected_user.role == 'SUPPORT':
             if view.action == 'update' or view.action == 'partial_update':
                 return True
-        return False
\ No newline at end of file
+        return False
+
+
+class ReportPermissions(BasePermission):
+    def has_permission(self, request, view):
+        """
+        Only a MANAGER can read the reports.
+        """
+        return request.user.role == 'MANAGER'
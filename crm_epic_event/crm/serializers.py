@@ -1,9 +1,89 @@
-from rest_framework.serializers import ModelSerializer, SerializerMethodField
+from operator import itemgetter
 
-from crm.models import Customer, Contract, Event
+from rest_framework import ISO_8601
+from rest_framework.serializers import DateTimeField, ModelSerializer, SerializerMethodField
+from rest_framework.settings import api_settings
 
+from crm.models import (Customer, Contract, Event, HistoryEntry, SellerSummary, CustomerSummary,
+                        EventMonthSummary)
 
-class CustomerDetailSerializer(ModelSerializer):
+
+class SparseFieldsSerializer(ModelSerializer):
+    """
+    Takes the names of the fields to keep, from ?fields= (see the
+    SparseFieldsMixin of the views). The other fields are removed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields != None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+def value(column):
+    """
+    A field of values_fields which displays a column as it is.
+    """
+    return [column], lambda: itemgetter(column)
+
+
+def date_value(column):
+    """
+    A field of values_fields which displays a date like a DateTimeField. The
+    timezone is read once per list instead of once per date.
+    """
+    def make_display():
+        field = DateTimeField()
+        field_timezone = field.default_timezone()
+        if api_settings.DATETIME_FORMAT.lower() != ISO_8601 or field_timezone is None:
+            return lambda row: field.to_representation(row[column])
+
+        def display(row):
+            if not row[column]:
+                return None
+            date = row[column].astimezone(field_timezone).isoformat()
+            return date[:-6] + 'Z' if date.endswith('+00:00') else date
+        return display
+    return [column], make_display
+
+
+def str_value(column):
+    """
+    A field of values_fields which displays a related instance with its
+    __str__, read from one column ('None' without instance).
+    """
+    return [column], lambda: lambda row: str(row[column])
+
+
+class ValuesListSerializer(SparseFieldsSerializer):
+    """
+    A list serializer which can also build its rows straight from the dicts of
+    .values(), without the fields of DRF (see ValuesListMixin in the views).
+    values_fields gives, for each field, the columns it reads and a function
+    returning how to display them, so the rows are the same than with
+    to_representation.
+    """
+    values_fields = {}
+
+    @classmethod
+    def get_values_columns(cls, fields=None):
+        columns = []
+        for name in cls.Meta.fields:
+            if fields == None or name in fields:
+                columns += [column for column in cls.values_fields[name][0]
+                            if column not in columns]
+        return columns
+
+    @classmethod
+    def rows_from_values(cls, rows, fields=None):
+        displays = [(name, cls.values_fields[name][1]()) for name in cls.Meta.fields
+                    if fields == None or name in fields]
+        return [{name: display(row) for name, display in displays} for row in rows]
+
+
+class CustomerDetailSerializer(SparseFieldsSerializer):
 
     class Meta:
         model = Customer
@@ -22,7 +102,14 @@ class CustomerDetailSerializer(ModelSerializer):
         ]
 
 
-class CustomerListSerializer(ModelSerializer):
+class CustomerListSerializer(ValuesListSerializer):
+    values_fields = {
+        'first_name': value('first_name'),
+        'last_name': value('last_name'),
+        'compagny_name': value('compagny_name'),
+        'existing': value('existing'),
+        'id': value('id')
+    }
     
     class Meta:
         model = Customer
@@ -35,7 +122,25 @@ class CustomerListSerializer(ModelSerializer):
         ]
 
 
-class ContractDetailSerializer(ModelSerializer):
+class CustomerImportSerializer(ModelSerializer):
+    """
+    Validates the rows of a bulk import. The seller is resolved by the view,
+    for all the rows at once.
+    """
+
+    class Meta:
+        model = Customer
+        fields = [
+            'first_name',
+            'last_name',
+            'email',
+            'phone',
+            'compagny_name',
+            'notes'
+        ]
+
+
+class ContractDetailSerializer(SparseFieldsSerializer):
     customer = SerializerMethodField()
     support = SerializerMethodField()
     event = SerializerMethodField()
@@ -60,7 +165,6 @@ class ContractDetailSerializer(ModelSerializer):
         return instance.customer.__str__()
     
     def get_support(self, instance):
-        print(instance)
         return instance.support.__str__()
     
     def get_seller(self, instance):
@@ -70,10 +174,22 @@ class ContractDetailSerializer(ModelSerializer):
         return instance.event.__str__()
 
 
-class ContractListSerializer(ModelSerializer):
+class ContractListSerializer(ValuesListSerializer):
     customer = SerializerMethodField()
     support = SerializerMethodField()
     event = SerializerMethodField()
+    values_fields = {
+        'support': str_value('support__username'),
+        'customer': (['customer_id', 'customer__first_name', 'customer__last_name',
+                      'customer__compagny_name'],
+                     lambda: lambda row: Customer.display_name(row['customer__first_name'],
+                         row['customer__last_name'], row['customer__compagny_name'])
+                     if row['customer_id'] is not None else 'None'),
+        'event': str_value('event__name'),
+        'signed': value('signed'),
+        'date_created': date_value('date_created'),
+        'id': value('id')
+    }
     
     class Meta:
         model = Contract
@@ -96,7 +212,21 @@ class ContractListSerializer(ModelSerializer):
         return instance.event.__str__()
 
 
-class EventDetailSerializer(ModelSerializer):
+class ContractImportSerializer(ModelSerializer):
+    """
+    Validates the rows of a bulk import. The support, seller and customer are
+    resolved by the view, for all the rows at once.
+    """
+
+    class Meta:
+        model = Contract
+        fields = [
+            'due',
+            'payed'
+        ]
+
+
+class EventDetailSerializer(SparseFieldsSerializer):
 
     class Meta:
         model = Event
@@ -111,7 +241,12 @@ class EventDetailSerializer(ModelSerializer):
         ]
 
 
-class EventListSerializer(ModelSerializer):
+class EventListSerializer(ValuesListSerializer):
+    values_fields = {
+        'name': value('name'),
+        'date_event': date_value('date_event'),
+        'id': value('id')
+    }
     
     class Meta:
         model = Event
@@ -120,3 +255,62 @@ class EventListSerializer(ModelSerializer):
             'date_event',
             'id'
         ]
+
+
+class SellerSummarySerializer(ModelSerializer):
+    seller_name = SerializerMethodField()
+
+    class Meta:
+        model = SellerSummary
+        fields = [
+            'seller',
+            'seller_name',
+            'contracts',
+            'signed_contracts',
+            'signed_due',
+            'payed_due'
+        ]
+
+    def get_seller_name(self, instance):
+        return instance.seller.__str__()
+
+
+class CustomerSummarySerializer(ModelSerializer):
+    customer_name = SerializerMethodField()
+
+    class Meta:
+        model = CustomerSummary
+        fields = [
+            'customer',
+            'customer_name',
+            'contracts',
+            'total_due',
+            'unpaid_due'
+        ]
+
+    def get_customer_name(self, instance):
+        return instance.customer.__str__()
+
+
+class EventMonthSummarySerializer(ModelSerializer):
+
+    class Meta:
+        model = EventMonthSummary
+        fields = [
+            'month',
+            'events'
+        ]
+
+
+class HistoryEntrySerializer(ModelSerializer):
+
+    class Meta:
+        model = HistoryEntry
+        fields = [
+            'action',
+            'changes',
+            'user',
+            'username',
+            'date_created',
+            'id'
+        ]
@@ -1,3 +1,1312 @@
-from django.test import TestCase
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+import csv
+import json
+import re
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import FloatField, IntegerField, Q
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from crm import history, metrics
+from crm.models import (Customer, Contract, ContractVisibility, CustomerVisibility, Event,
+                        HistoryEntry, OutboxMessage, REPORT_SUMMARIES, Tombstone)
+from crm.pagination import DateCreatedCursorPagination
+from crm.views import ContractViewset, CustomerViewset, EventViewset
+from crm_epic_event.asgi import application
+from users.models import User
+from users.serializers import RoleTokenObtainPairSerializer
+
+
+class CrmTestCase(TestCase):
+    """
+    Commun fixtures : one user per role, and a helper to create contracts.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.manager = User.objects.create(username='damien', role='MANAGER')
+        cls.seller = User.objects.create(username='jamy', role='SELLER')
+        cls.support = User.objects.create(username='francois', role='SUPPORT')
+        cls.customer = Customer.objects.create(
+            last_name='Dupont', compagny_name='Dupont SA',
+            email='dupont@example.com', seller=cls.seller)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def login(self, user):
+        self.client.force_authenticate(user=user)
+
+    def create_contracts(self, number):
+        for i in range(number):
+            event = Event.objects.create(
+                name='Event ' + str(i), location='Paris',
+                date_event=timezone.now() + timedelta(days=30))
+            Contract.objects.create(
+                customer=self.customer, seller=self.seller, support=self.support,
+                event=event, signed=True, due=1000)
+
+
+class ContractQueryBudgetTest(CrmTestCase):
+    """
+    The contract routes must load the customer, the users and the event of
+    every contract in a constant number of queries, whatever the page size.
+    """
+    def assert_budget(self, url, budget):
+        self.create_contracts(5)
+        with self.assertNumQueries(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        self.create_contracts(20)
+        with self.assertNumQueries(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 25)
+
+    def test_contracts_list(self):
+        self.login(self.manager)
+        self.assert_budget('/api/contracts/', 2)
+
+    def test_contracts_list_seller(self):
+        self.login(self.seller)
+        self.assert_budget('/api/contracts/', 2)
+
+    def test_user_contracts_list(self):
+        self.login(self.manager)
+        self.assert_budget('/api/users/' + str(self.support.id) + '/contracts/', 3)
+
+    def test_customer_contracts_list(self):
+        self.login(self.support)
+        self.assert_budget('/api/customers/' + str(self.customer.id) + '/contracts/', 3)
+
+    def test_contract_detail(self):
+        self.login(self.manager)
+        self.create_contracts(1)
+        contract = Contract.objects.get()
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/contracts/' + str(contract.id) + '/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['customer'], str(self.customer))
+        self.assertEqual(response.data['seller'], str(self.seller))
+
+
+class CursorPaginationTest(CrmTestCase):
+    """
+    Walking the next links of ?pagination=cursor gives every instance the user
+    can read once, even when they were created at the same time.
+    """
+    def setUp(self):
+        super().setUp()
+        other_seller = User.objects.create(username='fred', role='SELLER')
+        other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=other_seller)
+        self.create_contracts(7)
+        for i in range(3):
+            Contract.objects.create(customer=other_customer, seller=other_seller,
+                                    support=self.support, due=500)
+        for i in range(4):
+            customer = Customer.objects.create(
+                last_name='Durand ' + str(i), compagny_name='Durand SA',
+                email='durand' + str(i) + '@example.com', seller=self.seller)
+            if i % 2:
+                Contract.objects.create(customer=customer, seller=self.seller,
+                                        support=self.support, due=500)
+        # Ties on the ordering of the cursor.
+        now = timezone.now()
+        for model in [Customer, Contract, Event]:
+            model.objects.update(date_created=now)
+
+    def walk(self, url):
+        ids = []
+        url = url + '?pagination=cursor'
+        while url != None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_walk(self):
+        with mock.patch.object(DateCreatedCursorPagination, 'page_size', 3):
+            for user, route, queryset in [
+                    (self.manager, '/api/contracts/', Contract.objects.all()),
+                    (self.seller, '/api/contracts/', Contract.objects.filter(seller=self.seller)),
+                    (self.seller, '/api/customers/', Customer.objects.filter(seller=self.seller)),
+                    (self.support, '/api/contracts/', Contract.objects.filter(support=self.support)),
+                    (self.support, '/api/events/', Event.objects.filter(event__support=self.support)),
+                    (self.support, '/api/customers/', Customer.objects.filter(
+                        customer__support=self.support).distinct())]:
+                self.login(user)
+                ids = self.walk(route)
+                expected = sorted(queryset.values_list('id', flat=True), reverse=True)
+                self.assertGreater(len(expected), 3, (user.role, route))
+                # No duplicate nor gap, in the order of the ids for the ties.
+                self.assertEqual(ids, expected, (user.role, route))
+
+
+class VisibilityTest(CrmTestCase):
+    """
+    visible_to, read from the visibility tables, gives the same instances than
+    the role filters they replaced, after each change of the relations.
+    """
+    def setUp(self):
+        super().setUp()
+        self.other_seller = User.objects.create(username='fred', role='SELLER')
+        self.other_support = User.objects.create(username='marie', role='SUPPORT')
+        self.other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=self.other_seller)
+        self.create_contracts(2)
+        event = Event.objects.create(name='Salon', location='Lyon',
+                                     date_event=timezone.now() + timedelta(days=30))
+        Contract.objects.create(customer=self.other_customer, seller=self.other_seller,
+                                support=self.other_support, event=event, due=500)
+
+    def role_filter(self, model, user, customer=None):
+        # The filters of the views before the visibility tables.
+        if user.role == 'MANAGER' and customer is None:
+            return model.objects.all()
+        if user.role == 'MANAGER':
+            contracts = Contract.objects.all()
+        else:
+            contracts = Contract.objects.filter(Q(seller=user) | Q(support=user))
+        if customer is not None:
+            contracts = contracts.filter(customer=customer)
+        if model == Contract:
+            return contracts
+        if model == Event:
+            return Event.objects.filter(id__in=contracts.values('event'))
+        if user.role == 'MANAGER':
+            customers = Customer.objects.all()
+        elif user.role == 'SELLER':
+            customers = Customer.objects.filter(seller=user)
+        else:
+            customers = Customer.objects.filter(id__in=contracts.values('customer'))
+        return customers.filter(id=customer.id) if customer is not None else customers
+
+    def assert_visible(self, step):
+        for user in User.objects.all():
+            for model in [Customer, Contract, Event]:
+                for customer in [None] + list(Customer.objects.all()):
+                    self.assertEqual(
+                        set(model.objects.visible_to(user, customer).values_list('id', flat=True)),
+                        set(self.role_filter(model, user, customer).values_list('id', flat=True)),
+                        (step, user.username, model.__name__, customer))
+
+    def test_changes(self):
+        self.assert_visible('created')
+        contract = Contract.objects.filter(customer=self.customer).first()
+        contract.support = self.other_support
+        contract.save()
+        self.assert_visible('support changed')
+        contract.seller = self.other_seller
+        contract.save()
+        self.assert_visible('seller changed')
+        self.customer.seller = self.other_seller
+        self.customer.save()
+        self.assert_visible('customer seller changed')
+        contract.delete()
+        self.assert_visible('contract deleted')
+        Event.objects.filter(event__customer=self.other_customer).get().delete()
+        self.assert_visible('event deleted')
+        self.support.delete()
+        self.assert_visible('user deleted')
+
+    def test_granted(self):
+        # Only what became visible in the window.
+        since = timezone.now()
+        contract = Contract.objects.filter(customer=self.customer).first()
+        contract.support = self.other_support
+        contract.save()
+        until = timezone.now()
+        self.assertEqual(list(Contract.objects.granted_to(self.other_support, since, until)),
+                         [contract])
+        self.assertEqual(list(Event.objects.granted_to(self.other_support, since, until)),
+                         [contract.event])
+        self.assertEqual(list(Customer.objects.granted_to(self.other_support, since, until)),
+                         [self.customer])
+        for user in [self.support, self.seller]:
+            self.assertFalse(Contract.objects.granted_to(user, since, until).exists())
+        self.assertFalse(Contract.objects.granted_to(self.other_support, until, timezone.now()
+                                                     ).exists())
+        self.assertFalse(Contract.objects.granted_to(self.manager, since, until).exists())
+
+
+class CustomerEventsTest(CrmTestCase):
+    """
+    The events of a customer, by the customer filters of /events/ or the
+    /customers/<pk>/events/ route, are exactly the ones of his contracts the
+    user can see, once each.
+    """
+    def setUp(self):
+        super().setUp()
+        self.other_support = User.objects.create(username='marie', role='SUPPORT')
+        self.other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=self.seller)
+        self.create_contracts(2)
+        for customer, support in [(self.customer, self.other_support),
+                                  (self.other_customer, self.support),
+                                  (self.other_customer, self.other_support)]:
+            event = Event.objects.create(name='Salon', location='Lyon',
+                                         date_event=timezone.now() + timedelta(days=30))
+            Contract.objects.create(customer=customer, seller=self.seller, support=support,
+                                    event=event, signed=True, due=500)
+        # An event without contract belongs to no customer.
+        Event.objects.create(name='Orphan', location='Lyon',
+                             date_event=timezone.now() + timedelta(days=30))
+
+    def get_ids(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        ids = [row['id'] for row in response.data['results']]
+        self.assertEqual(len(ids), len(set(ids)), url)
+        return set(ids)
+
+    def test_events(self):
+        for user in [self.manager, self.seller, self.support]:
+            self.login(user)
+            for customer in [self.customer, self.other_customer]:
+                contracts = Contract.objects.filter(customer=customer)
+                if user.role == 'SUPPORT':
+                    contracts = contracts.filter(support=user)
+                expected = set(contracts.values_list('event', flat=True))
+                self.assertTrue(expected)
+                self.assertEqual(
+                    self.get_ids('/api/customers/' + str(customer.id) + '/events/'),
+                    expected, (user.role, customer.last_name))
+                for field in ['last_name', 'compagny_name', 'email']:
+                    self.assertEqual(
+                        self.get_ids('/api/events/', {field: getattr(customer, field)}),
+                        expected, (user.role, field))
+
+
+class ContractWriteCountTest(CrmTestCase):
+    """
+    Creating or updating a contract writes each changed row only once, and
+    the customer only when his status changes.
+    """
+    def count_writes(self, queries):
+        writes = {}
+        for query in queries:
+            words = query['sql'].split()
+            if words[0] == 'INSERT':
+                key = ('INSERT', words[2].strip('"'))
+            elif words[0] == 'UPDATE':
+                key = ('UPDATE', words[1].strip('"'))
+            else:
+                continue
+            writes[key] = writes.get(key, 0) + 1
+        return writes
+
+    def post_contract(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/contracts/', {
+                'support': self.support.id, 'customer': self.customer.id, 'due': 500})
+        self.assertEqual(response.status_code, 201)
+        return self.count_writes(context.captured_queries)
+
+    def test_create(self):
+        self.login(self.seller)
+        writes = self.post_contract()
+        self.assertEqual(writes[('INSERT', 'crm_contract')], 1)
+        self.assertEqual(writes[('UPDATE', 'crm_customer')], 1)
+        self.assertNotIn(('UPDATE', 'crm_contract'), writes)
+        self.assertTrue(Customer.objects.get(id=self.customer.id).existing)
+
+        writes = self.post_contract()
+        self.assertEqual(writes[('INSERT', 'crm_contract')], 1)
+        self.assertNotIn(('UPDATE', 'crm_customer'), writes)
+        self.assertNotIn(('UPDATE', 'crm_contract'), writes)
+
+    def test_update(self):
+        self.login(self.manager)
+        self.create_contracts(1)
+        contract = Contract.objects.get()
+        other_support = User.objects.create(username='marie', role='SUPPORT')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch('/api/contracts/' + str(contract.id) + '/', {
+                'support': other_support.id, 'seller': self.seller.id,
+                'customer': self.customer.id, 'due': 800}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        writes = self.count_writes(context.captured_queries)
+        self.assertEqual(writes[('UPDATE', 'crm_contract')], 1)
+        self.assertNotIn(('UPDATE', 'crm_customer'), writes)
+        self.assertNotIn(('INSERT', 'crm_contract'), writes)
+        contract.refresh_from_db()
+        self.assertEqual(contract.support, other_support)
+        self.assertEqual(contract.due, 800)
+
+    def test_roles_fetched_at_once(self):
+        # The users selected in one query, the customer in another, and
+        # nothing else is read before the writes.
+        Customer.objects.filter(id=self.customer.id).update(existing=True)
+        self.login(self.manager)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/contracts/', {
+                'support': self.support.id, 'seller': self.seller.id,
+                'customer': self.customer.id, 'due': 500})
+        self.assertEqual(response.status_code, 201)
+        selects = [re.search(r'FROM "(\w+)"', query['sql']).group(1)
+                   for query in context.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(selects, ['users_user', 'crm_customer'])
+
+
+class BulkImportTest(CrmTestCase):
+    """
+    The imports validate every row first, and create the rows with the same
+    side effects than the create action (visibility, status of the customer,
+    report tables).
+    """
+    def test_customers_json(self):
+        self.login(self.seller)
+        response = self.client.post('/api/customers/import/', [
+            {'last_name': 'Martin', 'email': 'martin@example.com'},
+            {'first_name': 'Anonymous', 'email': 'anonymous@example.com'},
+            {'compagny_name': 'Durand SA', 'email': 'not an email'}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['row'] for error in response.data['errors']], [1, 2])
+        self.assertIn('non_field_errors', response.data['errors'][0]['errors'])
+        self.assertIn('email', response.data['errors'][1]['errors'])
+        self.assertEqual(Customer.objects.count(), 1)
+
+        response = self.client.post('/api/customers/import/', [
+            {'last_name': 'Martin', 'email': 'martin@example.com'},
+            {'compagny_name': 'Durand SA', 'email': 'durand@example.com'}], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 2)
+        customers = Customer.objects.exclude(id=self.customer.id)
+        self.assertEqual({(customer.seller_id, customer.existing) for customer in customers},
+                         {(self.seller.id, False)})
+        self.assertEqual(CustomerVisibility.objects.filter(
+            user=self.seller, customer__in=customers).count(), 2)
+
+    def test_customers_csv(self):
+        self.login(self.manager)
+        content = ('last_name,compagny_name,email,seller\n'
+                   'Martin,,martin@example.com,%s\n'
+                   ',Durand SA,durand@example.com,%s\n' % (self.seller.id, self.seller.id))
+        response = self.client.post('/api/customers/import/', content, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Customer.objects.filter(seller=self.seller).count(), 3)
+
+        response = self.client.post('/api/customers/import/', 'last_name,email,seller\nMartin,martin@example.com,0\n',
+                                    content_type='text/csv')
+        self.assertEqual(response.data['errors'], [{'row': 0, 'errors': {'seller': ['Not found.']}}])
+
+        self.login(self.support)
+        response = self.client.post('/api/customers/import/', content, content_type='text/csv')
+        self.assertEqual(response.status_code, 403)
+
+    def test_contracts(self):
+        self.login(self.seller)
+        response = self.client.post('/api/contracts/import/', [
+            {'support': self.support.id, 'customer': self.customer.id, 'due': 500},
+            {'support': self.support.id, 'customer': self.customer.id, 'signed': True},
+            {'support': self.seller.id, 'customer': self.customer.id},
+            {'customer': self.customer.id}], format='json')
+        self.assertEqual(response.status_code, 400)
+        errors = {error['row']: error['errors'] for error in response.data['errors']}
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertIn('signed', errors[1])
+        self.assertEqual(errors[2]['support'], ['The support selected is not SUPPORT'])
+        self.assertEqual(errors[3]['support'], ['This field is required.'])
+        self.assertFalse(Contract.objects.exists())
+
+        content = 'support,customer,due\n%s,%s,500\n%s,%s,700\n' % (
+            self.support.id, self.customer.id, self.support.id, self.customer.id)
+        response = self.client.post('/api/contracts/import/', content, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Contract.objects.filter(seller=self.seller).count(), 2)
+        self.assertTrue(Customer.objects.get(id=self.customer.id).existing)
+        self.assertEqual(ContractVisibility.objects.filter(user=self.support).count(), 2)
+        self.assertTrue(CustomerVisibility.objects.filter(
+            user=self.support, customer=self.customer).exists())
+        self.assertEqual(self.seller.summary.contracts, 2)
+        self.assertEqual(self.customer.summary.total_due, 1200)
+
+        # A MANAGER chooses the seller of each row.
+        self.login(self.manager)
+        response = self.client.post('/api/contracts/import/', [
+            {'support': self.support.id, 'customer': self.customer.id}], format='json')
+        self.assertEqual(response.data['errors'][0]['errors']['seller'], ['This field is required.'])
+        self.login(self.support)
+        response = self.client.post('/api/contracts/import/', [
+            {'support': self.support.id, 'customer': self.customer.id}], format='json')
+        self.assertEqual(response.status_code, 403)
+
+
+class ExportTest(CrmTestCase):
+    """
+    The exports stream the whole list, with its security and its filters.
+    """
+    def export(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        self.create_contracts(2)
+        self.login(self.manager)
+        rows = list(csv.reader(StringIO(self.export('/api/contracts/export/'))))
+        self.assertEqual(rows[0], ['support', 'seller', 'customer', 'event', 'date_created',
+                                   'date_updated', 'signed', 'date_signed', 'due', 'id'])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][:4], ['francois', 'jamy', str(self.customer), 'Event 0'])
+
+        # The columns keep the order of the serializer.
+        lines = self.export('/api/customers/export/?fields=id,compagny_name').splitlines()
+        self.assertEqual(lines, ['compagny_name,id', 'Dupont SA,%s' % self.customer.id])
+
+    def test_ndjson(self):
+        self.create_contracts(2)
+        self.login(self.manager)
+        rows = [json.loads(line) for line in
+                self.export('/api/events/export/?output=ndjson&fields=name,id').splitlines()]
+        self.assertEqual(rows, [{'name': 'Event 0', 'id': rows[0]['id']},
+                                {'name': 'Event 1', 'id': rows[1]['id']}])
+
+        response = self.client.get('/api/events/export/?output=xml')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/events/export/?fields=unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_scope(self):
+        other_seller = User.objects.create(username='fred', role='SELLER')
+        other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=other_seller)
+        self.login(self.seller)
+        lines = self.export('/api/customers/export/?fields=id').splitlines()
+        self.assertEqual(lines, ['id', str(self.customer.id)])
+        self.login(other_seller)
+        lines = self.export('/api/customers/export/?fields=id').splitlines()
+        self.assertEqual(lines, ['id', str(other_customer.id)])
+        # A SUPPORT member without contracts exports nothing.
+        self.login(self.support)
+        self.assertEqual(self.export('/api/customers/export/?fields=id').splitlines(), ['id'])
+
+
+class MetricsTest(CrmTestCase):
+    """
+    Each request is measured on its own, and /api/metrics serves the
+    histograms in the Prometheus text format.
+    """
+    # name{labels} value, the value a number.
+    SAMPLE = re.compile(r'^([a-z_]+)\{((?:[a-z]+="[^"]*",?)+)\} (-?[0-9.e+-]+|\+Inf)$')
+
+    def parse(self, text):
+        samples = {}
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                continue
+            match = self.SAMPLE.match(line)
+            self.assertIsNotNone(match, line)
+            samples[(match.group(1), match.group(2))] = float(match.group(3))
+        return samples
+
+    def test_metrics(self):
+        self.create_contracts(2)
+        self.login(self.manager)
+        queries = []
+        with mock.patch.object(metrics, 'registry', metrics.Registry()):
+            for i in range(2):
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get('/api/contracts/')
+                self.assertIsNone(metrics.current_measures.get())
+                # The count starts again at each request.
+                self.assertIn('desc="%s queries"' % len(context.captured_queries),
+                              response['Server-Timing'])
+                queries.append(len(context.captured_queries))
+            response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        samples = self.parse(response.content.decode())
+        labels = 'route="contracts-list",role="MANAGER"'
+        self.assertEqual(samples[('crm_request_queries_count', labels)], 2)
+        self.assertEqual(samples[('crm_request_queries_sum', labels)], sum(queries))
+        self.assertEqual(samples[('crm_request_duration_seconds_bucket', labels + ',le="+Inf"')], 2)
+        # The scrape itself is measured after its body is built.
+        self.assertNotIn(('crm_request_queries_count', 'route="metrics",role="anonymous"'), samples)
+
+
+class SummaryTest(CrmTestCase):
+    """
+    The counters of the report tables, updated by each save and delete, must
+    stay equal to what rebuild() computes from the contracts and events.
+    """
+    def assert_summaries(self):
+        for summary in REPORT_SUMMARIES:
+            counters = [field.attname for field in summary._meta.concrete_fields
+                        if isinstance(field, (IntegerField, FloatField)) and not field.primary_key]
+            keys = [field.attname for field in summary._meta.concrete_fields
+                    if field.attname not in counters and not field.primary_key]
+
+            def rows():
+                # A row whose counters went back to 0 is the same as no row.
+                return {tuple(row[key] for key in keys) + tuple(round(row[counter], 2)
+                            for counter in counters)
+                        for row in summary.objects.values(*keys, *counters)
+                        if any(row[counter] for counter in counters)}
+            incremental = rows()
+            summary.rebuild()
+            self.assertEqual(incremental, rows(), summary.__name__)
+
+    def test_counters(self):
+        other_seller = User.objects.create(username='fred', role='SELLER')
+        other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=other_seller)
+        self.create_contracts(3)
+        self.login(self.seller)
+        response = self.client.post('/api/contracts/', {
+            'support': self.support.id, 'customer': self.customer.id, 'due': 500})
+        unsigned = Contract.objects.get(id=response.data['id'])
+        self.assert_summaries()
+
+        response = self.client.post('/api/contracts/' + str(unsigned.id) + '/sign/', {
+            'name': 'Mariage', 'location': 'Lyon',
+            'date_event': (timezone.now() + timedelta(days=60)).isoformat()})
+        self.assertEqual(response.status_code, 201)
+        self.assert_summaries()
+
+        first, second, third = Contract.objects.exclude(id=unsigned.id).order_by('id')
+        self.login(self.manager)
+        response = self.client.patch('/api/contracts/' + str(first.id) + '/', {
+            'support': self.support.id, 'seller': other_seller.id,
+            'customer': other_customer.id, 'due': 800}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        second.payed = True
+        second.save()
+        third.due = 1500
+        third.save(update_fields=['due'])
+        event = Event.objects.get(id=third.event_id)
+        event.date_event = timezone.now() + timedelta(days=400)
+        event.save()
+        self.assert_summaries()
+
+        second.delete()
+        Event.objects.get(id=first.event_id).delete()
+        self.assert_summaries()
+
+    def test_saved_state(self):
+        # The loading doesn't keep the state, the saves and deletes read it.
+        self.create_contracts(3)
+        first, second, third = Contract.objects.order_by('id')
+        self.assertFalse(hasattr(first, 'report_state'))
+        first.due = 1200
+        first.save()
+        self.assertEqual(first.report_state['due'], 1200)
+        second.delete()
+        third.due = 1
+        third.delete()
+        Event.objects.only('id').get(id=first.event_id).delete()
+        self.assert_summaries()
+
+    def test_permissions(self):
+        self.create_contracts(1)
+        for user in [self.seller, self.support]:
+            self.login(user)
+            for report in ['', 'revenue/', 'unpaid/', 'pipeline/', 'events/']:
+                response = self.client.get('/api/reports/' + report)
+                self.assertEqual(response.status_code, 403, (user.role, report))
+        self.login(self.manager)
+        response = self.client.get('/api/reports/revenue/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data[0]['signed_contracts'], response.data[0]['signed_due']),
+                         (1, 1000))
+        response = self.client.get('/api/reports/pipeline/')
+        self.assertEqual(response.data['signed'], {'contracts': 1, 'total_due': 1000})
+        response = self.client.get('/api/reports/unpaid/')
+        self.assertEqual(response.data['results'][0]['unpaid_due'], 1000)
+
+    def test_events_year(self):
+        self.create_contracts(1)
+        self.login(self.manager)
+        year = (timezone.now() + timedelta(days=30)).year
+        response = self.client.get('/api/reports/events/', {'year': year})
+        self.assertEqual([row['events'] for row in response.data], [1])
+        response = self.client.get('/api/reports/events/', {'year': year + 1})
+        self.assertEqual(response.data, [])
+        response = self.client.get('/api/reports/events/', {'year': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('year', response.data)
+
+
+class SearchTest(CrmTestCase):
+    """
+    ?search= on the customers tolerates typos, and returns the best matches
+    first.
+    """
+    def test_ranking(self):
+        for last_name, compagny_name in [('Durand', 'Durand SARL'), ('Dupond', 'Dupond et fils'),
+                                         ('Martin', 'Martin SA')]:
+            Customer.objects.create(last_name=last_name, compagny_name=compagny_name,
+                email=last_name.lower() + '@example.com', seller=self.seller)
+        self.login(self.seller)
+        response = self.client.get('/api/customers/', {'search': 'Duppont'})
+        self.assertEqual(response.status_code, 200)
+        names = [row['last_name'] for row in response.data['results']]
+        self.assertEqual(names[0], 'Dupont')
+        self.assertNotIn('Martin', names)
+
+    def test_cursor_refused(self):
+        self.login(self.seller)
+        response = self.client.get('/api/customers/', {'search': 'Dupont', 'pagination': 'cursor'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pagination', response.data)
+
+
+class ConditionalGetTest(CrmTestCase):
+    """
+    A list is answered with a 304 while it didn't change for the user.
+    """
+    def get(self, url, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag != None else {}
+        return self.client.get(url, **headers)
+
+    def test_list(self):
+        self.create_contracts(2)
+        self.login(self.manager)
+        etag = self.get('/api/contracts/')['ETag']
+        self.assertEqual(self.get('/api/contracts/', etag).status_code, 304)
+
+        contract = Contract.objects.first()
+        contract.due = 800
+        contract.save()
+        response = self.get('/api/contracts/', etag)
+        self.assertEqual(response.status_code, 200)
+
+        contract.delete()
+        self.assertEqual(self.get('/api/contracts/', response['ETag']).status_code, 200)
+
+    def test_visibility(self):
+        """
+        Two supports swap their contracts : the number of customers and their
+        date_updated are the same, but not the customers.
+        """
+        other_support = User.objects.create(username='marie', role='SUPPORT')
+        other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=self.seller)
+        events = [Event.objects.create(name='Event', location='Paris',
+                                       date_event=timezone.now() + timedelta(days=30))
+                  for i in range(2)]
+        mine = Contract.objects.create(customer=self.customer, seller=self.seller,
+                                       support=self.support, event=events[0], due=1000)
+        other = Contract.objects.create(customer=other_customer, seller=self.seller,
+                                        support=other_support, event=events[1], due=1000)
+        Customer.objects.update(date_updated=timezone.now())
+        Event.objects.update(date_updated=timezone.now())
+        self.login(self.support)
+        response = self.get('/api/customers/')
+        self.assertEqual([row['id'] for row in response.data['results']], [self.customer.id])
+        events_etag = self.get('/api/events/')['ETag']
+
+        Contract.objects.filter(id=mine.id).update(support=other_support)
+        Contract.objects.filter(id=other.id).update(support=self.support)
+        for contract in Contract.objects.all():
+            ContractVisibility.refresh_contract(contract)
+        for customer in Customer.objects.all():
+            CustomerVisibility.refresh_customer(customer)
+        response = self.get('/api/customers/', response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['id'] for row in response.data['results']], [other_customer.id])
+        self.assertEqual(self.get('/api/events/', events_etag).status_code, 200)
+
+    def test_cursor(self):
+        """
+        The keyset pagination never counts the list.
+        """
+        self.create_contracts(2)
+        self.login(self.manager)
+        with CaptureQueriesContext(connection) as context:
+            response = self.get('/api/contracts/?pagination=cursor')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertFalse([query for query in context.captured_queries
+                          if 'COUNT(' in query['sql'] or 'MAX(' in query['sql']])
+
+
+class SparseFieldsTest(CrmTestCase):
+    """
+    ?fields= narrows the keys of the lists and details, and the columns read.
+    """
+    def get(self, url, table):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        columns = set()
+        for query in context.captured_queries:
+            match = re.match(r'SELECT (.*?) FROM "%s"' % table, query['sql'])
+            if match and 'COUNT(' not in match.group(1):
+                columns.update(re.findall(r'"%s"\."(\w+)"' % table, match.group(1)))
+        return response, columns
+
+    def test_columns(self):
+        self.create_contracts(2)
+        self.login(self.seller)
+        # The pagination and the validator also read the id and the dates.
+        read_anyway = {'id', 'date_created', 'date_updated'}
+
+        response, columns = self.get('/api/customers/?fields=id,last_name', 'crm_customer')
+        self.assertEqual([set(row) for row in response.data['results']], [{'id', 'last_name'}])
+        self.assertEqual(columns - read_anyway, {'last_name'})
+
+        response, columns = self.get('/api/customers/' + str(self.customer.id) + '/?fields=email',
+                                     'crm_customer')
+        self.assertEqual(response.data, {'email': 'dupont@example.com'})
+        self.assertEqual(columns - read_anyway, {'email'})
+
+        contract = Contract.objects.first()
+        response, columns = self.get('/api/contracts/' + str(contract.id) + '/?fields=due,id',
+                                     'crm_contract')
+        self.assertEqual(response.data, {'due': 1000, 'id': contract.id})
+        # The validator of the detail also reads the customer and the event.
+        self.assertEqual(columns - read_anyway, {'due', 'customer_id', 'event_id'})
+
+    def test_unknown(self):
+        self.create_contracts(1)
+        self.login(self.seller)
+        for url in ['/api/customers/', '/api/customers/' + str(self.customer.id) + '/',
+                    '/api/contracts/', '/api/events/']:
+            response = self.client.get(url, {'fields': 'id,unknown'})
+            self.assertEqual(response.status_code, 400, url)
+            self.assertIn('unknown', response.data['fields'])
+
+
+class ValuesListTest(CrmTestCase):
+    """
+    The fast path of the lists (.values() and orjson) must return the same
+    bytes than the serializers.
+    """
+    def assert_same_output(self, url):
+        responses = []
+        for values_list in [False, True]:
+            for viewset in [CustomerViewset, ContractViewset, EventViewset]:
+                viewset.values_list = values_list
+            responses.append(self.client.get(url))
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[0].content, responses[1].content, url)
+
+    def tearDown(self):
+        for viewset in [CustomerViewset, ContractViewset, EventViewset]:
+            viewset.values_list = True
+
+    def test_lists(self):
+        self.create_contracts(3)
+        Contract.objects.create(customer=self.customer, seller=self.seller, due=10)
+        Customer.objects.create(first_name='Zoé', last_name='Martin\u2028',
+            email='zoe@example.com', seller=self.seller)
+        self.login(self.manager)
+        for url in ['/api/customers/', '/api/contracts/', '/api/events/',
+                    '/api/contracts/?pagination=cursor', '/api/contracts/?fields=customer,id',
+                    '/api/customers/' + str(self.customer.id) + '/events/']:
+            self.assert_same_output(url)
+
+
+class DateRangeTest(CrmTestCase):
+    """
+    The date filters are ranges on the date columns, and the calendar groups
+    the events of a month by day.
+    """
+    def setUp(self):
+        super().setUp()
+        self.create_contracts(4)
+        dates = ['2022-02-28T23:30:00Z', '2022-03-01T08:00:00Z',
+                 '2022-03-31T18:00:00Z', timezone.now() + timedelta(days=3)]
+        for event, date in zip(Event.objects.order_by('id'), dates):
+            Event.objects.filter(id=event.id).update(date_event=date)
+        self.login(self.manager)
+
+    def event_names(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return sorted(event['name'] for event in response.data['results'])
+
+    def test_events_range(self):
+        self.assertEqual(self.event_names('/api/events/?date_from=2022-03-01&date_to=2022-03-31'),
+                         ['Event 1', 'Event 2'])
+        self.assertEqual(self.event_names('/api/events/?date_to=2022-03-01T07:00'), ['Event 0'])
+        self.assertEqual(self.event_names('/api/events/?date=2022-03'), ['Event 1', 'Event 2'])
+        self.assertEqual(self.event_names('/api/events/?upcoming=true'), ['Event 3'])
+        response = self.client.get('/api/events/?date_from=03/01/2022')
+        self.assertEqual(response.status_code, 400)
+
+    def test_contracts_signed_range(self):
+        Contract.objects.filter(event__name='Event 1').update(date_signed='2022-01-10T12:00:00Z')
+        response = self.client.get('/api/contracts/?signed_from=2022-01-10&signed_to=2022-01-10')
+        self.assertEqual([contract['event'] for contract in response.data['results']], ['Event 1'])
+
+    def test_calendar(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/events/calendar/?month=2022-03&fields=name')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'month': '2022-03', 'count': 2, 'days': [
+            {'date': '2022-03-01', 'events': [{'name': 'Event 1'}]},
+            {'date': '2022-03-31', 'events': [{'name': 'Event 2'}]}]})
+
+
+class FinishPastEventsTest(CrmTestCase):
+    """
+    The past events are finished by batches of UPDATE, without their save().
+    """
+    def test_finish(self):
+        self.create_contracts(5)
+        past = list(Event.objects.order_by('id').values_list('id', flat=True)[:3])
+        Event.objects.filter(id__in=past).update(date_event=timezone.now() - timedelta(days=1))
+        with CaptureQueriesContext(connection) as context:
+            call_command('finish_past_events', batch_size=2, stdout=StringIO())
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertEqual(set(Event.objects.filter(finished=True).values_list('id', flat=True)),
+                         set(past))
+        self.assertEqual(Event.finish_past_events(), 0)
+
+
+class HistoryTest(CrmTestCase):
+    """
+    The changes saved are recorded field by field, with their user, once
+    committed.
+    """
+    def test_update(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_contracts(1)
+        contract = Contract.objects.get()
+        other_support = User.objects.create(username='marie', role='SUPPORT')
+        self.login(self.manager)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch('/api/contracts/' + str(contract.id) + '/', {
+                'support': other_support.id, 'seller': self.seller.id,
+                'customer': self.customer.id, 'due': 800}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        entry = HistoryEntry.objects.get(resource='contract', action=HistoryEntry.UPDATE)
+        self.assertEqual(entry.changes, {'support': [self.support.id, other_support.id],
+                                         'due': [1000, 800]})
+        self.assertEqual((entry.user_id, entry.username), (self.manager.id, 'damien'))
+
+        response = self.client.get('/api/contracts/' + str(contract.id) + '/history/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['changes']['due'], [1000, 800])
+        self.assertEqual(response.data['results'][-1]['action'], HistoryEntry.CREATE)
+
+        # The history is only readable by the users who can read the contract.
+        self.login(self.support)
+        response = self.client.get('/api/contracts/' + str(contract.id) + '/history/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.customer.notes = 'Rolled back'
+                    self.customer.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.customer.refresh_from_db()
+            self.customer.delete()
+        entry = HistoryEntry.objects.get()
+        self.assertEqual(entry.action, HistoryEntry.DELETE)
+        self.assertEqual(entry.changes['last_name'], ['Dupont', None])
+
+    def test_reads(self):
+        # The loading keeps nothing, the first save reads the values saved.
+        self.create_contracts(2)
+        contracts = list(Contract.objects.all())
+        self.assertFalse(any(hasattr(contract, 'history_state') for contract in contracts))
+        with self.assertNumQueries(1):
+            contracts[0].load_history_state()
+            contracts[0].load_history_state()
+        self.assertEqual(contracts[0].history_state['due'], 1000)
+
+    def test_request_finished(self):
+        # The entries of a request are written when its response is closed.
+        request = RequestFactory().post('/api/customers/')
+        request.user = self.manager
+
+        def get_response(request):
+            history.current_entries.get().entries.append(
+                HistoryEntry(resource='customer', object_id=self.customer.id,
+                             action=HistoryEntry.UPDATE, changes={}))
+            return HttpResponse()
+
+        response = history.HistoryMiddleware(get_response)(request)
+        self.assertFalse(HistoryEntry.objects.exists())
+        # Like the test client, which keeps the connection of the TestCase.
+        request_finished.disconnect(close_old_connections)
+        try:
+            response.close()
+        finally:
+            request_finished.connect(close_old_connections)
+        self.assertEqual(HistoryEntry.objects.get().resource, 'customer')
+
+
+@override_settings(SYNC_LAG=0)
+class ChangesFeedTest(CrmTestCase):
+    """
+    The changes feeds return what changed since the last sync, and the ids of
+    what was deleted or can't be seen anymore.
+    """
+    def sync(self, resource, since=None, limit=None):
+        params = {}
+        if since != None:
+            params['updated_since'] = since
+        if limit != None:
+            params['limit'] = limit
+        response = self.client.get('/api/' + resource + '/changes/', params)
+        self.assertEqual(response.status_code, 200)
+        pages = [response.data]
+        while pages[-1]['next'] != None:
+            pages.append(self.client.get(pages[-1]['next']).data)
+        return ([row['id'] for page in pages for row in page['results']],
+                [id for page in pages for id in page['deleted']], pages[0]['sync_token'])
+
+    def test_sync(self):
+        self.create_contracts(3)
+        changed, moved, deleted = Contract.objects.order_by('id')
+        other_support = User.objects.create(username='marie', role='SUPPORT')
+        self.login(self.support)
+        ids, removed, token = self.sync('contracts', limit=2)
+        self.assertEqual(ids, [changed.id, moved.id, deleted.id])
+        events_token = self.sync('events')[2]
+
+        self.login(self.manager)
+        self.client.patch('/api/contracts/' + str(changed.id) + '/', {
+            'support': self.support.id, 'seller': self.seller.id,
+            'customer': self.customer.id, 'due': 800}, format='multipart')
+        self.client.patch('/api/contracts/' + str(moved.id) + '/', {
+            'support': other_support.id, 'seller': self.seller.id,
+            'customer': self.customer.id}, format='multipart')
+        deleted_id = deleted.id
+        deleted.delete()
+
+        self.login(self.support)
+        self.assertEqual(self.sync('contracts', token, limit=1)[:2],
+                         ([changed.id], [moved.id, deleted_id]))
+        self.assertEqual(self.sync('events', events_token)[:2],
+                         ([], [moved.event_id, deleted.event_id]))
+        # The customer didn't change, but the new support can see it now.
+        self.login(other_support)
+        self.assertEqual(self.sync('customers', token)[:2], ([self.customer.id], []))
+        self.assertEqual(self.sync('customers', self.sync('customers')[2])[:2], ([], []))
+
+    def test_expired(self):
+        self.login(self.seller)
+        response = self.client.get('/api/customers/changes/', {
+            'updated_since': (timezone.now() - timedelta(days=31)).isoformat()})
+        self.assertEqual(response.status_code, 400)
+        Tombstone.objects.create(resource='customer', object_id=1,
+                                 date_created=timezone.now() - timedelta(days=31))
+        self.assertEqual(Tombstone.prune(30), 1)
+
+
+class WebhookReceiver(BaseHTTPRequestHandler):
+    """
+    Local stand-in of the receivers of the webhooks : answers with the next
+    status of the server, and keeps the requests.
+    """
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((dict(self.headers), json.loads(body)))
+        self.send_response(self.server.statuses.pop(0) if self.server.statuses else 200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class OutboxTest(CrmTestCase):
+    """
+    Signing a contract writes a message in the outbox, delivered later by the
+    outbox_worker command, which retries the failed ones.
+    """
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookReceiver)
+        self.server.received = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%s/hook' % self.server.server_port
+        self.settings = override_settings(OUTBOX_WEBHOOKS=[url])
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sign(self):
+        contract = Contract.objects.create(customer=self.customer, seller=self.seller,
+            support=self.support, due=1000)
+        self.login(self.seller)
+        response = self.client.post('/api/contracts/' + str(contract.id) + '/sign/', {
+            'name': 'Mariage', 'location': 'Lyon',
+            'date_event': (timezone.now() + timedelta(days=10)).isoformat()})
+        self.assertEqual(response.status_code, 201)
+        return contract
+
+    def drain(self):
+        call_command('outbox_worker', once=True, stdout=StringIO())
+
+    def test_sign(self):
+        contract = self.sign()
+        # The request doesn't call the receivers.
+        self.assertEqual(self.server.received, [])
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.topic, 'contract.signed')
+        self.assertEqual(message.payload['contract'], contract.id)
+        self.assertEqual(message.payload['event']['name'], 'Mariage')
+
+        self.drain()
+        headers, payload = self.server.received[0]
+        self.assertEqual(headers['X-Outbox-Id'], str(message.id))
+        self.assertEqual(payload['support'], self.support.id)
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.SENT)
+
+    def test_retry(self):
+        self.sign()
+        self.server.statuses = [503]
+        self.drain()
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts, message.last_error),
+                         (OutboxMessage.PENDING, 1, 'HTTP 503'))
+        self.assertGreater(message.available_at, timezone.now())
+
+        # Once the backoff is over.
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.drain()
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (OutboxMessage.SENT, 2))
+        self.assertEqual([headers['X-Outbox-Attempt'] for headers, payload in self.server.received],
+                         ['1', '2'])
+
+    def test_refused(self):
+        self.sign()
+        self.server.statuses = [400]
+        self.drain()
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (OutboxMessage.FAILED, 1))
+
+
+class AsgiTestCase(TransactionTestCase):
+    """
+    Requests sent to the ASGI application. Its threads have their own
+    connections, so the data must be committed (TransactionTestCase). The
+    connections they keep open are closed at the end of the test, or the test
+    database couldn't be dropped.
+    """
+    def setUp(self):
+        # The threads and connections opened by the requests.
+        self.opened = []
+
+        def on_created(connection, **kwargs):
+            if threading.current_thread() != threading.main_thread():
+                self.opened.append((threading.current_thread(), connection))
+
+        connection_created.connect(on_created, weak=False)
+        self.addCleanup(connection_created.disconnect, on_created)
+        self.addCleanup(self.close_opened)
+
+    def close_opened(self):
+        for thread, wrapper in self.opened:
+            if wrapper.connection is not None:
+                wrapper.connection.close()
+
+    def asgi_get(self, user, path, query=b''):
+        """
+        Returns the status, the body, and the threads which sent
+        request_finished.
+        """
+        headers = [(b'host', b'127.0.0.1')]
+        if user is not None:
+            token = str(RoleTokenObtainPairSerializer.get_token(user).access_token)
+            headers.append((b'authorization', b'Bearer ' + token.encode()))
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                 'method': 'GET', 'scheme': 'http', 'path': path,
+                 'query_string': query, 'root_path': '',
+                 'server': ('127.0.0.1', 80), 'client': ('127.0.0.1', 5000),
+                 'headers': headers}
+        messages = []
+        finished = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        def on_finished(**kwargs):
+            finished.append(threading.current_thread())
+
+        request_finished.connect(on_finished)
+        try:
+            async_to_sync(application)(scope, receive, send)
+        finally:
+            request_finished.disconnect(on_finished)
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], body, finished
+
+
+class AsgiExportTest(AsgiTestCase):
+    """
+    Under ASGI, an export is read on the thread of the request, with its own
+    connection, and the request must end like the others, with
+    request_finished.
+    """
+    def test_export(self):
+        manager = User.objects.create(username='damien', role='MANAGER')
+        Customer.objects.create(last_name='Dupont', compagny_name='Dupont SA',
+                                email='dupont@example.com')
+        status, body, finished = self.asgi_get(manager, '/api/customers/export/', b'output=csv')
+        self.assertEqual(status, 200)
+        self.assertIn(b'Dupont SA', body)
+        self.assertEqual(len(finished), 1)
+
+
+class AsgiReadTest(AsgiTestCase):
+    """
+    Under ASGI, the list and retrieve routes are run in the pool of threads of
+    asgiref (crm/async_views.py) : same permissions and visibility than the
+    sync views, and the connection of the pool thread is checked at the end
+    like Django does for a request : closed once older than CONN_MAX_AGE.
+    """
+    def setUp(self):
+        super().setUp()
+        self.seller = User.objects.create(username='jamy', role='SELLER')
+        self.support = User.objects.create(username='francois', role='SUPPORT')
+        other_seller = User.objects.create(username='fred', role='SELLER')
+        self.customer = Customer.objects.create(last_name='Dupont', compagny_name='Dupont SA',
+                                                email='dupont@example.com', seller=self.seller)
+        self.other_customer = Customer.objects.create(
+            last_name='Martin', compagny_name='Martin SA',
+            email='martin@example.com', seller=other_seller)
+        self.contract = Contract.objects.create(customer=self.customer, seller=self.seller,
+                                                support=self.support, due=1000)
+        self.other_contract = Contract.objects.create(
+            customer=self.other_customer, seller=other_seller, due=500)
+
+    def get_ids(self, user, path):
+        status, body, finished = self.asgi_get(user, path)
+        self.assertEqual(status, 200, path)
+        return [row['id'] for row in json.loads(body)['results']]
+
+    def test_visibility(self):
+        self.assertEqual(self.get_ids(self.seller, '/api/customers/'), [self.customer.id])
+        self.assertEqual(self.get_ids(self.seller, '/api/contracts/'), [self.contract.id])
+        self.assertEqual(self.get_ids(self.support, '/api/customers/'), [self.customer.id])
+
+        status, body, finished = self.asgi_get(
+            self.seller, '/api/contracts/' + str(self.contract.id) + '/')
+        self.assertEqual((status, json.loads(body)['due']), (200, 1000))
+        status, body, finished = self.asgi_get(
+            self.seller, '/api/contracts/' + str(self.other_contract.id) + '/')
+        self.assertEqual(status, 404)
+        status, body, finished = self.asgi_get(None, '/api/customers/')
+        self.assertEqual(status, 401)
+
+    def test_connection_closed(self):
+        # Read when the connection is opened.
+        with mock.patch.dict(connection.settings_dict, {'CONN_MAX_AGE': 0}):
+            ids = self.get_ids(self.seller, '/api/customers/')
+        self.assertEqual(ids, [self.customer.id])
+        self.assertTrue(self.opened)
+        for thread, wrapper in self.opened:
+            self.assertIsNone(wrapper.connection, thread.name)
+
+
+class SequentialScanTest(TestCase):
+    """
+    On a large dataset, the scoped and filtered list routes must be served by
+    indexes. The queries of each route are planned with the sequential scans
+    disabled, so the result doesn't depend on the size of the test tables : the
+    planner still reads every row of a table (sequential scan, or full index
+    scan with a filter) only if no index matches the query.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_crm', events=10000, stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.manager = User.objects.filter(role='MANAGER').first()
+        cls.seller = User.objects.filter(role='SELLER').first()
+        cls.support = User.objects.filter(role='SUPPORT').first()
+        cls.customer = Customer.objects.first()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.used_indexes = set()
+
+    def index_names(self, node):
+        for child in node.get('Plans', []):
+            yield from self.index_names(child)
+        if 'Index Name' in node:
+            yield node['Index Name']
+
+    def full_scans(self, node):
+        """
+        Yields the crm tables of the plan read without an index condition.
+        """
+        for child in node.get('Plans', []):
+            yield from self.full_scans(child)
+        if node.get('Relation Name', '').startswith('crm_'):
+            if node['Node Type'] == 'Seq Scan' or (
+                    'Filter' in node and 'Index Cond' not in node and 'Recheck Cond' not in node):
+                yield node['Relation Name']
+
+    def assert_no_seq_scan(self, user, url):
+        self.client.force_authenticate(user=user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in context.captured_queries:
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + query['sql'])
+                plan = cursor.fetchone()[0][0]['Plan']
+                cursor.execute('RESET enable_seqscan')
+            self.used_indexes.update(self.index_names(plan))
+            self.assertEqual(list(self.full_scans(plan)), [], url + '\n' + query['sql'])
+
+    def test_seller_routes(self):
+        for url in ['/api/customers/', '/api/contracts/', '/api/events/',
+                    '/api/contracts/?due_low=1000&due_high=2000',
+                    '/api/events/?finished=false']:
+            self.assert_no_seq_scan(self.seller, url)
+
+    def test_support_routes(self):
+        for url in ['/api/customers/', '/api/contracts/', '/api/events/',
+                    '/api/customers/' + str(self.customer.id) + '/contracts/']:
+            self.assert_no_seq_scan(self.support, url)
+
+    def test_search(self):
+        """
+        The fuzzy search reads the trigram indexes of the customers.
+        """
+        self.assert_no_seq_scan(self.manager, '/api/customers/?search=Custmer123')
+        self.assertTrue({'customer_last_name_trgm_idx', 'customer_compagny_trgm_idx',
+                         'customer_email_trgm_idx'} <= self.used_indexes)
+
+    def test_manager_routes(self):
+        customer = str(self.customer.id)
+        for url in ['/api/users/' + str(self.seller.id) + '/contracts/',
+                    '/api/users/' + str(self.support.id) + '/events/',
+                    '/api/users/' + str(self.support.id) + '/customers/',
+                    '/api/customers/' + customer + '/contracts/',
+                    '/api/customers/' + customer + '/events/',
+                    '/api/contracts/?due_low=1000&due_high=1500',
+                    '/api/contracts/?signed=false&pagination=cursor',
+                    '/api/customers/?last_name=customer123',
+                    '/api/contracts/?pagination=cursor']:
+            self.assert_no_seq_scan(self.manager, url)
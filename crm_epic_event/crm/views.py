@@ -1,27 +1,51 @@
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
 from django.shortcuts import get_object_or_404
-from rest_framework.exceptions import NotFound, PermissionDenied
-from django.db.models import Q
-from rest_framework.viewsets import ModelViewSet
-from datetime import datetime
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date
+from django.db.models import Count, Max, Q
+from django.db.models.functions import Greatest, TruncDate, Upper
+from django.contrib.postgres.search import TrigramSimilarity
+from rest_framework.viewsets import GenericViewSet, ModelViewSet
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+from datetime import datetime, time, timedelta
+from itertools import groupby
+import csv
+import hashlib
+import json
 import pytz
-from rest_framework_simplejwt.authentication import JWTAuthentication
+import re
 from rest_framework.permissions import IsAuthenticated
 from crm import permissions
+from crm.pagination import CursorOrOffsetPagination
+from crm.parsers import CSVParser
+from crm.renderers import FastJSONRenderer
 
 from crm import serializers, models
 from users.models import User as MODEL_USER
+from users.authentication import StatelessJWTAuthentication
 
 class CheckPathMixin:
     """
-    Commun methods.
+    Commun methods. The route is read from its kwargs : user_pk on the /users/
+    extentions, customer_pk on the /customers/ ones and contract_pk on /sign/.
     """
     def check_path_user(self):
         """
         If the user try to access special methods through the /users/
         endpoint, it returns an error.
         """
-        elements_path = self.request.get_full_path().split('/')
-        if 'users' == elements_path[2]:
+        if 'user_pk' in self.kwargs:
             message = 'Method not allowed with this path'
             raise PermissionDenied(message, code=403)
 
@@ -30,8 +54,7 @@ class CheckPathMixin:
         If the user try to access special methods through the /customer/
         endpoint, it returns an error.
         """
-        elements_path = self.request.get_full_path().split('/')
-        if 'users' == elements_path[2] or 'customers' == elements_path[2]:
+        if 'user_pk' in self.kwargs or 'customer_pk' in self.kwargs:
             message = 'Method not allowed with this path'
             raise PermissionDenied(message, code=403)
     
@@ -40,22 +63,533 @@ class CheckPathMixin:
         If the user try to do anything else than sign with the /sign/
         endpoint, it returns an error.
         """
+        if 'contract_pk' in self.kwargs and self.request.method != 'POST':
+            message = 'Method not allowed'
+            raise PermissionDenied(message, code=403)
+
+    def get_path_user(self, message):
+        """
+        The user of the /users/ extentions, which only a MANAGER can access.
+        A manager is in charge of nothing, the message explains it.
+        """
+        if self.request.user.role != 'MANAGER':
+            message_denied = 'You are not authorized to perform this action'
+            raise PermissionDenied(message_denied, code=403)
+        user = get_object_or_404(MODEL_USER, id=self.kwargs['user_pk'])
+        if user.role == 'MANAGER':
+            raise NotFound(detail=message, code=404)
+        return user
+
+    def visible_queryset(self, model, message):
+        """
+        The instances of the model the route shows, through visible_to(). On
+        the /users/ extentions, the ones the user of the path can see.
+        """
+        if 'user_pk' in self.kwargs:
+            return model.objects.visible_to(self.get_path_user(message))
+        if 'customer_pk' in self.kwargs:
+            customer = get_object_or_404(models.Customer, id=self.kwargs['customer_pk'])
+            return model.objects.visible_to(self.request.user, customer)
+        return model.objects.visible_to(self.request.user)
+
+
+class BulkImportMixin:
+    """
+    Creation of many instances in one request, from a JSON array or a CSV file.
+    Every row is validated first. If one of them is invalid, nothing is created
+    and the errors of each invalid row are returned.
+    """
+    import_serializer_class = None
+    import_batch_size = 1000
+
+    def get_import_rows(self):
+        rows = self.request.data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValidationError('Expected a JSON array of objects, or a CSV file')
+        return rows
+
+    def validate_import_rows(self, rows):
+        """
+        Returns the validated data and the errors, indexed by row.
+        The same serializer validates all the rows, so its fields are only
+        built once.
+        """
+        serializer = self.import_serializer_class()
+        validated_rows = {}
+        errors = {}
+        for index, row in enumerate(rows):
+            try:
+                validated_rows[index] = serializer.run_validation(row)
+            except ValidationError as e:
+                errors[index] = e.detail
+        return validated_rows, errors
+
+    def add_import_error(self, errors, index, field, message):
+        errors.setdefault(index, {}).setdefault(field, []).append(message)
+
+    def fetch_import_related(self, rows, field, model, errors, role=None, required=False):
+        """
+        Fetches, in one query, the instances the rows point to with the field.
+        If a role is given, the users must have that role.
+        Returns the instances indexed by row.
+        """
+        ids = {}
+        for index, row in enumerate(rows):
+            value = row.get(field)
+            if value is None or value == '':
+                if required:
+                    self.add_import_error(errors, index, field, 'This field is required.')
+                continue
+            try:
+                ids[index] = int(value)
+            except (TypeError, ValueError):
+                self.add_import_error(errors, index, field, 'A valid integer is required.')
+
+        instances = model.objects.in_bulk(set(ids.values()))
+        related = {}
+        for index, pk in ids.items():
+            instance = instances.get(pk)
+            if instance is None:
+                self.add_import_error(errors, index, field, 'Not found.')
+            elif role is not None and instance.role != role:
+                self.add_import_error(errors, index, field,
+                    'The ' + field + ' selected is not ' + role)
+            else:
+                related[index] = instance
+        return related
+
+    def import_errors_response(self, errors):
+        return Response({'errors': [
+            {'row': index, 'errors': errors[index]} for index in sorted(errors)
+        ]}, status=400)
+
+
+class EchoBuffer:
+    """
+    Gives back what the csv writer writes, so the rows can be streamed.
+    """
+    def write(self, value):
+        return value
+
+
+class ExportMixin:
+    """
+    Export of a whole list, with the same queryset than the list action (so the
+    same security and filters), in CSV or NDJSON.
+    The instances are read from a server-side cursor, chunk by chunk, and the
+    file is streamed row by row : the memory used doesn't depend on the number
+    of instances exported. ?fields= limits the columns, like on the lists (see
+    SparseFieldsMixin).
+    """
+    export_chunk_size = 2000
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        """
+        GET .../export/?output=csv (default) or ?output=ndjson
+        """
+        output = request.query_params.get('output', 'csv')
+        if output != 'csv' and output != 'ndjson':
+            raise ValidationError('output must be csv or ndjson')
+
+        queryset = self.get_queryset()
+        fields = self.get_sparse_fields(self.detail_serializer_class)
+        if fields != None:
+            queryset = self.project_queryset(queryset, fields)
+        serializer = self.detail_serializer_class(fields=fields)
+        instances = queryset.iterator(chunk_size=self.export_chunk_size)
+        rows = (serializer.to_representation(instance) for instance in instances)
+        if output == 'csv':
+            response = StreamingHttpResponse(
+                self.stream_csv(list(serializer.fields), rows), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(
+                self.stream_ndjson(rows), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            serializer.Meta.model._meta.verbose_name_plural, output)
+        return response
+
+    def stream_csv(self, fields, rows):
+        writer = csv.writer(EchoBuffer())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([row[field] for field in fields])
+
+    def stream_ndjson(self, rows):
+        for row in rows:
+            yield json.dumps(row, cls=JSONEncoder) + '\n'
+
+
+class ConditionalGetMixin:
+    """
+    Conditional GET on the list and detail actions. Before serializing
+    anything, a validator is computed : the number of instances and the last
+    date_updated of the list (one aggregate query, whose count is reused by the
+    pagination), or the date_updated of the instance. If the client already has
+    that version (If-None-Match or If-Modified-Since), a 304 is returned.
+    The date_updated of the instances displayed with each row (ex: the customer
+    of a contract) are listed in validator_related_fields.
+    If-Modified-Since doesn't see the deleted instances, the ETag does.
+    The lists of a SELLER or a SUPPORT member also change when their
+    visibility rows do : the last date_created of the rows joined is added.
+    With ?pagination=cursor, whose point is to never count the list, there is
+    no validator.
+    """
+    validator_related_fields = []
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.paginator.use_cursor(request):
+            return self.render_list(queryset)
+        dates = {'date_updated': Max('date_updated')}
+        for field in self.validator_related_fields:
+            dates[field] = Max(field)
+        if self.is_scoped():
+            # Reuses the join of visible_to() on the visibility rows of the user.
+            dates['visibilities__date_created'] = Max('visibilities__date_created')
+        validator = queryset.order_by().aggregate(count=Count('id'), **dates)
+        count = validator.pop('count')
+        self.paginator.known_count = count
+        last_modified = max([date for date in validator.values() if date != None], default=None)
+
+        def render():
+            return self.render_list(queryset)
+
+        return self.conditional_response(render, last_modified, count)
+
+    def is_scoped(self):
+        """
+        True if the list is read through visibility rows : the ones of a
+        SELLER or a SUPPORT member, or of the user of a /users/ extention.
+        """
+        return ('user_pk' in self.kwargs or self.request.user.role == 'SELLER'
+                or self.request.user.role == 'SUPPORT')
+
+    def render_list(self, queryset):
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(queryset, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        dates = [instance.date_updated]
+        for field in self.validator_related_fields:
+            related = instance
+            for name in field.split('__'):
+                related = getattr(related, name) if related != None else None
+            dates.append(related)
+        last_modified = max([date for date in dates if date != None])
+
+        def render():
+            return Response(self.get_serializer(instance).data)
+
+        return self.conditional_response(render, last_modified, instance.id)
+
+    def conditional_response(self, render, last_modified, *validator):
+        """
+        The ETag depends on the user too, since two users can see different
+        instances on the same url.
+        """
+        user = self.request.user
+        key = [user.id, user.role, self.request.get_full_path(),
+               self.request.accepted_renderer.format, last_modified, *validator]
+        etag = '"%s"' % hashlib.md5(repr(key).encode()).hexdigest()
+        timestamp = int(last_modified.timestamp()) if last_modified != None else None
+
+        response = get_conditional_response(self.request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = render()
+        response['ETag'] = etag
+        if timestamp != None:
+            response['Last-Modified'] = http_date(timestamp)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+        return response
+
+
+class SparseFieldsMixin:
+    """
+    ?fields=id,name on the lists, the details and the exports : only those
+    fields are serialized, and only their columns are read, with .only(). The
+    instances displayed by the contracts (customer, event...) are only joined
+    if their field is asked.
+    """
+    sparse_fields_param = 'fields'
+
+    def get_sparse_fields(self, serializer_class=None):
+        """
+        The asked fields, None if the whole serializer is returned.
+        """
+        value = self.request.query_params.get(self.sparse_fields_param)
+        if value == None or value == '' or self.request.method != 'GET':
+            return None
+        serializer_class = serializer_class or self.get_serializer_class()
+        fields = [name.strip() for name in value.split(',') if name.strip() != '']
+        unknown = [name for name in fields if name not in serializer_class.Meta.fields]
+        if unknown:
+            raise ValidationError({self.sparse_fields_param: 'Unknown fields: %s. Available fields: %s' % (
+                ', '.join(unknown), ', '.join(serializer_class.Meta.fields))})
+        return fields
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action == 'list' or self.action == 'retrieve':
+            kwargs.setdefault('fields', self.get_sparse_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action == 'list' or self.action == 'retrieve':
+            fields = self.get_sparse_fields()
+            if fields != None:
+                queryset = self.project_queryset(queryset, fields)
+        return queryset
+
+    def project_queryset(self, queryset, fields):
+        """
+        Only the columns of the fields, and the ones the pagination and the
+        conditional GET read (id, date_created, date_updated). The relations of
+        select_related are kept if their field is asked, or if the validator of
+        the detail reads them.
+        """
+        columns = {'id', 'date_created', 'date_updated'}
+        for name in fields:
+            try:
+                field = queryset.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.concrete:
+                columns.add(name)
+
+        select_related = queryset.query.select_related
+        if isinstance(select_related, dict):
+            needed = set(fields)
+            if self.action == 'retrieve':
+                needed.update(field.split('__')[0]
+                              for field in getattr(self, 'validator_related_fields', []))
+            kept = [name for name in select_related if name in needed]
+            queryset = queryset.select_related(None)
+            queryset = queryset.select_related(*kept) if kept else queryset
+            columns.update(kept)
+        return queryset.only(*columns)
+
+
+class DateRangeMixin:
+    """
+    ?<prefix>_from= and ?<prefix>_to= filters for each date column of
+    date_range_fields, ex: ?date_from=2022-03-01&date_to=2022-03-31. The
+    column is compared as it is, so its btree index can be used (the former
+    ?date= cast each date to text to search it).
+    The bounds are a date, or a date and a time (2022-03-01T14:00), in the
+    timezone of the server. date_to is included : a date ends the next day at
+    midnight.
+    """
+    date_range_fields = {}
+
+    def parse_date_param(self, name):
+        """
+        The moment given by the param, and whether it is a whole day.
+        """
+        value = self.request.query_params.get(name)
+        if value == None or value == '':
+            return None
+        try:
+            day = parse_date(value)
+            moment = parse_datetime(value) if day is None else None
+        except ValueError:
+            moment = day = None
+        if moment is None and day is None:
+            raise ValidationError({name: 'Expected a date (YYYY-MM-DD) or a date and a time '
+                                         '(YYYY-MM-DDTHH:MM)'})
+        if day != None:
+            moment = datetime.combine(day, time.min)
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment, day != None
+
+    def filter_date_range(self, queryset):
+        for prefix, column in self.date_range_fields.items():
+            start = self.parse_date_param(prefix + '_from')
+            end = self.parse_date_param(prefix + '_to')
+            if start != None:
+                queryset = queryset.filter(**{column + '__gte': start[0]})
+            if end != None and end[1]:
+                queryset = queryset.filter(**{column + '__lt': end[0] + timedelta(days=1)})
+            elif end != None:
+                queryset = queryset.filter(**{column + '__lte': end[0]})
+        return queryset
+
+    def filter_date_prefix(self, queryset, column, value):
+        """
+        The former ?date= : a year, a month (2022-03) or a day (2022-03-01)
+        is turned into a range on the column. Other values are still searched
+        in the text of the dates.
+        """
+        match = re.fullmatch(r'(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?', value)
         try:
-            elements_path = self.request.get_full_path().split('/')
-            if 'sign' == elements_path[4]:
-                if self.request.method != 'POST':
-                    message = 'Method not allowed'
-                    raise PermissionDenied(message, code=403)
-        except:
-            pass
-
-class CustomerViewset(CheckPathMixin, ModelViewSet):
+            year, month, day = [int(part) if part != None else None for part in match.groups()]
+            start = datetime(year, month or 1, day or 1)
+            if day != None:
+                end = start + timedelta(days=1)
+            elif month != None:
+                end = (start + timedelta(days=32)).replace(day=1)
+            else:
+                end = start.replace(year=year + 1)
+        except (AttributeError, ValueError, OverflowError):
+            return queryset.filter(**{column + '__icontains': value})
+        return queryset.filter(**{column + '__gte': timezone.make_aware(start),
+                                  column + '__lt': timezone.make_aware(end)})
+
+
+class HistoryMixin:
+    """
+    GET .../<pk>/history/ : the changes of an instance, the most recent first
+    (paginated). The instance is fetched like for the detail, so the same
+    users can read it.
+    """
+    @action(detail=True, methods=['get'])
+    def history(self, request, *args, **kwargs):
+        instance = self.get_object()
+        entries = models.HistoryEntry.objects.filter(
+            resource=instance.history_resource, object_id=instance.id).order_by('-id')
+        page = self.paginate_queryset(entries)
+        if page is not None:
+            return self.get_paginated_response(
+                serializers.HistoryEntrySerializer(page, many=True).data)
+        return Response(serializers.HistoryEntrySerializer(entries, many=True).data)
+
+
+class ChangesFeedMixin:
+    """
+    GET .../changes/?updated_since=<date> : the incremental sync of the apps.
+    Returns the instances changed after updated_since, or that the user can
+    see since then, with the detail serializer (?fields= accepted), and the
+    ids of the ones deleted or that he can't see anymore (deleted). Each of
+    them is read from an index by date : the cost depends on what changed,
+    not on the number of instances visible. Without updated_since, all the
+    visible instances are returned.
+    The pages are cut by id, follow next until it is null, then keep
+    sync_token as the updated_since of the next sync. The filters of the list
+    don't apply. The window ends SYNC_LAG seconds ago, so the transactions
+    still running (their date_updated is older than their commit) are seen
+    by the next sync.
+    """
+    changes_page_size = 500
+    changes_max_page_size = 5000
+    # The relations of the detail serializer, joined.
+    changes_related = []
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request, *args, **kwargs):
+        self.check_path_user_customer()
+        model = self.detail_serializer_class.Meta.model
+        since = self.parse_sync_date('updated_since')
+        until = self.parse_sync_date('until')
+        until = until if until != None else timezone.now() - timedelta(seconds=settings.SYNC_LAG)
+        after = self.parse_sync_int('after', 0)
+        limit = min(self.parse_sync_int('limit', self.changes_page_size), self.changes_max_page_size)
+        if since != None and since < timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS):
+            raise ValidationError({'updated_since': 'Older than the tombstones kept (%s days), '
+                'sync again without updated_since' % settings.SYNC_TOMBSTONE_DAYS})
+
+        visible = self.fetch_queryset()
+        # The limit + 1 first ids of each source : the limit first of their union
+        # are all there, and there is a next page if it has more.
+        if since == None:
+            sources = [visible]
+            tombstones = set()
+        else:
+            sources = [visible.filter(date_updated__gt=since, date_updated__lte=until),
+                       model.objects.granted_to(request.user, since, until)]
+            tombstones = set(models.Tombstone.objects.filter(
+                Q(user=request.user) | Q(user=None), resource=model.history_resource,
+                date_created__gt=since, date_created__lte=until, object_id__gt=after
+            ).order_by('object_id').values_list('object_id', flat=True).distinct()[:limit + 1])
+        ids = set(tombstones)
+        for queryset in sources:
+            ids.update(queryset.filter(id__gt=after).order_by('id'
+                ).values_list('id', flat=True)[:limit + 1])
+        page = sorted(ids)[:limit]
+
+        fields = self.get_sparse_fields(self.detail_serializer_class)
+        queryset = visible.filter(id__in=page).order_by('id')
+        if self.changes_related:
+            queryset = queryset.select_related(*self.changes_related)
+        if fields != None:
+            queryset = self.project_queryset(queryset, fields)
+        instances = list(queryset)
+        shown = {instance.id for instance in instances}
+
+        next_url = None
+        if len(ids) > limit:
+            next_url = request.build_absolute_uri()
+            next_url = replace_query_param(next_url, 'until', self.format_sync_date(until))
+            next_url = replace_query_param(next_url, 'after', page[-1])
+        return Response({
+            'results': self.detail_serializer_class(instances, many=True, fields=fields).data,
+            'deleted': [id for id in page if id in tombstones and id not in shown],
+            'next': next_url,
+            'sync_token': self.format_sync_date(until)
+        })
+
+    def parse_sync_date(self, name):
+        value = self.request.query_params.get(name)
+        if value == None or value == '':
+            return None
+        moment = parse_datetime(value)
+        if moment == None:
+            raise ValidationError({name: 'Must be a date and time, ex: 2022-03-31T12:00:00Z'})
+        return moment if timezone.is_aware(moment) else timezone.make_aware(moment)
+
+    def parse_sync_int(self, name, default):
+        value = self.request.query_params.get(name)
+        if value == None or value == '':
+            return default
+        if not value.isdigit() or int(value) == 0:
+            raise ValidationError({name: 'Must be a positive integer'})
+        return int(value)
+
+    def format_sync_date(self, moment):
+        return moment.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class ValuesListMixin:
+    """
+    Fast path of the lists in JSON. The page is read with .values() and its
+    rows are built by the list serializer (rows_from_values) instead of its
+    fields, then rendered with orjson. The output is the same, byte for byte.
+    The browsable API keeps the serializers.
+    """
+    values_list = True
+
+    def render_list(self, queryset):
+        serializer_class = self.get_serializer_class()
+        if (not self.values_list or self.request.accepted_renderer.format != 'json'
+                or not getattr(serializer_class, 'values_fields', None)):
+            return super().render_list(queryset)
+
+        fields = self.get_sparse_fields()
+        # The cursor pagination reads the date_created of the rows.
+        columns = serializer_class.get_values_columns(fields)
+        columns += [column for column in ['date_created', 'id'] if column not in columns]
+        queryset = queryset.values(*columns)
+        page = self.paginate_queryset(queryset)
+        rows = serializer_class.rows_from_values(page if page is not None else queryset, fields)
+        self.request.accepted_renderer = FastJSONRenderer()
+        if page is not None:
+            return self.get_paginated_response(rows)
+        return Response(rows)
+
+
+class CustomerViewset(CheckPathMixin, ValuesListMixin, ConditionalGetMixin, SparseFieldsMixin, BulkImportMixin, ExportMixin, HistoryMixin, ChangesFeedMixin, ModelViewSet):
     serializer_class = serializers.CustomerListSerializer
     detail_serializer_class = serializers.CustomerDetailSerializer
+    import_serializer_class = serializers.CustomerImportSerializer
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated,
                     permissions.CustomerPermissions]
+    pagination_class = CursorOrOffsetPagination
 
     def fetch_queryset(self):
         """
@@ -65,42 +599,12 @@ class CustomerViewset(CheckPathMixin, ModelViewSet):
         A MANAGER can pretty much see everything, but a SELLER can only see the customers
         he is in charge of, and a SUPPORT member can only see the customer he is related
         with throungh a contract.
+        Those customers are precomputed in the CustomerVisibility table.
         """
-        elements_path = self.request.get_full_path().split('/')
-        current_user = self.request.user
-        is_manager = current_user.role == 'MANAGER'
-
-        if 'users' == elements_path[2]:
-            if is_manager:
-                user = get_object_or_404(MODEL_USER, id=self.kwargs['user_pk'])
-                if user.role == 'MANAGER':
-                    message = 'This user is manager, therefore he is in charge of no customer'
-                    raise NotFound(detail=message, code=404)
-                elif user.role == 'SELLER':
-                    return models.Customer.objects.filter(seller=user)
-                elif user.role == 'SUPPORT':
-                    customers_list = models.Contract.objects.filter(
-                                support=user).values('customer')
-                    return models.Customer.objects.filter(
-                                id__in=customers_list)
-            else:
-                """
-                Only a MANAGER can access the /users/ endpoint and his extentions.
-                """
-                message = 'You are not authorized to perform this action'
-                raise PermissionDenied(message, code=403)
-        else:
-            if is_manager:
-                return models.Customer.objects.all()
-            elif current_user.role == 'SELLER':
-                return models.Customer.objects.filter(seller=current_user)
-            elif current_user.role == 'SUPPORT':
-                customers_list = models.Contract.objects.filter(
-                            support=current_user).values('customer')
-                return models.Customer.objects.filter(id__in=customers_list)
+        message = 'This user is manager, therefore he is in charge of no customer'
+        return self.visible_queryset(models.Customer, message)
     
     def get_queryset(self):
-        print(self.request.user.id)
         queryset = self.fetch_queryset()
         last_name = self.request.query_params.get('last_name')
         compagny_name = self.request.query_params.get('compagny_name')
@@ -113,14 +617,46 @@ class CustomerViewset(CheckPathMixin, ModelViewSet):
         queryset = queryset.filter(email__icontains=email
                             ) if email != None and email != '' else queryset
 
+        search = self.request.query_params.get('search')
+        queryset = self.search(queryset, search
+                            ) if search != None and search != '' else queryset
+
         return queryset
 
+    def search(self, queryset, search):
+        """
+        Fuzzy search on the name, the compagny and the email of the customers.
+        The customers close to the searched words (typos included) are returned,
+        the best matches first. The trigram indexes on those fields are used.
+        The keyset pagination orders by date, not by relevance : with a search,
+        it is refused, the pages use limit and offset.
+        """
+        if self.action == 'list' and self.paginator.use_cursor(self.request):
+            raise ValidationError({'pagination': 'The search is ordered by relevance, '
+                'it can only be paginated with limit and offset'})
+        search = search.upper()
+        queryset = queryset.alias(
+            upper_last_name=Upper('last_name'),
+            upper_compagny_name=Upper('compagny_name'),
+            upper_email=Upper('email')
+        ).filter(
+            Q(upper_last_name__trigram_similar=search)
+            | Q(upper_compagny_name__trigram_similar=search)
+            | Q(upper_email__trigram_similar=search))
+        return queryset.annotate(rank=Greatest(
+            TrigramSimilarity('upper_last_name', search),
+            TrigramSimilarity('upper_compagny_name', search),
+            TrigramSimilarity('upper_email', search)
+        )).order_by('-rank', 'id')
+
     def get_serializer_class(self):
         if (self.action == 'retrieve' or self.action == 'create'
                 or self.action == 'update' or self.action == 'partial_update'):
             return self.detail_serializer_class
         if self.action == 'list':
             return super().get_serializer_class()
+        if self.action == 'bulk_import':
+            return self.import_serializer_class
     
     def perform_create(self, serializer):
         """
@@ -142,14 +678,51 @@ class CustomerViewset(CheckPathMixin, ModelViewSet):
         self.check_path_user()
         return super().perform_destroy(instance)
 
+    @action(detail=False, methods=['post'], url_path='import',
+            parser_classes=[JSONParser, CSVParser])
+    def bulk_import(self, request, *args, **kwargs):
+        """
+        Creates many customers at once, only from the /customers/ endpoint.
+        A SELLER is in charge of all the customers he imports, a MANAGER can
+        choose the seller of each row.
+        """
+        self.check_path_user()
+        rows = self.get_import_rows()
+        validated_rows, errors = self.validate_import_rows(rows)
+        is_seller = request.user.role == 'SELLER'
+        sellers = {} if is_seller else self.fetch_import_related(
+                    rows, 'seller', MODEL_USER, errors)
+
+        customers = []
+        for index, data in validated_rows.items():
+            if not models.Customer.is_identifiable(
+                    data.get('last_name'), data.get('compagny_name')):
+                self.add_import_error(errors, index, 'non_field_errors',
+                    models.Customer.IDENTITY_ERROR)
+            seller = request.user if is_seller else sellers.get(index)
+            customers.append(models.Customer(seller=seller, **data))
+        if errors:
+            return self.import_errors_response(errors)
+
+        with transaction.atomic():
+            customers = models.Customer.objects.bulk_create(
+                customers, batch_size=self.import_batch_size)
+            models.CustomerVisibility.add_customers(customers)
+        return Response({'created': len(customers)}, status=201)
+
 
-class ContractViewset(CheckPathMixin, ModelViewSet):
+class ContractViewset(CheckPathMixin, ValuesListMixin, ConditionalGetMixin, SparseFieldsMixin, DateRangeMixin, BulkImportMixin, ExportMixin, HistoryMixin, ChangesFeedMixin, ModelViewSet):
     serializer_class = serializers.ContractListSerializer
     detail_serializer_class = serializers.ContractDetailSerializer
+    import_serializer_class = serializers.ContractImportSerializer
+    validator_related_fields = ['customer__date_updated', 'event__date_updated']
+    date_range_fields = {'date': 'date_created', 'signed': 'date_signed'}
+    changes_related = ['customer', 'support', 'seller', 'event']
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated,
                     permissions.ContractPermissions]
+    pagination_class = CursorOrOffsetPagination
 
     def fetch_queryset(self):
         """
@@ -162,38 +735,11 @@ class ContractViewset(CheckPathMixin, ModelViewSet):
         that points to them.
         Same logic if the contracts are fetched withe the contract url, except that the contracts
         are not related to a customer anymore.
+        The contracts of a SELLER or SUPPORT are precomputed in the ContractVisibility table.
         """
-        elements_path = self.request.get_full_path().split('/')
         self.check_path_sign()
-        current_user = self.request.user
-        is_manager = current_user.role == 'MANAGER'
-
-        if 'users' == elements_path[2]:
-            if is_manager:
-                user = get_object_or_404(MODEL_USER, id=self.kwargs['user_pk'])
-                if user.role == 'MANAGER':
-                    message = 'This user is manager, therefore he is in charge of no customer'
-                    raise NotFound(detail=message, code=404)
-                else:
-                    return models.Contract.objects.filter(Q(seller=user) | Q(support=user))
-            else:
-                message = 'You are not authorized to perform this action'
-                raise PermissionDenied(message, code=403)
-        
-        elif 'customers' == elements_path[2]:
-            customer = get_object_or_404(models.Customer,
-                            id=self.kwargs['customer_pk'])
-            if is_manager:
-                return models.Contract.objects.filter(customer=customer)
-            else:
-                return models.Contract.objects.filter(
-                    Q(customer=customer) & (Q(seller=current_user) | Q(support=current_user)))    
-        
-        else:
-            if is_manager:
-                return models.Contract.objects.all()
-            else:
-                return models.Contract.objects.filter(Q(seller=current_user) | Q(support=current_user))
+        message = 'This user is manager, therefore he is in charge of no customer'
+        return self.visible_queryset(models.Contract, message)
 
     def get_queryset(self):
         queryset = self.fetch_queryset()
@@ -202,18 +748,24 @@ class ContractViewset(CheckPathMixin, ModelViewSet):
         date = self.request.query_params.get('date')
         due_low = self.request.query_params.get('due_low')
         due_high = self.request.query_params.get('due_high')
+        signed = self.request.query_params.get('signed')
 
         queryset = queryset.filter(customer__last_name__icontains=last_name
                             ) if last_name != None and last_name != '' else queryset
         queryset = queryset.filter(customer__compagny_name__icontains=compagny_name
                             ) if compagny_name != None and compagny_name != '' else queryset
-        queryset = queryset.filter(date_created__icontains=date
+        queryset = self.filter_date_prefix(queryset, 'date_created', date
                             ) if date != None and date != '' else queryset
+        queryset = self.filter_date_range(queryset)
         queryset = queryset.filter(due__gt=float(due_low)
                             ) if due_low != None and due_low != '' else queryset
         queryset = queryset.filter(due__lt=float(due_high)
                             ) if due_high != None and due_high != '' else queryset
-        return queryset
+        queryset = queryset.filter(signed=signed == 'true'
+                            ) if signed == 'true' or signed == 'false' else queryset
+        # The serializers display the customer, the users and the event of each
+        # contract, so they are joined here instead of fetched row by row.
+        return queryset.select_related('customer', 'support', 'seller', 'event')
     
     def get_serializer_class(self):
         if (self.action == 'retrieve' or self.action == 'create'
@@ -221,6 +773,8 @@ class ContractViewset(CheckPathMixin, ModelViewSet):
             return self.detail_serializer_class
         if self.action == 'list':
             return super().get_serializer_class()
+        if self.action == 'bulk_import':
+            return self.import_serializer_class
     
     def perform_create(self, serializer):
         """
@@ -239,43 +793,86 @@ class ContractViewset(CheckPathMixin, ModelViewSet):
             or 'seller' not in self.request.POST):
                 message = 'Missing fields (support, customer or seller)'
                 raise PermissionDenied(message, code=403)
-            seller = self.check_role('SELLER')
+            users = self.check_roles(['SELLER', 'SUPPORT'])
+            seller = users['SELLER']
         
         if self.request.user.role == 'SELLER':
+            if 'support' not in self.request.POST or 'customer' not in self.request.POST:
+                message = 'Missing fields (support or customer)'
+                raise PermissionDenied(message, code=403)
+            users = self.check_roles(['SUPPORT'])
             seller = self.request.user
         
-        support = self.check_role('SUPPORT')
-        
+        # Another table than the users : a second SELECT, the only other one
+        # before the writes.
         customer = get_object_or_404(models.Customer, id=self.request.POST['customer'])
-        if customer.existing == False:
-            customer.existing = True
-            customer.save()
         
-        serializer.save(support=support, customer=customer, seller=seller)
-        return super().perform_create(serializer)
+        # Contract.save marks the customer as existing if needed.
+        serializer.save(support=users['SUPPORT'], customer=customer, seller=seller)
     
     def perform_update(self, serializer):
         """
         Do pretty much the save stuff and same verification than the create action.
+        All the changes are saved at once.
         """
         self.check_path_user_customer()
         self.check_fields()
         
-        if 'support' in self.request.POST:
-            support = self.check_role('SUPPORT')
-            serializer.save(support=support)
-        
-        if 'seller' in self.request.POST:
-            seller = self.check_role('SELLER')
-            serializer.save(seller=seller)
+        roles = [role for role in ['SUPPORT', 'SELLER'] if role.lower() in self.request.POST]
+        changes = {role.lower(): user for role, user in self.check_roles(roles).items()}
 
         if 'customer' in self.request.POST:
-            customer = get_object_or_404(models.Customer.objects.get(
-                            id=self.request.POST['customer']))
-            serializer.save(customer=customer)
+            changes['customer'] = get_object_or_404(models.Customer,
+                            id=self.request.POST['customer'])
 
-        return super().perform_update(serializer)
+        serializer.save(**changes)
     
+    @action(detail=False, methods=['post'], url_path='import',
+            parser_classes=[JSONParser, CSVParser])
+    def bulk_import(self, request, *args, **kwargs):
+        """
+        Creates many contracts at once, with the same rules than the create action :
+        only from the /contracts/ endpoint, the support and the customer are required,
+        a MANAGER also chooses the seller, and the event and signature fields are
+        forbidden. The customers become existing.
+        """
+        self.check_path_user_customer()
+        rows = self.get_import_rows()
+        validated_rows, errors = self.validate_import_rows(rows)
+        is_manager = request.user.role == 'MANAGER'
+
+        for index, row in enumerate(rows):
+            for field in ['event', 'signed', 'date_signed']:
+                if field in row:
+                    self.add_import_error(errors, index, field,
+                        'You are trying to update unupdatable fields')
+        supports = self.fetch_import_related(
+                    rows, 'support', MODEL_USER, errors, role='SUPPORT', required=True)
+        sellers = self.fetch_import_related(
+                    rows, 'seller', MODEL_USER, errors, role='SELLER', required=True
+                    ) if is_manager else {}
+        customers = self.fetch_import_related(
+                    rows, 'customer', models.Customer, errors, required=True)
+        if errors:
+            return self.import_errors_response(errors)
+
+        contracts = [models.Contract(
+                        support=supports[index],
+                        seller=sellers[index] if is_manager else request.user,
+                        customer=customers[index], **data)
+                     for index, data in validated_rows.items()]
+        with transaction.atomic():
+            contracts = models.Contract.objects.bulk_create(
+                contracts, batch_size=self.import_batch_size)
+            models.Customer.objects.filter(
+                id__in={contract.customer_id for contract in contracts}, existing=False
+            ).update(existing=True, date_updated=datetime.now())
+            models.ContractVisibility.add_contracts(contracts)
+            states = [(contract.get_report_state(), 1) for contract in contracts]
+            for summary in models.CONTRACT_SUMMARIES:
+                summary.add_states(states)
+        return Response({'created': len(contracts)}, status=201)
+
     def perform_destroy(self, instance):
         """
         A contract is not directly deletable. A user must destroy an event, and
@@ -295,20 +892,39 @@ class ContractViewset(CheckPathMixin, ModelViewSet):
                 message = 'You are trying to update unupdatable fields'
                 raise PermissionDenied(message, code=403)
 
-    def check_role(self, role):
-        user = get_object_or_404(MODEL_USER, id=self.request.POST[role.lower()])
-        if user.role != role:
-            message = 'The support selected is not SUPPORT'
-            raise PermissionDenied(message, code=403)
-        return user
+    def check_roles(self, roles):
+        """
+        Fetches, in one query, the users selected for each role (ex: the
+        'support' field for the SUPPORT role), and checks they have this role.
+        """
+        ids = {role: self.request.POST[role.lower()] for role in roles}
+        if not ids:
+            return {}
+        try:
+            users = MODEL_USER.objects.in_bulk(set(ids.values()))
+        except ValueError:
+            raise NotFound(code=404)
+
+        selected = {}
+        for role, user_id in ids.items():
+            user = users.get(int(user_id))
+            if user is None:
+                raise NotFound(code=404)
+            if user.role != role:
+                message = 'The ' + role.lower() + ' selected is not ' + role
+                raise PermissionDenied(message, code=403)
+            selected[role] = user
+        return selected
 
-class EventViewset(CheckPathMixin, ModelViewSet):
+class EventViewset(CheckPathMixin, ValuesListMixin, ConditionalGetMixin, SparseFieldsMixin, DateRangeMixin, ExportMixin, HistoryMixin, ChangesFeedMixin, ModelViewSet):
     serializer_class = serializers.EventListSerializer
     detail_serializer_class = serializers.EventDetailSerializer
+    date_range_fields = {'date': 'date_event'}
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated,
                     permissions.EventPermission]
+    pagination_class = CursorOrOffsetPagination
 
     def fetch_queryset(self):
         """
@@ -316,44 +932,11 @@ class EventViewset(CheckPathMixin, ModelViewSet):
         can acces the /user/ extentions endpoint.
         A SELLER can only see the events related to his customers, and a SUPPORT member
         can only see the event he is in charge of (throung a contract).
+        Those events are read from the ContractVisibility table.
         """
-        elements_path = self.request.get_full_path().split('/')
         self.check_path_sign()
-        current_user = self.request.user
-        is_manager = current_user.role == 'MANAGER'
-
-        if 'users' == elements_path[2]:
-            if is_manager:
-                user = get_object_or_404(MODEL_USER, id=self.kwargs['user_pk'])
-                if user.role == 'MANAGER':
-                    raise NotFound(detail='This user is manager, therefore he is in charge of no event', code=404)
-                else:
-                    print('slt')
-                    events_list = models.Contract.objects.filter(Q(seller=user) | Q(support=user)).values('event')
-                    return models.Event.objects.filter(id__in=events_list)
-            else:
-                raise PermissionDenied('You are not authorized to perform this action', code=403)
-        
-        elif 'customers' == elements_path[2]:
-            customer = get_object_or_404(models.Customer, id=self.kwargs['customer_pk'])
-            if is_manager:
-                events_list = models.Contract.objects.filter(
-                                customer=customer).values('event')
-            elif current_user.role == 'SELLER':
-                events_list = models.Contract.objects.filter(
-                    Q(customer=customer) & Q(seller=current_user)).values('event')
-            elif current_user.role == 'SUPPORT':
-                events_list = models.Contract.objects.filter(
-                    Q(customer=customer) & Q(support=current_user)).values('event')
-            return models.Event.objects.filter(id__in=events_list)
-        
-        else:
-            if is_manager:
-                return models.Event.objects.all()
-            else:
-                events_list = models.Contract.objects.filter(
-                    Q(seller=current_user) | Q(support=current_user)).values('event')
-                return models.Event.objects.filter(id__in=events_list)
+        message = 'This user is manager, therefore he is in charge of no event'
+        return self.visible_queryset(models.Event, message)
 
     def get_queryset(self):
         queryset = self.fetch_queryset()
@@ -361,25 +944,64 @@ class EventViewset(CheckPathMixin, ModelViewSet):
         compagny_name = self.request.query_params.get('compagny_name')
         email = self.request.query_params.get('email')
         date = self.request.query_params.get('date')
+        finished = self.request.query_params.get('finished')
+        upcoming = self.request.query_params.get('upcoming')
 
-        queryset_contract_last_name = models.Contract.objects.filter(
-                    event__in=queryset, customer__last_name__icontains=last_name).values(
-                                'event') if last_name != None and last_name != '' else queryset
-        queryset = models.Event.objects.filter(id__in=queryset_contract_last_name)
+        # The customer filters go through the contract of the event
+        # (Event.event is the reverse relation to the Contract), so they all
+        # share a single join, only added when one of them is used.
+        customer_filters = {}
+        if last_name != None and last_name != '':
+            customer_filters['event__customer__last_name__icontains'] = last_name
+        if compagny_name != None and compagny_name != '':
+            customer_filters['event__customer__compagny_name__icontains'] = compagny_name
+        if email != None and email != '':
+            customer_filters['event__customer__email__icontains'] = email
+        queryset = queryset.filter(**customer_filters) if customer_filters else queryset
 
-        queryset_contract_compagny_name = models.Contract.objects.filter(
-                    event__in=queryset, customer__compagny_name__icontains=compagny_name).values(
-                                'event') if compagny_name != None and compagny_name != '' else queryset
-        queryset = models.Event.objects.filter(id__in=queryset_contract_compagny_name)
-
-        queryset_contract_email = models.Contract.objects.filter(
-                    event__in=queryset, customer__email__icontains=email).values(
-                                'event') if email != None and email != '' else queryset
-        queryset = models.Event.objects.filter(id__in=queryset_contract_email)
-
-        queryset = queryset.filter(date_event__icontains=date
+        queryset = self.filter_date_prefix(queryset, 'date_event', date
                                 ) if date != None and date != '' else queryset
+        queryset = self.filter_date_range(queryset)
+        queryset = queryset.filter(finished=finished == 'true'
+                                ) if finished == 'true' or finished == 'false' else queryset
+        if upcoming == 'true' or upcoming == 'false':
+            lookup = 'date_event__gte' if upcoming == 'true' else 'date_event__lt'
+            queryset = queryset.filter(**{lookup: timezone.now()})
         return queryset
+
+    @action(detail=False, methods=['get'])
+    def calendar(self, request, *args, **kwargs):
+        """
+        GET .../events/calendar/?month=2022-03 (the current month by default)
+        The events of the month grouped by day, in the timezone of the server.
+        They are read in one query, with the same queryset than the list (so
+        the same security and filters) and ?fields=.
+        """
+        month = request.query_params.get('month')
+        try:
+            start = (datetime.strptime(month, '%Y-%m') if month != None and month != ''
+                     else timezone.localtime().replace(tzinfo=None))
+            start = datetime(start.year, start.month, 1)
+            end = (start + timedelta(days=32)).replace(day=1)
+        except (ValueError, OverflowError):
+            raise ValidationError({'month': 'Expected a month (YYYY-MM)'})
+
+        serializer_class = self.serializer_class
+        fields = self.get_sparse_fields(serializer_class)
+        queryset = self.get_queryset().filter(
+            date_event__gte=timezone.make_aware(start), date_event__lt=timezone.make_aware(end)
+        ).annotate(day=TruncDate('date_event', tzinfo=timezone.get_current_timezone())
+        ).order_by('date_event', 'id').values('day', *serializer_class.get_values_columns(fields))
+
+        days = []
+        count = 0
+        for day, rows in groupby(queryset, key=lambda row: row['day']):
+            events = serializer_class.rows_from_values(rows, fields)
+            days.append({'date': day.isoformat(), 'events': events})
+            count += len(events)
+        if request.accepted_renderer.format == 'json':
+            request.accepted_renderer = FastJSONRenderer()
+        return Response({'month': start.strftime('%Y-%m'), 'count': count, 'days': days})
     
     def get_serializer_class(self):
         if (self.action == 'retrieve' or self.action == 'create'
@@ -398,11 +1020,13 @@ class EventViewset(CheckPathMixin, ModelViewSet):
             message = 'This contract is already signed'
             raise PermissionDenied(message, code=403)
 
-        event = serializer.save(finished=False)
-        contract.event = event
-        contract.signed = True
-        contract.date_signed = pytz.UTC.localize(datetime.now())
-        contract.save()
+        with transaction.atomic():
+            event = serializer.save(finished=False)
+            contract.event = event
+            contract.signed = True
+            contract.date_signed = pytz.UTC.localize(datetime.now())
+            contract.save()
+            models.OutboxMessage.add_contract_signed(contract)
         return event
     
     def perform_update(self, serializer):
@@ -423,4 +1047,66 @@ class EventViewset(CheckPathMixin, ModelViewSet):
         """
         self.check_path_user_customer()
         return super().perform_destroy(instance)
-        
\ No newline at end of file
+        
+
+
+class ReportViewset(GenericViewSet):
+    """
+    Reports for the managers. They are read from the summary tables, kept up
+    to date by the save() of the contracts and the events, so no contract or
+    event is read here.
+    """
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [IsAuthenticated,
+                    permissions.ReportPermissions]
+    reports = ['revenue', 'unpaid', 'pipeline', 'events']
+
+    def list(self, request, *args, **kwargs):
+        return Response({report: reverse('reports-' + report, request=request)
+                         for report in self.reports})
+
+    @action(detail=False, methods=['get'])
+    def revenue(self, request, *args, **kwargs):
+        """
+        Contracts and revenue of each seller, the best first.
+        """
+        summaries = models.SellerSummary.objects.select_related('seller'
+                        ).order_by('-signed_due', 'seller')
+        return Response(serializers.SellerSummarySerializer(summaries, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def unpaid(self, request, *args, **kwargs):
+        """
+        The customers who owe the most first (paginated).
+        """
+        summaries = models.CustomerSummary.objects.filter(unpaid_due__gt=0
+                        ).select_related('customer').order_by('-unpaid_due')
+        page = self.paginate_queryset(summaries)
+        return self.get_paginated_response(
+            serializers.CustomerSummarySerializer(page, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def pipeline(self, request, *args, **kwargs):
+        """
+        Number and due of the signed and of the unsigned contracts.
+        """
+        pipeline = {'signed': {'contracts': 0, 'total_due': 0},
+                    'unsigned': {'contracts': 0, 'total_due': 0}}
+        for summary in models.PipelineSummary.objects.all():
+            pipeline['signed' if summary.signed else 'unsigned'] = {
+                'contracts': summary.contracts, 'total_due': summary.total_due}
+        return Response(pipeline)
+
+    @action(detail=False, methods=['get'])
+    def events(self, request, *args, **kwargs):
+        """
+        Number of events per month. ?year= keeps only the months of a year.
+        """
+        summaries = models.EventMonthSummary.objects.filter(events__gt=0).order_by('month')
+        year = request.query_params.get('year')
+        if year != None and year != '':
+            try:
+                summaries = summaries.filter(month__year=int(year))
+            except ValueError:
+                return Response({'year': 'Must be a year, ex: 2022'}, status=400)
+        return Response(serializers.EventMonthSummarySerializer(summaries, many=True).data)
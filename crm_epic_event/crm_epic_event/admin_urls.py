@@ -0,0 +1,11 @@
+"""
+URLs of the admin. They are only imported at the first request on /admin/
+(see urls.py) : the workers which never serve the admin don't load it, nor
+the admin.py of the apps.
+"""
+from django.contrib import admin
+
+
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
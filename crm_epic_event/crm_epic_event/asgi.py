@@ -2,6 +2,10 @@
 ASGI config for crm_epic_event project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The requests are resolved with asgi_urls.py, where the reads of the crm
+routes are async. Serve it with uvicorn workers :
+
+    gunicorn --pythonpath crm_epic_event crm_epic_event.asgi -k uvicorn.workers.UvicornWorker
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -9,8 +13,53 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crm_epic_event.settings')
 
-application = get_asgi_application()
+
+class CrmASGIHandler(ASGIHandler):
+    urlconf = 'crm_epic_event.asgi_urls'
+
+    async def get_response_async(self, request):
+        request.urlconf = self.urlconf
+        return await super().get_response_async(request)
+
+    async def send_response(self, response, send):
+        """
+        Django 4.0 reads the streaming responses in the event loop, where the
+        exports can't query the database. Their parts are read on the thread of
+        the sync views of the request instead, one by one. The response is
+        closed on that thread too, like Django does : it closes the cursor of
+        the export and sends request_finished (close_old_connections...), even
+        if the client left.
+        """
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        try:
+            headers = [(header.encode('ascii'), value.encode('latin1'))
+                       for header, value in response.items()]
+            headers += [(b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                        for cookie in response.cookies.values()]
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': headers})
+            parts = iter(response)
+            next_part = sync_to_async(next)
+            part = await next_part(parts, None)
+            while part is not None:
+                for chunk, last in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                part = await next_part(parts, None)
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+# Same as get_asgi_application(), with the handler above.
+django.setup(set_prefix=False)
+application = CrmASGIHandler()
+# Every view sync, like get_asgi_application(). Only for the comparisons of bench_asgi.
+sync_application = ASGIHandler()
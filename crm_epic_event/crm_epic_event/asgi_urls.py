@@ -0,0 +1,10 @@
+"""
+URLs of the ASGI application. They are the same than in urls.py, but the list
+and retrieve of the customers, contracts and events are async views (see
+crm/async_views.py).
+"""
+from crm.async_views import async_reads
+from crm_epic_event.urls import urlpatterns as sync_urlpatterns
+
+
+urlpatterns = async_reads(sync_urlpatterns)
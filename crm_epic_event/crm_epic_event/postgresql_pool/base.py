@@ -0,0 +1,255 @@
+"""
+PostgreSQL backend with a pool of connections, shared by the threads of a
+process (the gunicorn threads, or the threads of the async reads under ASGI).
+Django 4.0 has no pool : each thread keeps its own connection, so the number
+of connections grows with the threads. Here a thread borrows a connection for
+a request and gives it back at the end, and at most SIZE connections are
+opened by each process.
+
+Enabled in settings.py with DB_POOL_SIZE. The options are in the POOL key of
+the database settings :
+- SIZE : number of connections of each process.
+- TIMEOUT : seconds a thread waits for a free connection before an
+  OperationalError.
+- HEALTH_CHECK : a connection unused for more than this number of seconds is
+  checked with a SELECT 1 before being lent (0 : at each checkout).
+- MAX_LIFETIME : seconds after which a connection is closed and replaced.
+CONN_MAX_AGE must be 0, so the connections are given back after each request.
+"""
+import collections
+import os
+import threading
+import time
+
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from crm_epic_event.postgresql_pool.creation import DatabaseCreation
+
+
+Database = base.Database
+
+
+class PoolTimeout(Database.OperationalError):
+    pass
+
+
+class Waiter:
+    """
+    A thread waiting for a connection. The connections given back are handed
+    to the waiters in their order of arrival, so none of them waits for ever
+    while the others get the connections.
+    """
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.handed = False
+        self.idle = None
+
+
+class ConnectionPool:
+    def __init__(self, size=10, timeout=10, health_check=30, max_lifetime=3600):
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.max_lifetime = max_lifetime
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # (connection, time it was given back), the most recent last.
+        self.idle = collections.deque()
+        self.waiters = collections.deque()
+        self.opened_at = {}
+        # The connections lent, or being opened.
+        self.in_use = 0
+        self.stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'wait_seconds': 0,
+            'opened': 0,
+            'closed': 0,
+            'health_check_failures': 0
+        }
+
+    def get(self, connect):
+        """
+        Lends an idle connection, or opens one with connect() if there are less
+        than size connections. Otherwise waits for one to be given back.
+        """
+        start = time.monotonic()
+        with self.lock:
+            if self.waiters or (not self.idle and self.in_use >= self.size):
+                waiter = Waiter(self.lock)
+                self.waiters.append(waiter)
+                while not waiter.handed:
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.waiters.remove(waiter)
+                        self.stats['timeouts'] += 1
+                        raise PoolTimeout('No free connection in the pool after %s seconds '
+                                          '(%s connections in use)' % (self.timeout, self.in_use))
+                    waiter.condition.wait(remaining)
+                idle = waiter.idle
+            else:
+                idle = self.idle.pop() if self.idle else None
+                self.in_use += 1
+            self.stats['checkouts'] += 1
+            self.stats['wait_seconds'] += time.monotonic() - start
+
+        try:
+            if idle is not None:
+                connection, released_at = idle
+                if self.is_usable(connection, released_at):
+                    return connection
+                self.discard(connection)
+            connection = connect()
+            with self.lock:
+                self.opened_at[connection] = time.monotonic()
+                self.stats['opened'] += 1
+            return connection
+        except BaseException:
+            self.release(None)
+            raise
+
+    def put(self, connection, discard=False):
+        """
+        Gives back a connection. It is rolled back if a transaction is still
+        open, and closed if it is broken, too old, or if discard is True.
+        """
+        usable = not discard and not connection.closed and not self.expired(connection)
+        if usable and connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except Database.Error:
+                usable = False
+            usable = usable and connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+        if not usable:
+            self.discard(connection)
+        self.release((connection, time.monotonic()) if usable else None)
+
+    def release(self, idle):
+        """
+        Hands the connection, or the right to open one if idle is None, to the
+        first waiter.
+        """
+        with self.lock:
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                waiter.idle = idle
+                waiter.handed = True
+                waiter.condition.notify()
+            else:
+                self.in_use -= 1
+                if idle is not None:
+                    self.idle.append(idle)
+
+    def is_usable(self, connection, released_at):
+        if connection.closed or self.expired(connection):
+            return False
+        if time.monotonic() - released_at < self.health_check:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not connection.autocommit:
+                connection.rollback()
+            return True
+        except Database.Error:
+            with self.lock:
+                self.stats['health_check_failures'] += 1
+            return False
+
+    def expired(self, connection):
+        opened_at = self.opened_at.get(connection)
+        return opened_at != None and time.monotonic() - opened_at > self.max_lifetime
+
+    def discard(self, connection):
+        """
+        Closes a connection which doesn't come back in the pool.
+        """
+        try:
+            connection.close()
+        except Database.Error:
+            pass
+        with self.lock:
+            self.opened_at.pop(connection, None)
+            self.stats['closed'] += 1
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self.lock:
+            idle, self.idle = list(self.idle), collections.deque()
+        for connection, released_at in idle:
+            self.discard(connection)
+
+    def to_text(self, alias):
+        with self.lock:
+            values = [
+                ('crm_db_pool_size', 'gauge', 'Maximum number of connections.', self.size),
+                ('crm_db_pool_connections_in_use', 'gauge', 'Connections lent.', self.in_use),
+                ('crm_db_pool_connections_idle', 'gauge', 'Connections waiting in the pool.',
+                 len(self.idle)),
+                ('crm_db_pool_waiting', 'gauge', 'Threads waiting for a connection.',
+                 len(self.waiters)),
+                ('crm_db_pool_checkouts_total', 'counter', 'Connections lent.',
+                 self.stats['checkouts']),
+                ('crm_db_pool_timeouts_total', 'counter', 'Checkouts which timed out.',
+                 self.stats['timeouts']),
+                ('crm_db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection.',
+                 self.stats['wait_seconds']),
+                ('crm_db_pool_opened_total', 'counter', 'Connections opened.', self.stats['opened']),
+                ('crm_db_pool_closed_total', 'counter', 'Connections closed.', self.stats['closed']),
+                ('crm_db_pool_health_check_failures_total', 'counter',
+                 'Idle connections found broken.', self.stats['health_check_failures']),
+            ]
+        lines = []
+        for name, kind, help, value in values:
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind),
+                      '%s{database="%s"} %s' % (name, alias, value)]
+        return '\n'.join(lines)
+
+
+# The pools of the process, by alias and connection parameters (the tests
+# switch to another database).
+pools = {}
+pools_lock = threading.Lock()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_pool(self, conn_params=None):
+        conn_params = self.get_connection_params() if conn_params is None else conn_params
+        key = (self.alias, repr(sorted(conn_params.items())))
+        with pools_lock:
+            pool = pools.get(key)
+            # The connections opened before a fork belong to the parent.
+            if pool is None or pool.pid != os.getpid():
+                options = self.settings_dict.get('POOL', {})
+                pool = pools[key] = ConnectionPool(
+                    size=options.get('SIZE', 10), timeout=options.get('TIMEOUT', 10),
+                    health_check=options.get('HEALTH_CHECK', 30),
+                    max_lifetime=options.get('MAX_LIFETIME', 3600))
+            return pool
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        connection = self.pool.get(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        # Closed inside an atomic block, the wrapper keeps the connection : it
+        # can't be lent to another thread.
+        with self.wrap_database_errors:
+            self.pool.put(self.connection, discard=self.in_atomic_block)
+
+    def close_pool(self):
+        self.get_pool().close()
+
+    def pool_metrics(self):
+        return self.get_pool().to_text(self.alias)
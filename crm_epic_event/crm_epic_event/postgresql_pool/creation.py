@@ -0,0 +1,10 @@
+from django.db.backends.postgresql import creation
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # The idle connections of the pool are still connected to the test
+        # database, which can't be dropped then.
+        self.connection.close_pool()
+        super()._destroy_test_db(test_database_name, verbosity)
@@ -0,0 +1,109 @@
+import threading
+import time
+
+from django.db import connection
+from django.test import TestCase
+
+from crm_epic_event.postgresql_pool.base import ConnectionPool, Database, DatabaseWrapper, PoolTimeout
+
+
+class ConnectionPoolTest(TestCase):
+    """
+    The pool lends real connections to the test database.
+    """
+    def setUp(self):
+        self.params = connection.get_connection_params()
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+
+    def make_pool(self, **options):
+        pool = ConnectionPool(**options)
+        self.pools.append(pool)
+        return pool
+
+    def connect(self):
+        return Database.connect(**self.params)
+
+    def test_reused(self):
+        """
+        Through the backend, like the requests : the connection closed at the
+        end of a request is lent to the next one.
+        """
+        wrapper = DatabaseWrapper({**connection.settings_dict, 'CONN_MAX_AGE': 0,
+                                   'POOL': {'SIZE': 2}})
+        self.pools.append(wrapper.get_pool())
+        wrapper.ensure_connection()
+        first = wrapper.connection
+        wrapper.close()
+        self.assertEqual([idle[0] for idle in wrapper.pool.idle], [first])
+        self.assertFalse(first.closed)
+
+        wrapper.ensure_connection()
+        self.assertIs(wrapper.connection, first)
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        wrapper.close()
+        self.assertEqual((wrapper.pool.stats['opened'], wrapper.pool.stats['checkouts']), (1, 2))
+        self.assertEqual(wrapper.pool.in_use, 0)
+
+    def test_limit(self):
+        pool = self.make_pool(size=1, timeout=0.2)
+        first = pool.get(self.connect)
+        start = time.monotonic()
+        with self.assertRaises(PoolTimeout):
+            pool.get(self.connect)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(pool.stats['timeouts'], 1)
+
+        # A waiting thread gets the connection given back.
+        lent = []
+        waiter = threading.Thread(target=lambda: lent.append(pool.get(self.connect)))
+        waiter.start()
+        time.sleep(0.05)
+        pool.put(first)
+        waiter.join()
+        self.assertIs(lent[0], first)
+        pool.put(first)
+        self.assertEqual(pool.stats['opened'], 1)
+
+    def test_broken(self):
+        """
+        A connection broken while lent, or while idle, is closed and never
+        lent again.
+        """
+        pool = self.make_pool(size=2, health_check=0)
+        first = pool.get(self.connect)
+        first.close()
+        pool.put(first)
+        self.assertEqual(len(pool.idle), 0)
+        second = pool.get(self.connect)
+        self.assertIsNot(second, first)
+        pool.put(second)
+
+        # Killed by the server while idle : the health check sees it.
+        killer = self.connect()
+        killer.autocommit = True
+        with killer.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [second.get_backend_pid()])
+        killer.close()
+        third = pool.get(self.connect)
+        self.assertIsNot(third, second)
+        self.assertTrue(second.closed)
+        self.assertEqual(pool.stats['health_check_failures'], 1)
+        pool.put(third)
+
+    def test_rollback(self):
+        """
+        A connection given back inside a transaction is rolled back.
+        """
+        pool = self.make_pool(size=1)
+        first = pool.get(self.connect)
+        with first.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        pool.put(first)
+        self.assertEqual(first.info.transaction_status, Database.extensions.TRANSACTION_STATUS_IDLE)
+        self.assertIs(pool.get(self.connect), first)
+        pool.put(first)
@@ -33,12 +33,14 @@ ALLOWED_HOSTS = ['p12-epicevents.herokuapp.com', '127.0.0.1']
 # Application definition
 
 INSTALLED_APPS = [
-    'django.contrib.admin',
+    # Without the autodiscover of the admin.py at startup : see admin_urls.py.
+    'django.contrib.admin.apps.SimpleAdminConfig',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework_simplejwt',
     'phone_field',
@@ -47,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'crm.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -55,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'crm.history.HistoryMiddleware',
 ]
 
 ROOT_URLCONF = 'crm_epic_event.urls'
@@ -95,6 +99,20 @@ import dj_database_url
 db_from_env = dj_database_url.config(conn_max_age=600)
 DATABASES['default'].update(db_from_env)
 
+# Pool of database connections shared by the threads of each process (see
+# crm_epic_event/postgresql_pool). Off by default : each thread keeps its own
+# connection for CONN_MAX_AGE seconds.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+if DB_POOL_SIZE:
+    DATABASES['default']['ENGINE'] = 'crm_epic_event.postgresql_pool'
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['POOL'] = {
+        'SIZE': DB_POOL_SIZE,
+        'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'HEALTH_CHECK': float(os.environ.get('DB_POOL_HEALTH_CHECK', 30)),
+        'MAX_LIFETIME': float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600)),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -151,3 +169,29 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=365),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=365)
 }
+
+# How long the role and status of a user are cached by the
+# StatelessJWTAuthentication. The default cache is local to each process : with
+# several workers, a change is seen by the other workers after this delay at worst,
+# unless CACHES points to a shared cache (Redis, Memcached...).
+JWT_USER_CACHE_TIMEOUT = 60
+
+# Part of the requests measured by crm.metrics.MetricsMiddleware, from 0 to 1.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 1))
+# If set, /api/metrics requires it as a bearer token.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Urls called by the outbox_worker command when a contract is signed,
+# separated by commas (see crm.models.OutboxMessage). If a secret is set, the
+# body is signed with it (X-Outbox-Signature header, HMAC-SHA256).
+OUTBOX_WEBHOOKS = [url.strip() for url in os.environ.get('OUTBOX_WEBHOOKS', '').split(',')
+                   if url.strip() != '']
+OUTBOX_WEBHOOK_SECRET = os.environ.get('OUTBOX_WEBHOOK_SECRET')
+
+# Change history of the customers, contracts and events (see crm/history.py).
+HISTORY_ENABLED = os.environ.get('HISTORY_ENABLED', '1') == '1'
+
+# The changes feeds (/api/<resource>/changes/) : their window ends SYNC_LAG
+# seconds ago, and the tombstones are kept SYNC_TOMBSTONE_DAYS days.
+SYNC_LAG = int(os.environ.get('SYNC_LAG', 5))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 30))
@@ -13,13 +13,15 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, URLResolver
+from django.urls.resolvers import RoutePattern
 
 from rest_framework_nested import routers
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
+import crm.metrics
 import crm.views
+import users.serializers
 import users.views
 
 
@@ -28,6 +30,7 @@ router.register('users', users.views.UserViewset, basename='users')
 router.register('customers', crm.views.CustomerViewset, basename='customers')
 router.register('contracts', crm.views.ContractViewset, basename='contracts')
 router.register('events', crm.views.EventViewset, basename='events')
+router.register('reports', crm.views.ReportViewset, basename='reports')
 
 users_router = routers.NestedSimpleRouter(router, 'users', lookup='user')
 users_router.register('customers', crm.views.CustomerViewset, basename='_user_customers')
@@ -41,11 +44,43 @@ customers_router.register('events', crm.views.EventViewset, basename='customer_e
 contracts_router = routers.NestedSimpleRouter(router, 'contracts', lookup='contract')
 contracts_router.register('sign', crm.views.EventViewset, basename='contract_sign')
 
+
+class LazyURLResolver(URLResolver):
+    """
+    Resolver of a urlconf given by its path, which is only imported at its
+    first request, or at the first reverse() of one of its urls. Until then,
+    the reverse() of the other urls leave it out.
+    """
+    def _populate(self):
+        if 'urlconf_module' in self.__dict__:
+            super()._populate()
+
+    @property
+    def reverse_dict(self):
+        self.urlconf_module
+        return super().reverse_dict
+
+    @property
+    def namespace_dict(self):
+        self.urlconf_module
+        return super().namespace_dict
+
+    @property
+    def app_dict(self):
+        self.urlconf_module
+        return super().app_dict
+
+
 urlpatterns = [
-    path('admin/', admin.site.urls),
+    # Like path('admin/', admin.site.urls), but admin_urls.py is imported at the
+    # first request on /admin/ only.
+    LazyURLResolver(RoutePattern('admin/'), 'crm_epic_event.admin_urls',
+        app_name='admin', namespace='admin'),
     path('api-auth/', include('rest_framework.urls')),
-    path('api/login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('api/login/', TokenObtainPairView.as_view(
+        serializer_class=users.serializers.RoleTokenObtainPairSerializer), name='token_obtain_pair'),
     path('api/login/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/metrics', crm.metrics.metrics_view, name='metrics'),
     path('api/', include(router.urls)),
     path('api/', include(users_router.urls)),
     path('api/', include(customers_router.urls)),
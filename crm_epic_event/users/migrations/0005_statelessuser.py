@@ -0,0 +1,28 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:38
+
+import django.contrib.auth.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_user_password'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatelessUser',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('users.user',),
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+    ]
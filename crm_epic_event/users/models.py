@@ -1,4 +1,6 @@
 from django.db import models
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
 from django.contrib.auth.models import AbstractUser
 from phone_field import PhoneField
 
@@ -28,3 +30,35 @@ class User(AbstractUser):
         if self.role == 'MANAGER':
             self.is_superuser == True
         super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'role' in update_fields or 'is_active' in update_fields:
+            cache.delete(self.state_cache_key(self.id))
+
+    def delete(self, *args, **kwargs):
+        cache.delete(self.state_cache_key(self.id))
+        return super().delete(*args, **kwargs)
+
+    @staticmethod
+    def state_cache_key(user_id):
+        """
+        Key of the cached role and status of the user, read by the
+        StatelessJWTAuthentication.
+        """
+        return 'user_state_' + str(user_id)
+
+
+class StatelessUser(User):
+    """
+    A user rebuilt from the claims of his token and the cache, without any query.
+    It can be the request.user, be used in filters or as a foreign key, but it
+    is not complete, so it can't be saved or deleted.
+    """
+
+    class Meta:
+        proxy = True
+
+    def save(self, *args, **kwargs):
+        raise PermissionDenied('A stateless user can\'t be saved')
+
+    def delete(self, *args, **kwargs):
+        raise PermissionDenied('A stateless user can\'t be deleted')
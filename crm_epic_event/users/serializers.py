@@ -1,4 +1,5 @@
 from rest_framework.serializers import ModelSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 from users.models import User as MODEL_USER
 
@@ -23,3 +24,16 @@ class UserListSerializer(ModelSerializer):
     class Meta:
         model = MODEL_USER
         fields = ['first_name', 'last_name', 'id']
+
+
+class RoleTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    The tokens also carry the username of the user. Not his role, which
+    StatelessJWTAuthentication reads from the cache and the database.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        return token
@@ -1,3 +1,75 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from crm.models import Customer
+from users.authentication import StatelessJWTAuthentication
+from users.models import StatelessUser, User
+
+
+class StatelessJWTAuthenticationTest(TestCase):
+    """
+    The crm routes rebuild the user from his token and the cache : no query
+    while the cache is warm, and a change of role or status applies at once.
+    """
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='jamy', role='SELLER', email='jamy@example.com')
+        self.user.set_password('jambon12')
+        self.user.save()
+        self.customer = Customer.objects.create(
+            last_name='Dupont', compagny_name='Dupont SA',
+            email='dupont@example.com', seller=self.user)
+        self.client = APIClient()
+        response = self.client.post('/api/login/', {'username': 'jamy', 'password': 'jambon12'})
+        self.assertEqual(response.status_code, 200)
+        self.authorization = 'Bearer ' + response.data['access']
+        self.client.credentials(HTTP_AUTHORIZATION=self.authorization)
+
+    def get_customers(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/customers/')
+        users_queries = [query for query in context.captured_queries
+                         if 'FROM "users_user"' in query['sql']]
+        return response, users_queries
+
+    def test_cached(self):
+        response, users_queries = self.get_customers()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(users_queries), 1)
+        response, users_queries = self.get_customers()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(users_queries, [])
+        self.assertEqual([row['id'] for row in response.data['results']], [self.customer.id])
+
+    def test_role_changed(self):
+        # A SELLER can create customers (the empty one is invalid), a SUPPORT
+        # member can't.
+        self.assertEqual(self.client.post('/api/customers/', {}).status_code, 400)
+        self.user.role = 'SUPPORT'
+        self.user.save()
+        response, users_queries = self.get_customers()
+        self.assertEqual(len(users_queries), 1)
+        self.assertEqual(self.client.post('/api/customers/', {}).status_code, 403)
+
+    def test_inactive(self):
+        self.get_customers()
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        response, users_queries = self.get_customers()
+        self.assertEqual(response.status_code, 401)
+
+    def test_not_saved(self):
+        # The user of a request authenticated by a token can't be written.
+        request = RequestFactory().get('/api/customers/', HTTP_AUTHORIZATION=self.authorization)
+        user, token = StatelessJWTAuthentication().authenticate(request)
+        self.assertIsInstance(user, StatelessUser)
+        user.first_name = 'Changed'
+        with self.assertRaises(PermissionDenied):
+            user.save()
+        with self.assertRaises(PermissionDenied):
+            user.delete()
+        self.assertEqual(User.objects.get(id=self.user.id).first_name, '')
@@ -0,0 +1,53 @@
+"""
+Configuration of gunicorn in production (see the Procfile).
+
+The application is loaded once by the master, then the workers are forked
+from it : they share the memory of Django, DRF and the apps (copy-on-write)
+and start at once. The environment variables :
+- WEB_CONCURRENCY : number of workers, 2 per CPU + 1 by default.
+- GUNICORN_THREADS : threads per worker (2). The threads wait for the database
+  in turn, see DB_POOL_SIZE in the settings to share its connections.
+- GUNICORN_MAX_REQUESTS : a worker is replaced after this number of requests
+  (1000, 0 to never replace them), which limits the growth of its memory.
+- GUNICORN_PRELOAD : 0 to load the application in each worker instead.
+"""
+import gc
+import os
+
+
+def cpu_count():
+    # The CPUs the process can run on, which can be less than the CPUs of the
+    # machine in a container.
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+workers = int(os.environ.get('WEB_CONCURRENCY', cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 2))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+# The workers are not all replaced at the same time.
+max_requests_jitter = max_requests // 10
+timeout = 30
+# The heartbeat of the workers is written in memory rather than on the disk.
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def when_ready(server):
+    """
+    Called by the master before forking the workers. With preload_app, the
+    urls (and so the views, serializers...) are imported here too, the
+    connections opened while loading are closed, so that the workers don't
+    share them, and the objects loaded are left out of the garbage collector,
+    whose passes would otherwise write in their pages and copy them in every
+    worker.
+    """
+    if not preload_app:
+        return
+    from django.db import connections
+    from django.urls import get_resolver
+
+    get_resolver().url_patterns
+    connections.close_all()
+    gc.freeze()